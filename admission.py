@@ -0,0 +1,165 @@
+import math
+import os
+import shutil
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException
+
+import metrics
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, cost=1):
+        """0 if `cost` tokens were taken, else the seconds until they would be available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.burst)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+
+def parse_api_keys(value):
+    """'key1:600:100,key2' -> {'key1': (600, 100), 'key2': (None, None)} (per minute, burst; None = default x4)."""
+    keys = {}
+    for item in (value or "").split(","):
+        parts = item.strip().split(":")
+        if not parts[0]:
+            continue
+        rate = float(parts[1]) if len(parts) > 1 and parts[1] else None
+        burst = float(parts[2]) if len(parts) > 2 and parts[2] else None
+        keys[parts[0]] = (rate, burst)
+    return keys
+
+
+class Admission:
+    """
+    Admission control in front of the expensive endpoints: answer fast when we're
+    saturated instead of starting engines, Chrome and ffmpeg we can't finish.
+    - per-client token buckets, keyed by API key (X-API-Key header / api_key param,
+      only keys listed in API_KEYS) or else client IP -> 429 + Retry-After
+    - global caps -> 503 + Retry-After: engine races in flight, download tasks,
+      FFmpeg jobs (running + queued, live and background), free space for the
+      temp files downloads and adaptive /stream staging write
+    The engine-race cap for info/batch/stream lookups is applied by admit_race() on
+    the cache-miss path only: cache hits and lookups joining a race already in flight
+    cost nothing, so they're never turned away for it. Downloads resolve in the
+    background, where a 503 can't be sent, so they're checked up front.
+    Everything here is per gunicorn worker: RATE_LIMIT_PER_MIN is per host and is
+    split across WEB_CONCURRENCY workers, the ADMIT_MAX_* caps are per worker.
+    """
+    RATE = float(os.getenv("RATE_LIMIT_PER_MIN", "60"))       # 0 = no per-client limit
+    BURST = float(os.getenv("RATE_LIMIT_BURST", "20"))
+    API_KEYS = parse_api_keys(os.getenv("API_KEYS", ""))
+    WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    TRUST_FORWARDED = os.getenv("TRUST_FORWARDED_FOR", "false").lower() in ("1", "true", "yes")
+    MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "10000"))
+    # Tokens per request; a batch costs one per URL (capped at the burst)
+    COSTS = {"info": 1, "batch": 1, "download": 3, "stream": 3}
+
+    MAX_RACES = int(os.getenv("ADMIT_MAX_RACES", "16"))
+    MAX_TASKS = int(os.getenv("ADMIT_MAX_TASKS", "24"))
+    MAX_TRANSCODES = int(os.getenv("ADMIT_MAX_TRANSCODES", "8"))
+    MIN_FREE_MB = int(os.getenv("ADMIT_MIN_FREE_MB", "1024"))
+    RETRY_AFTER = int(os.getenv("ADMIT_RETRY_AFTER", "10"))
+
+    def __init__(self, races, tasks, transcodes, disk_paths):
+        # Load probes: callables returning the current count (and paths whose disk must have room)
+        self.races = races
+        self.tasks = tasks
+        self.transcodes = transcodes
+        self.disk_paths = disk_paths
+        self.buckets = OrderedDict()
+        self.admitted = 0
+        self.rejected = {}
+
+    def client_key(self, request):
+        key = request.headers.get("x-api-key") or request.query_params.get("api_key")
+        if key and key in self.API_KEYS:
+            return "key:" + key
+        # Unknown keys fall back to the IP, so rotating made-up keys buys nothing
+        forwarded = request.headers.get("x-forwarded-for") if self.TRUST_FORWARDED else None
+        if forwarded:
+            return "ip:" + forwarded.split(",")[0].strip()
+        return "ip:" + (request.client.host if request.client else "unknown")
+
+    def _bucket(self, client):
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            rate, burst = self.RATE, self.BURST
+            if client.startswith("key:"):
+                key_rate, key_burst = self.API_KEYS[client[4:]]
+                rate, burst = key_rate or rate * 4, key_burst or burst * 4
+            bucket = self.buckets[client] = TokenBucket(rate / 60 / self.WORKERS, max(1, burst))
+            if len(self.buckets) > self.MAX_CLIENTS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client)
+        return bucket
+
+    def _saturated(self, endpoint):
+        """Reason we can't take `endpoint` work right now, or None."""
+        if endpoint == "download" and self.races() >= self.MAX_RACES:
+            return "engine_races"
+        if endpoint == "download" and self.tasks() >= self.MAX_TASKS:
+            return "download_tasks"
+        if endpoint in ("download", "stream") and self.transcodes() >= self.MAX_TRANSCODES:
+            return "transcodes"
+        if endpoint in ("download", "stream") and self.MIN_FREE_MB:
+            for path in self.disk_paths:
+                try:
+                    if shutil.disk_usage(path).free < self.MIN_FREE_MB * 1024 * 1024:
+                        return "disk"
+                except OSError:
+                    pass
+        return None
+
+    def _reject(self, endpoint, status, reason, retry_after, detail):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        metrics.ADMISSION_REJECTED.inc(endpoint=endpoint, reason=reason)
+        raise HTTPException(status_code=status, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+    def admit(self, request, endpoint, cost=None):
+        """Raises HTTPException 503 (we're full) or 429 (this client is over its rate)."""
+        # Global caps first: a 503 doesn't use up the client's tokens
+        reason = self._saturated(endpoint)
+        if reason:
+            print(f"[Admission] 503 {endpoint}: {reason}")
+            self._reject(endpoint, 503, reason, self.RETRY_AFTER, f"Server busy ({reason}), retry later")
+        wait = 0
+        if self.RATE > 0:
+            wait = self._bucket(self.client_key(request)).take(cost or self.COSTS.get(endpoint, 1))
+        if wait:
+            self._reject(endpoint, 429, "rate_limit", wait, "Rate limit exceeded")
+        self.admitted += 1
+
+    def admit_race(self, endpoint):
+        """Raises HTTPException 503 if a new engine race for `endpoint` would exceed MAX_RACES."""
+        if self.races() >= self.MAX_RACES:
+            print(f"[Admission] 503 {endpoint}: engine_races")
+            self._reject(endpoint, 503, "engine_races", self.RETRY_AFTER, "Server busy (engine_races), retry later")
+
+    def stats(self):
+        return {
+            "clients": len(self.buckets),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "load": {
+                "engine_races": f"{self.races()}/{self.MAX_RACES}",
+                "download_tasks": f"{self.tasks()}/{self.MAX_TASKS}",
+                "transcodes": f"{self.transcodes()}/{self.MAX_TRANSCODES}",
+            },
+        }
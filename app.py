@@ -1,28 +1,114 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 import uvicorn
 import aiohttp
 import asyncio
+import functools
 import os
 import uuid
+import json
+import re
+import time
 import tempfile
-from typing import Optional
+from typing import List, Optional
+from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 load_dotenv()
 
 from youtube_downloader import YouTubeDownloader, USER_AGENT
+from youtube_reverse import ProxyManager
+from http_pool import HttpPool
+from segmented_download import SegmentedDownloader, staging_path, claim_staging, release_staging, sweep_staging
+from resumable import iter_resumable
+from task_store import TaskStore
+from task_events import TaskEvents
+from artifact_cache import ArtifactCache
+from ffmpeg_runner import run_ffmpeg, FFmpegError, PipeInput, scheduler as ffmpeg_scheduler
+from stream_pipeline import StreamPipeline, PipelineResponse, StreamIdle
+import stream_pipeline
+from range_response import RangeFileResponse, parse_ranges, multipart_layout, RangeNotSatisfiable
+from cancellation import cancel_all
+from admission import Admission
+from formats import codec_family
+import executors
+import metrics
+import ytdlp_worker
+import selenium_worker
 
 import os
 import ssl
 
 
+# / answers as soon as the worker is up (liveness); /ready waits for warm_up (readiness)
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "60"))
+SELENIUM_WARM = os.getenv("SELENIUM_WARM", "false").lower() in ("1", "true", "yes")
+readiness = {"ready": False, "warmup": {}}
+
+async def warm_up():
+    """
+    Pays the first request's setup costs before /ready says yes: the yt-dlp pool with
+    its extractor loaded, and (SELENIUM_WARM=true) one Chrome per selenium thread.
+    A step that fails or times out is reported but doesn't hold readiness back;
+    the engine then just starts cold.
+    """
+    started = time.perf_counter()
+    disabled = downloader.reverse_engine.DISABLED_ENGINES
+    steps = {}
+    # The instances the races will use: ytdlp-proxy's (PROXY_URL, if set) and ytdlp-direct's
+    proxy = await ProxyManager.get_proxy()
+    proxies = {p for name, p in (("ytdlp-proxy", proxy), ("ytdlp-direct", None)) if name not in disabled}
+    if proxies:
+        init = functools.partial(ytdlp_worker.init_worker, *proxies)
+        steps["ytdlp"] = executors.ytdlp_pool.warm(init, executors.ytdlp_pool.workers)
+    if SELENIUM_WARM and "selenium" not in disabled:
+        steps["selenium"] = executors.selenium_pool.warm(selenium_worker.warm, executors.selenium_pool.workers)
+
+    async def step(name, coro):
+        began = time.perf_counter()
+        try:
+            await asyncio.wait_for(coro, WARMUP_TIMEOUT)
+            result = "ok"
+        except Exception as e:
+            result = f"failed: {type(e).__name__} {e}".strip()
+            print(f"[Warmup] {name} {result}")
+        readiness["warmup"][name] = {"result": result, "seconds": round(time.perf_counter() - began, 3)}
+
+    await asyncio.gather(*(step(name, coro) for name, coro in steps.items()))
+    readiness["ready"] = True
+    print(f"[Warmup] Ready in {time.perf_counter() - started:.2f}s")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared keep-alive pools for the engines and the download/stream paths
+    await HttpPool.start()
+    warmup_task = asyncio.create_task(warm_up())
+    artifacts.cleanup_staging()
+    cleanup_task = asyncio.create_task(tasks.cleanup_loop())
+    # Per-worker metrics dump, merged across workers by /metrics
+    metrics_task = asyncio.create_task(metrics.flush_loop())
+    # Re-resolves hot videos before their cached stream URLs expire
+    prewarm_task = asyncio.create_task(downloader.prewarmer.loop())
+    yield
+    warmup_task.cancel()
+    cleanup_task.cancel()
+    metrics_task.cancel()
+    prewarm_task.cancel()
+    await HttpPool.close()
+    # yt-dlp workers and the long-lived Chrome drivers
+    executors.shutdown_all()
+
 app = FastAPI(
     title="TikDown YouTube API",
     description="High-performance YouTube Downloader API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+# Opt-in request tracing (X-Trace: 1 header or TRACE_SAMPLE_RATE)
+app.add_middleware(metrics.TraceMiddleware)
+
 # Enable CORS for frontend flexibility
 app.add_middleware(
     CORSMiddleware,
@@ -36,92 +122,324 @@ downloader = YouTubeDownloader()
 
 @app.get("/")
 async def health_check():
-    return {"status": "online", "engine": "TubeFetch Pro"}
+    """Liveness: the worker answers. Whether it's warmed up is /ready."""
+    return {"status": "online", "engine": "TubeFetch Pro", "ready": readiness["ready"]}
+
+@app.get("/ready")
+async def ready_check():
+    """Readiness: 503 until warm_up has run, so load balancers hold traffic back until then."""
+    return JSONResponse(status_code=200 if readiness["ready"] else 503, content=readiness)
+
+# Shared (cross-worker) database for download progress tracking
+tasks = TaskStore()
+
+# Pushes task progress over SSE (one batched store read per tick per worker)
+events = TaskEvents(tasks)
+
+# Finished MP4/MP3 files shared by every request for the same video + encode settings
+artifacts = ArtifactCache()
+
+# 429/503 + Retry-After instead of piling engines, Chrome and ffmpeg onto a saturated host
+admission = Admission(
+    races=lambda: downloader.inflight.stats()["in_flight"],
+    tasks=metrics.active_tasks,
+    transcodes=ffmpeg_scheduler.load,
+    disk_paths=[tempfile.gettempdir(), artifacts.dir],
+)
+
+# FFmpeg output settings; they are part of the artifact cache key
+AUDIO_ARGS = ["-vn", "-ar", "44100", "-ac", "2", "-b:a", "192k"]     # MP3 Conversion
+VIDEO_ARGS = ["-c", "copy", "-movflags", "faststart"]               # MP4 Remuxing (no transcoding for speed)
+
+def output_spec(type_str: str):
+    if type_str == "audio":
+        return "mp3", AUDIO_ARGS
+    return "mp4", VIDEO_ARGS
 
-# Memory database for download progress tracking
-download_tasks = {}
+# Remux without re-encoding (transcode=false): AAC keeps its MP4 container, Opus/Vorbis go to Ogg
+def audio_copy_spec(acodec: Optional[str]):
+    if codec_family(acodec) in ("opus", "vorbis"):
+        return "ogg", ["-vn", "-c:a", "copy"]
+    # Progressive fallbacks without codec info carry AAC
+    return "m4a", ["-vn", "-c:a", "copy", "-movflags", "faststart"]
 
-async def run_download_task(task_id: str, url: str, type_str: str, itag: Optional[str]):
+# /stream audio containers: preferred source codec, ffmpeg muxer args, encoder if the source doesn't fit
+STREAM_AUDIO = {
+    "m4a": ("aac", ["-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4"], ["-c:a", "aac", "-b:a", "192k"]),
+    "ogg": ("opus", ["-f", "ogg"], ["-c:a", "libopus", "-b:a", "160k"]),
+}
+
+MEDIA_TYPES = {"mp3": "audio/mpeg", "m4a": "audio/mp4", "ogg": "audio/ogg", "opus": "audio/ogg"}
+
+def media_type_for(filename: str):
+    return MEDIA_TYPES.get(filename.rsplit(".", 1)[-1].lower(), "video/mp4")
+
+# Adaptive mode: video-only input 0 + audio-only input 1, stream-copied into one MP4
+MUX_MAP = ["-map", "0:v:0", "-map", "1:a:0"]
+STREAM_MOVFLAGS = "frag_keyframe+empty_moov+default_base_moof"
+
+def media_sources(info: dict):
+    """URLs FFmpeg reads: the progressive stream, or separate video + audio to mux."""
+    if info.get("mode") == "adaptive":
+        return [info["video_url"], info["audio_url"]]
+    if info.get("mode") == "audio":
+        return [info["audio_url"]]
+    return [info["play"]]
+
+def ffmpeg_queue(task_id: str, running_status: str):
+    """on_queue callback: 'queued' + position while waiting for an FFmpeg slot, then back to running_status."""
+    def on_queue(position):
+        if position:
+            tasks.queue_position(task_id, position)
+        else:
+            tasks.queue_position(task_id, None, status=running_status)
+    return on_queue
+
+def combined_progress(count: int, report):
+    """One on_progress(downloaded, total) callback per parallel download, reported as a single fraction."""
+    seen = [(0, 0)] * count
+    def make(idx):
+        def on_progress(downloaded, total):
+            seen[idx] = (downloaded, total)
+            if all(t for _, t in seen):
+                report(sum(d for d, _ in seen) / sum(t for _, t in seen))
+        return on_progress
+    return [make(idx) for idx in range(count)]
+
+# "pipe": stream the download straight into ffmpeg's stdin (no raw temp file);
+# falls back to "staged" when the container needs seeking (e.g. MP4 with moov at the end)
+PIPE_MODE = os.getenv("FFMPEG_PIPE_MODE", "pipe").lower()
+
+# Share of the staged-mode progress bar spent downloading (remux is quick, MP3 encode is not)
+STAGED_DOWNLOAD_SHARE = {"copy": 0.9, "encode": 0.6}
+
+async def build_media(task_id: str, url: str, itag: Optional[str], out_args: list, final_file: str,
+                      mode: str = "combined", quality: Optional[str] = None, codec: Optional[str] = None,
+                      info: Optional[dict] = None):
+    """Resolves (unless `info` is given), downloads and runs FFmpeg into final_file (holding a download slot)."""
+    # Wait for one of the host-wide download slots
+    await tasks.acquire_slot(task_id)
     try:
+        await tasks.update(task_id, status="downloading")
+
         # STEP 1: Get direct playable URL via Reverse Engine
         # Support itag if provided
-        info = await downloader.get_media_info(url, itag=itag)
-        if not info or not info.get("play"):
+        info = info or await downloader.get_media_info(url, itag=itag, mode=mode, quality=quality, codec=codec)
+        if not info:
             raise Exception("Could not retrieve a playable URL.")
         
-        play_url = info["play"]
-        temp_dir = tempfile.gettempdir()
-        final_file = os.path.join(temp_dir, f"{task_id}.{'mp3' if type_str == 'audio' else 'mp4'}")
-
-        # Download to raw temp file first (Avoids pipe errors and allows FFmpeg seeking)
-        raw_temp_file = os.path.join(temp_dir, f"raw-{task_id}")
+        sources = media_sources(info)
+        if info["mode"] == "audio":
+            print(f"[*] Audio-only source: itag {info['audio_itag']} ({info['acodec']})")
+        if len(sources) > 1:
+            print(f"[*] Muxing adaptive {info['quality']} ({info['vcodec']} + {info['acodec']})")
+            out_args = [*MUX_MAP, *out_args]
         proxy = os.getenv("PROXY_URL")
-        
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-            async with session.get(play_url, headers={"User-Agent": USER_AGENT}, proxy=proxy, timeout=600) as resp:
-                if resp.status >= 400:
-                    raise Exception(f"YouTube stream error: {resp.status}")
-                
-                total_size = int(resp.headers.get('content-length', 0))
-                downloaded = 0
-                
-                with open(raw_temp_file, "wb") as f:
-                    async for chunk in resp.content.iter_chunked(1024 * 1024):
-                        if not chunk: break
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        if total_size > 0:
-                            download_tasks[task_id]["progress"] = round((downloaded / total_size) * 80, 1) # 80% is download
-
-        # STEP 2: Use FFmpeg to process the downloaded file
-        print(f"[*] Processing with FFmpeg: {raw_temp_file}")
-        if type_str == "audio":
-            # MP3 Conversion
-            cmd = ["ffmpeg", "-y", "-i", raw_temp_file, "-vn", "-ar", "44100", "-ac", "2", "-b:a", "192k", final_file]
-        else:
-            # MP4 Remuxing with faststart (no transcoding for speed)
-            cmd = ["ffmpeg", "-y", "-i", raw_temp_file, "-c", "copy", "-movflags", "faststart", final_file]
+        # Expired/403 stream URLs get re-resolved mid-download (same itag, same offset)
+        refreshers = downloader.stream_refreshers(url, info, itag)
+        # Staged downloads are named by stream, so a retry of this video resumes them
+        video_id = downloader.reverse_engine._extract_video_id(url)
+        staging = [staging_path(video_id, stream_itag) if video_id and stream_itag else None
+                   for _, stream_itag in downloader.stream_itags(info)]
 
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.DEVNULL,
-            stderr=asyncio.subprocess.DEVNULL
-        )
-        await process.wait()
-        
-        # Cleanup raw file
-        try: os.unlink(raw_temp_file)
-        except: pass
+        # STEP 2: Download + FFmpeg
+        if PIPE_MODE == "pipe":
+            try:
+                await build_piped(task_id, sources, proxy, out_args, final_file, refreshers)
+            except FFmpegError as e:
+                print(f"[FFmpeg] Pipe mode failed ({e}), retrying staged")
+                await build_staged(task_id, sources, proxy, out_args, final_file, refreshers, staging)
+        else:
+            await build_staged(task_id, sources, proxy, out_args, final_file, refreshers, staging)
 
         if not os.path.exists(final_file) or os.path.getsize(final_file) < 500:
             raise Exception("Final file is missing or too small.")
+    finally:
+        await tasks.release_slot(task_id)
 
-        download_tasks[task_id]["status"] = "completed"
-        download_tasks[task_id]["progress"] = 100
-        download_tasks[task_id]["file"] = final_file
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        print(f"[Task Error] {e}")
-        download_tasks[task_id]["status"] = "error"
-        download_tasks[task_id]["error"] = str(e)
+async def build_piped(task_id: str, sources: list, proxy: Optional[str], out_args: list, final_file: str,
+                      refreshers: Optional[list] = None):
+    """Network -> ffmpeg stdin (or one pipe per adaptive input) -> final_file, with download and encode overlapping."""
+    state = {"encoded": None}
+
+    def on_download(fraction):
+        # Until ffmpeg knows the duration, bytes received is the best estimate
+        if state["encoded"] is None:
+            tasks.progress(task_id, round(fraction * 99, 1))
+
+    def on_encode(fraction):
+        state["encoded"] = fraction
+        tasks.progress(task_id, round(fraction * 99, 1))
+
+    # In-order parallel Range segments over the shared pool (single stream if unsupported)
+    fetchers = [
+        SegmentedDownloader(src, headers={"User-Agent": USER_AGENT}, proxy=proxy, on_progress=cb, refresh=refresh)
+        for src, cb, refresh in zip(sources, combined_progress(len(sources), on_download), refreshers or [None] * len(sources))
+    ]
+    print(f"[*] Piping into FFmpeg: {final_file}")
+    if len(fetchers) == 1:
+        await run_ffmpeg(
+            ["-i", "pipe:0"], [*out_args, final_file], feed=fetchers[0].stream(),
+            on_progress=on_encode, on_queue=ffmpeg_queue(task_id, "downloading")
+        )
+    else:
+        pipes = [PipeInput(f.stream()) for f in fetchers]
+        input_args = [arg for p in pipes for arg in ("-i", p.arg)]
+        await run_ffmpeg(
+            input_args, [*out_args, final_file], pipes=pipes,
+            on_progress=on_encode, on_queue=ffmpeg_queue(task_id, "downloading")
+        )
+    # ffmpeg exits 0 with an empty file when the input can't be demuxed without seeking
+    if not os.path.exists(final_file) or os.path.getsize(final_file) < 500:
+        raise FFmpegError("Piped input produced no output (container needs seeking)")
+
+async def build_staged(task_id: str, sources: list, proxy: Optional[str], out_args: list, final_file: str,
+                       refreshers: Optional[list] = None, staging: Optional[list] = None):
+    """
+    Download to raw temp files first (allows FFmpeg seeking), then process them.
+    `staging` (per source, None = unknown stream) names resumable files: if the build
+    fails they are kept with their '.state' so the next attempt picks up the segments
+    already on disk. A stream another build is staging right now gets a per-task file.
+    """
+    share = STAGED_DOWNLOAD_SHARE["copy" if "copy" in out_args else "encode"]
+    sweep_staging()
+    raw_temp_files, resumable, claims = [], [], []
+    for idx, path in enumerate(staging or [None] * len(sources)):
+        fd = claim_staging(path) if path else None
+        if fd is None:
+            path = os.path.join(tempfile.gettempdir(), f"raw-{task_id}-{idx}")
+        else:
+            claims.append(fd)
+            resumable.append(path)
+        raw_temp_files.append(path)
+    built = False
+
+    def on_download(fraction):
+        tasks.progress(task_id, round(fraction * share * 100, 1))
+
+    def on_encode(fraction):
+        tasks.progress(task_id, round((share + fraction * (1 - share)) * 100, 1))
+
+    try:
+        # Parallel Range segments over the shared pool (falls back to one stream if unsupported);
+        # adaptive video and audio download side by side
+        downloads = [
+            asyncio.ensure_future(SegmentedDownloader(
+                src, raw, headers={"User-Agent": USER_AGENT}, proxy=proxy, on_progress=cb, refresh=refresh
+            ).run())
+            for src, raw, cb, refresh in zip(sources, raw_temp_files, combined_progress(len(sources), on_download),
+                                             refreshers or [None] * len(sources))
+        ]
+        try:
+            await asyncio.gather(*downloads)
+        finally:
+            await cancel_all(downloads)
+
+        print(f"[*] Processing with FFmpeg: {', '.join(raw_temp_files)}")
+        await tasks.update(task_id, status="processing")
+        input_args = [arg for raw in raw_temp_files for arg in ("-i", raw)]
+        await run_ffmpeg(input_args, [*out_args, final_file], on_progress=on_encode, on_queue=ffmpeg_queue(task_id, "processing"))
+        built = True
+    finally:
+        # Cleanup raw files and their resume state, unless a retry can resume them
+        for raw in raw_temp_files:
+            if raw in resumable and not built:
+                continue
+            for path in (raw, raw + ".state"):
+                try: os.unlink(path)
+                except: pass
+        for fd in claims:
+            release_staging(fd)
+
+def artifact_params(out_args: list, mode: str, quality: Optional[str], codec: Optional[str]):
+    """Encode settings that make up the artifact key (combined mode keeps its original keys)."""
+    params = " ".join(out_args)
+    if mode == "adaptive":
+        params += f" adaptive q={quality or 'best'} c={codec or 'any'}"
+    return params
+
+async def run_download_task(task_id: str, url: str, type_str: str, itag: Optional[str],
+                            mode: str = "combined", quality: Optional[str] = None, codec: Optional[str] = None,
+                            transcode: bool = True):
+    ext, out_args = output_spec(type_str)
+    if type_str == "audio":
+        # Audio-only stream instead of the whole video (muxing only matters for video)
+        mode = "audio"
+    build_args = dict(mode=mode, quality=quality, codec=codec)
+    video_id = downloader.reverse_engine._extract_video_id(url)
+    metrics.task_started()
+    outcome = "error"
+    with metrics.span("download_task", type=type_str, mode=mode):
+        try:
+            if type_str == "audio" and not transcode:
+                # Keep the source codec: the container follows whichever stream gets picked
+                build_args["codec"] = codec = codec or "aac"
+                info = await downloader.get_media_info(url, itag=itag, mode=mode, codec=codec)
+                if not info:
+                    raise Exception("Could not retrieve a playable URL.")
+                ext, out_args = audio_copy_spec(info.get("acodec"))
+                build_args["info"] = info
+
+            if not video_id:
+                # Not cacheable: build straight into a per-task temp file
+                final_file = os.path.join(tempfile.gettempdir(), f"{task_id}.{ext}")
+                await build_media(task_id, url, itag, out_args, final_file, **build_args)
+                await tasks.update(task_id, status="completed", progress=100, file=final_file)
+                outcome = "completed"
+                return
+
+            key = artifacts.key(video_id, itag, type_str, artifact_params(out_args, mode, quality, codec))
+            cached = artifacts.lookup(key, ext)
+            hit = bool(cached)
+            if not cached:
+                await tasks.update(task_id, status="queued")
+                # One build per artifact; concurrent requests wait here and reuse the result
+                async with artifacts.building(key):
+                    cached = artifacts.lookup(key, ext, count=False)
+                    if not cached:
+                        staging = artifacts.staging_path(key, ext)
+                        try:
+                            await build_media(task_id, url, itag, out_args, staging, **build_args)
+                            cached = artifacts.publish(staging, key, ext)
+                        finally:
+                            try: os.unlink(staging)
+                            except: pass
+            else:
+                print(f"[Artifacts] Hit: {video_id} ({type_str})")
+
+            await tasks.update(task_id, status="completed", progress=100, file=cached, cached=True)
+            outcome = "cached" if hit else "completed"
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"[Task Error] {e}")
+            await tasks.update(task_id, status="error", error=str(e))
+        finally:
+            metrics.task_finished(outcome)
+            # Download tasks outlive the request that started them: log the finished trace
+            metrics.report_trace()
 
 @app.get("/start-download")
-async def start_download(url: str, type: str = "video", itag: Optional[str] = None):
+async def start_download(
+    request: Request, url: str, type: str = "video", itag: Optional[str] = None,
+    mode: str = Query("combined", pattern="^(combined|adaptive)$"),
+    quality: Optional[str] = None, codec: Optional[str] = None,
+    transcode: bool = True
+):
+    """
+    type=audio fetches only an audio stream; transcode=false keeps its codec
+    (m4a for AAC, ogg for Opus, `codec` picks which) instead of encoding MP3.
+    """
+    admission.admit(request, "download")
     task_id = str(uuid.uuid4())
-    download_tasks[task_id] = {
-        "status": "starting", 
-        "progress": 0, 
-        "file": None, 
-        "error": None
-    }
-    asyncio.create_task(run_download_task(task_id, url, type, itag))
+    await tasks.create(task_id)
+    asyncio.create_task(run_download_task(task_id, url, type, itag, mode, quality, codec, transcode))
     return {"task_id": task_id}
 
 @app.get("/task-status/{task_id}")
 async def task_status(task_id: str):
     try:
-        task = download_tasks.get(task_id)
+        task = await tasks.get(task_id)
         if not task:
             return JSONResponse(status_code=404, content={"status": "error", "error": "Task not found"})
         return task
@@ -129,9 +447,27 @@ async def task_status(task_id: str):
         print(f"[Status Error] {e}")
         return JSONResponse(status_code=500, content={"status": "error", "error": str(e)})
 
-@app.get("/download-file/{task_id}")
-async def fetch_download_file(task_id: str, filename: str = "video.mp4"):
-    task = download_tasks.get(task_id)
+@app.get("/events")
+async def task_events(ids: str = Query(..., description="Comma-separated task ids")):
+    """
+    Server-Sent Events for one or many download tasks, instead of polling /task-status.
+    Sends `status`, `progress`, `completed` and `error` events (data: the task-status
+    record plus task_id) and ends once every task is finished.
+    """
+    task_ids = list(dict.fromkeys(t.strip() for t in ids.split(",") if t.strip()))
+    if not task_ids:
+        raise HTTPException(status_code=400, detail="No task ids given")
+    if len(task_ids) > events.MAX_TASKS:
+        raise HTTPException(status_code=413, detail=f"At most {events.MAX_TASKS} task ids per stream")
+    return StreamingResponse(
+        events.stream(task_ids), media_type="text/event-stream",
+        # No proxy buffering: events must arrive as they happen
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Access-Control-Allow-Origin": "*"}
+    )
+
+@app.api_route("/download-file/{task_id}", methods=["GET", "HEAD"])
+async def fetch_download_file(request: Request, task_id: str, filename: str = "video.mp4"):
+    task = await tasks.get(task_id)
     if not task or task["status"] != "completed" or not task["file"]:
         raise HTTPException(status_code=404, detail="File not ready or expired")
         
@@ -139,78 +475,122 @@ async def fetch_download_file(task_id: str, filename: str = "video.mp4"):
     if not os.path.exists(path):
         raise HTTPException(status_code=404, detail="File vanished from server")
     
-    media_type = "video/mp4"
-    if filename.endswith(".mp3"): media_type = "audio/mpeg"
+    media_type = media_type_for(filename)
     
-    return FileResponse(path, media_type=media_type, filename=filename)
+    # Range/206 aware (resume + seeking); HEAD lets download managers size the file first
+    return RangeFileResponse(path, media_type, filename=filename, range_header=request.headers.get("range"))
 
 @app.get("/status")
 async def get_status():
-    return {"status": "online"}
+    return {
+        "status": "online",
+        "cache": downloader.cache.stats(),
+        "coalescing": downloader.inflight.stats(),
+        "prewarm": downloader.prewarmer.stats(),
+        "engines": downloader.reverse_engine.scheduler.snapshot(),
+        "executors": executors.stats(),
+        "ffmpeg": ffmpeg_scheduler.stats(),
+        "streams": stream_pipeline.stats(),
+        "artifacts": artifacts.stats(),
+        "admission": admission.stats(),
+        "events": events.stats()
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus scrape endpoint (all workers on this host, summed)."""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """Spans of a recent traced request (kept in the worker that served it)."""
+    trace = metrics.get_trace(trace_id)
+    if not trace:
+        raise HTTPException(status_code=404, detail="Trace not found (expired, or served by another worker)")
+    return trace
 
 @app.get("/stream")
-async def stream_video(url: str, filename: Optional[str] = "video.mp4"):
+async def stream_video(
+    request: Request, url: str, filename: Optional[str] = "video.mp4",
+    mode: str = Query("combined", pattern="^(combined|adaptive)$"),
+    quality: Optional[str] = None, codec: Optional[str] = None
+):
     """
     Real-time Streaming with On-The-Fly Conversion (MP4/MP3).
     Supports direct piping to avoid temp files.
+    mode=adaptive muxes the best video-only + audio-only streams (up to `quality`,
+    preferring `codec`) into fragmented MP4 on the fly.
+    Audio filenames (.mp3, or .m4a/.ogg for no re-encode) only fetch an audio stream.
     """
-    is_audio = filename.endswith(".mp3")
+    audio_ext = filename.rsplit(".", 1)[-1].lower()
+    if audio_ext == "opus": audio_ext = "ogg"
+    is_audio = audio_ext in ("mp3", *STREAM_AUDIO)
+    if is_audio:
+        mode = "audio"
+        if audio_ext in STREAM_AUDIO: codec = codec or STREAM_AUDIO[audio_ext][0]
     print(f"[*] Stream conversion requested: {'AUDIO' if is_audio else 'VIDEO'}")
+
+    # 0. Already built by a download task? Serve the finished file directly.
+    video_id = downloader.reverse_engine._extract_video_id(url)
+    if video_id and audio_ext not in STREAM_AUDIO:
+        type_str = "audio" if is_audio else "video"
+        ext, out_args = output_spec(type_str)
+        cached = artifacts.lookup(artifacts.key(video_id, None, type_str, artifact_params(out_args, mode, quality, codec)), ext)
+        if cached:
+            return RangeFileResponse(
+                cached, media_type_for(filename),
+                filename=filename, range_header=request.headers.get("range")
+            )
     
+    # Only live conversions need admitting: the cached file above is just a file read
+    admission.admit(request, "stream")
+
     # 1. Get the direct URL via reverse engine
-    info = await downloader.get_media_info(url)
-    if not info or not info.get("play"):
+    info = await downloader.get_media_info(url, mode=mode, quality=quality, codec=codec,
+                                           admit=lambda: admission.admit_race("stream"))
+    if not info:
         raise HTTPException(status_code=404, detail="Could not retrieve stream URL")
     
-    target_url = info["play"]
+    sources = media_sources(info)
     proxy = os.getenv("PROXY_URL")
 
-    async def stream_generator():
-        # Build FFmpeg command for on-the-fly streaming
-        if is_audio:
-            # Extract audio and convert to mp3
-            cmd = ["ffmpeg", "-i", "pipe:0", "-vn", "-ar", "44100", "-ac", "2", "-b:a", "192k", "-f", "mp3", "pipe:1"]
-        else:
-            # Remux to mp4 (faststart) for compatibility
-            cmd = ["ffmpeg", "-i", "pipe:0", "-c", "copy", "-movflags", "frag_keyframe+empty_moov+faststart", "-f", "mp4", "pipe:1"]
-
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.DEVNULL
-        )
+    # 2. FFmpeg output for on-the-fly conversion
+    if audio_ext in STREAM_AUDIO:
+        # Remux the audio as-is (re-encode only if the source codec doesn't fit the container)
+        want, muxer, encode = STREAM_AUDIO[audio_ext]
+        fits = codec_family(info.get("acodec") or "aac") == codec_family(want)
+        out_args = ["-vn", *(["-c:a", "copy"] if fits else encode), *muxer, "pipe:1"]
+    elif is_audio:
+        # Extract audio and convert to mp3
+        out_args = ["-vn", "-ar", "44100", "-ac", "2", "-b:a", "192k", "-f", "mp3", "pipe:1"]
+    elif len(sources) > 1:
+        # Adaptive: video + audio arrive on their own pipes and are stream-copied together
+        out_args = [*MUX_MAP, "-c", "copy", "-movflags", STREAM_MOVFLAGS, "-f", "mp4", "pipe:1"]
+    else:
+        # Remux to mp4 (faststart) for compatibility
+        out_args = ["-c", "copy", "-movflags", "frag_keyframe+empty_moov+faststart", "-f", "mp4", "pipe:1"]
 
-        async def writer():
+    # 3. Bounded upstream -> ffmpeg -> client pipeline on a live FFmpeg slot
+    pipeline = StreamPipeline(sources, out_args, proxy=proxy, headers={"User-Agent": USER_AGENT},
+                              refreshers=downloader.stream_refreshers(url, info))
+    try:
+        await pipeline.start()
+        # Fail fast: ffmpeg dying before its first chunk is a 502, not an empty 200
+        with metrics.span("ffmpeg_first_output"):
             try:
-                async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-                    async with session.get(target_url, headers={"User-Agent": USER_AGENT}, proxy=proxy) as resp:
-                        async for chunk in resp.content.iter_chunked(512 * 1024):
-                            process.stdin.write(chunk)
-                            await process.stdin.drain()
-                process.stdin.close()
-            except Exception as e:
-                print(f"[Stream Writer Error] {e}")
-                process.stdin.close()
-
-        # Start writer in background
-        writer_task = asyncio.create_task(writer())
-
-        try:
-            while True:
-                chunk = await process.stdout.read(1024 * 1024)
-                if not chunk: break
-                yield chunk
-        finally:
-            if process.returncode is None:
-                try: process.terminate()
-                except: pass
-            await writer_task
+                ready = await pipeline.ready()
+            except StreamIdle as e:
+                print(f"[Stream] Nothing came out of FFmpeg: {e}")
+                raise HTTPException(status_code=504, detail=f"Conversion stalled ({e})")
+        if not ready:
+            print(f"[Stream] FFmpeg failed before any output: {pipeline.error()}")
+            raise HTTPException(status_code=502, detail=f"Conversion failed (ffmpeg exit {pipeline.process.returncode})")
+    except BaseException:
+        await pipeline.close()
+        raise
 
-    media_type = "audio/mpeg" if is_audio else "video/mp4"
-    return StreamingResponse(
-        stream_generator(),
-        media_type=media_type,
+    return PipelineResponse(
+        pipeline, media_type_for(filename),
         headers={
             "Content-Disposition": f'attachment; filename="{filename}"',
             "Access-Control-Allow-Origin": "*",
@@ -219,23 +599,106 @@ async def stream_video(url: str, filename: Optional[str] = "video.mp4"):
     )
 
 @app.get("/info")
-async def get_info(url: str):
+async def get_info(
+    request: Request, url: str,
+    mode: str = Query("combined", pattern="^(combined|adaptive)$"),
+    quality: Optional[str] = None, codec: Optional[str] = None, itag: Optional[str] = None
+):
     """
     Analyzes a YouTube URL and returns metadata + download formats.
+    `formats` is the video's full indexed list (best-first per kind: combined, video,
+    audio) and `index` maps itag/height/codec/container to positions in it, so clients
+    can pick a stream and ask for it by itag without another lookup.
     """
     if not url:
         raise HTTPException(status_code=400, detail="URL is required")
-    
-    info = await downloader.get_media_info(url)
+    admission.admit(request, "info")
+
+    info = await downloader.get_media_info(url, itag=itag, mode=mode, quality=quality, codec=codec,
+                                           admit=lambda: admission.admit_race("info"))
     if not info:
         raise HTTPException(status_code=404, detail="Could not analyze video")
     
     return info
 
+# Batch lookups: items per request and lookups in flight per request
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+class BatchInfoRequest(BaseModel):
+    urls: List[str] = Field(..., min_length=1)
+    mode: str = Field("combined", pattern="^(combined|adaptive)$")
+    quality: Optional[str] = None
+    codec: Optional[str] = None
+    concurrency: Optional[int] = Field(None, ge=1)
+    expand_playlists: bool = True
+
+def ndjson(obj: dict):
+    return (json.dumps(obj, separators=(",", ":")) + "\n").encode()
+
+@app.post("/info/batch")
+async def get_info_batch(request: Request, body: BatchInfoRequest):
+    """
+    Resolves many videos (and playlist URLs, expanded to their videos) concurrently.
+    Streams NDJSON, one line per video as soon as it resolves (completion order, not
+    input order), then a final {"done": true, ...} summary line.
+    """
+    if len(body.urls) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} URLs per batch")
+    admission.admit(request, "batch", cost=len(body.urls))
+    concurrency = min(body.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY)
+
+    async def results():
+        started = time.perf_counter()
+        # (url, playlist it came from); playlists are listed concurrently with each other
+        items = []
+        playlists = [u for u in body.urls if body.expand_playlists and downloader.is_playlist(u)]
+        expanded = await asyncio.gather(
+            *(downloader.expand_playlist(u, BATCH_MAX_ITEMS, admit=lambda: admission.admit_race("batch"))
+              for u in playlists), return_exceptions=True
+        )
+        expanded = dict(zip(playlists, expanded))
+        for url in body.urls:
+            videos = expanded.get(url)
+            if videos is None:
+                items.append((url, None))
+            elif isinstance(videos, Exception):
+                error = videos.detail if isinstance(videos, HTTPException) else videos
+                yield ndjson({"playlist": url, "status": "error", "error": f"Could not expand playlist: {error}"})
+            else:
+                items.extend((video, url) for video in videos)
+        items = items[:BATCH_MAX_ITEMS]
+
+        ok = failed = 0
+        async for index, url, info in downloader.iter_media_info(
+            [u for u, _ in items], concurrency, mode=body.mode, quality=body.quality, codec=body.codec,
+            admit=lambda: admission.admit_race("batch")
+        ):
+            line = {"index": index, "url": url}
+            if items[index][1]:
+                line["playlist"] = items[index][1]
+            if isinstance(info, Exception) or not info:
+                failed += 1
+                error = info.detail if isinstance(info, HTTPException) else str(info) if info else "Could not analyze video"
+                line.update(status="error", error=error)
+            else:
+                ok += 1
+                line.update(status="ok", info=info)
+            yield ndjson(line)
+        yield ndjson({"done": True, "total": len(items), "ok": ok, "failed": failed,
+                      "elapsed": round(time.perf_counter() - started, 2)})
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
 @app.get("/proxy")
-async def proxy_media(url: str, filename: Optional[str] = "video.mp4"):
+async def proxy_media(request: Request, url: str, filename: Optional[str] = "video.mp4",
+                      video_id: Optional[str] = None, itag: Optional[str] = None):
     """
     High-performance Streaming Proxy with logging.
+    Forwards the client's Range header upstream and answers 200/206/416 accordingly
+    (multi-range requests are served as multipart/byteranges).
+    A connection dropped mid-body is resumed from the last byte sent. With `video_id`
+    (and `itag`, else taken from the URL) an expired/403 URL is re-resolved too.
     """
     # Sanitize naming
     safe_filename = "".join([c for c in filename if c.isalnum() or c in "._- "]).strip()
@@ -243,41 +706,159 @@ async def proxy_media(url: str, filename: Optional[str] = "video.mp4"):
     
     print(f"[*] Proxy Process: {url[:60]}... -> {safe_filename}")
     
-    headers = {
-        "User-Agent": USER_AGENT,
-        "Accept": "*/*",
-        "Range": "bytes=0-",
+    media_type = media_type_for(safe_filename)
+    client_range = request.headers.get("range")
+    proxy = os.getenv("PROXY_URL")
+    response_headers = {
+        "Content-Disposition": f'attachment; filename="{safe_filename}"',
+        "Access-Control-Allow-Origin": "*",
+        "Accept-Ranges": "bytes"
     }
-    
-    async def stream_generator():
-        proxy = os.getenv("PROXY_URL")
-        # Use a single connector for efficiency
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-            try:
-                async with session.get(url, headers=headers, proxy=proxy, timeout=60) as resp:
-                    print(f"[Proxy] Response: {resp.status}")
-                    if resp.status == 403:
-                        print("[Proxy] 403 - Trying Direct fallback...")
-                        async with session.get(url, headers={"User-Agent": USER_AGENT}) as resp2:
-                            if resp2.status < 400:
-                                async for chunk in resp2.content.iter_chunked(1024 * 1024): yield chunk
-                        return
-
-                    if resp.status < 400:
-                        async for chunk in resp.content.iter_chunked(1024 * 1024): yield chunk
-            except Exception as e:
-                print(f"[Proxy Stream Error] {e}")
-
-    media_type = "audio/mpeg" if safe_filename.endswith(".mp3") else "video/mp4"
-    return StreamingResponse(
-        stream_generator(),
-        media_type=media_type,
-        headers={
-            "Content-Disposition": f'attachment; filename="{safe_filename}"',
-            "Access-Control-Allow-Origin": "*",
-            "Accept-Ranges": "bytes"
-        }
-    )
+
+    refresh = None
+    if video_id:
+        pinned = itag or (re.search(r"[?&]itag=(\d+)", url) or [None, None])[1]
+        refresh = downloader.url_refresher(f"https://www.youtube.com/watch?v={video_id}", url, pinned)
+    # Where the body comes from; the direct fallback sticks for resumes too
+    upstream = {"url": url, "proxy": proxy}
+
+    async def open_upstream(range_value):
+        headers = {"User-Agent": USER_AGENT, "Accept": "*/*", "Range": range_value}
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=60)
+        # Shared keep-alive pools (proxied and direct)
+        session = await HttpPool.for_proxy(upstream["proxy"])
+        resp = await session.get(upstream["url"], headers=headers, proxy=upstream["proxy"], timeout=timeout)
+        print(f"[Proxy] Response: {resp.status}")
+        if resp.status == 403 and upstream["proxy"]:
+            resp.release()
+            print("[Proxy] 403 - Trying Direct fallback...")
+            direct = await HttpPool.get(proxied=False)
+            resp = await direct.get(upstream["url"], headers=headers, timeout=timeout)
+            if resp.status < 400: upstream["proxy"] = None
+        if resp.status in (403, 410) and refresh:
+            resp.release()
+            upstream["url"] = await refresh(upstream["url"])
+            return await open_upstream(range_value)
+        return resp
+
+    async def relay(resp):
+        sent = 0
+        started = time.monotonic()
+        # Resume point for a dropped connection: the range this response covers
+        match = re.match(r"bytes (\d+)-(\d+)/", resp.headers.get("Content-Range", "")) if resp.status == 206 else None
+        start, end = (int(match.group(1)), int(match.group(2))) if match else (0, None)
+        body = iter_resumable(
+            upstream["url"], {"User-Agent": USER_AGENT, "Accept": "*/*"}, upstream["proxy"],
+            start=start, end=end, refresh=refresh, response=resp, chunk_size=1024 * 1024, path="proxy"
+        )
+        try:
+            async for chunk in body:
+                sent += len(chunk)
+                yield chunk
+        except Exception as e:
+            print(f"[Proxy Stream Error] {e}")
+        finally:
+            await body.aclose()
+            metrics.DOWNLOAD_BYTES.inc(sent, path="proxy")
+            if sent: metrics.DOWNLOAD_THROUGHPUT.observe(sent / max(time.monotonic() - started, 1e-3), path="proxy")
+
+    specs = client_range.split("=", 1)[1].split(",") if client_range and "=" in client_range else []
+    if len(specs) > 1:
+        multi = await proxy_multirange(open_upstream, client_range, media_type, response_headers)
+        if multi:
+            return multi
+        # Malformed or too many ranges: RFC 9110 says ignore the header and send it all
+        client_range = None
+
+    try:
+        resp = await open_upstream(client_range or "bytes=0-")
+    except Exception as e:
+        print(f"[Proxy Stream Error] {e}")
+        raise HTTPException(status_code=502, detail="Upstream unreachable")
+
+    if resp.status == 416:
+        resp.release()
+        headers = dict(response_headers, **{"Content-Range": resp.headers.get("Content-Range", "bytes */*")})
+        return Response(status_code=416, headers=headers)
+    if resp.status >= 400:
+        resp.release()
+        raise HTTPException(status_code=502, detail=f"Upstream error: {resp.status}")
+
+    headers = dict(response_headers)
+    status = 200
+    length = resp.headers.get("Content-Length")
+    if resp.status == 206 and client_range:
+        # Client asked for a range and got it: pass the partial response through
+        status = 206
+        headers["Content-Range"] = resp.headers.get("Content-Range", "")
+    elif resp.status == 206:
+        # Our own 'bytes=0-': the full entity, sized by Content-Range
+        total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+        length = total if total.isdigit() else None
+    if length:
+        headers["Content-Length"] = length
+
+    return StreamingResponse(relay(resp), status_code=status, media_type=media_type, headers=headers)
+
+async def proxy_multirange(open_upstream, client_range, media_type, response_headers):
+    """
+    multipart/byteranges built from one upstream request per range; None when the
+    Range header is to be ignored (the caller then sends the whole body with a 200).
+    """
+    try:
+        probe = await open_upstream("bytes=0-0")
+    except Exception as e:
+        print(f"[Proxy Multirange Error] {e}")
+        raise HTTPException(status_code=502, detail="Upstream unreachable")
+    total = probe.headers.get("Content-Range", "").rpartition("/")[2]
+    probe.release()
+    if probe.status != 206 or not total.isdigit():
+        raise HTTPException(status_code=502, detail="Upstream does not support ranges")
+    size = int(total)
+    try:
+        ranges = parse_ranges(client_range, size)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers=dict(response_headers, **{"Content-Range": f"bytes */{size}"}))
+    if not ranges:
+        return None
+
+    boundary, parts, trailer, length = multipart_layout(ranges, size, media_type)
+
+    async def open_part(start, end):
+        resp = await open_upstream(f"bytes={start}-{end}")
+        if resp.status != 206:
+            resp.release()
+            raise Exception(f"Upstream error: {resp.status} for bytes {start}-{end}")
+        return resp
+
+    # The first part is opened before any header goes out, so a refusing upstream is still a 502
+    try:
+        first = await open_part(*parts[0][1:])
+    except Exception as e:
+        print(f"[Proxy Multirange Error] {e}")
+        raise HTTPException(status_code=502, detail="Upstream error")
+
+    async def body():
+        resp = first
+        try:
+            for i, (head, start, end) in enumerate(parts):
+                yield head
+                resp = resp or await open_part(start, end)
+                try:
+                    async for chunk in resp.content.iter_chunked(1024 * 1024): yield chunk
+                finally:
+                    resp.release()
+                    resp = None
+        except Exception as e:
+            # Headers are out: all that's left is cutting the response short
+            print(f"[Proxy Multirange Error] part {i + 1}/{len(parts)} aborted: {e}")
+            raise
+        finally:
+            if resp: resp.release()
+        yield trailer
+
+    headers = dict(response_headers, **{"Content-Length": str(length)})
+    return StreamingResponse(body(), status_code=206, media_type=f"multipart/byteranges; boundary={boundary}", headers=headers)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8088)
@@ -0,0 +1,151 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+class ArtifactCache:
+    """
+    Content-addressed store for finished MP4/MP3 files.
+    Key = (video id, itag, output type, encode params). Files are published with an
+    atomic rename, evicted least-recently-used once ARTIFACT_CACHE_MAX_GB is exceeded,
+    and built under a per-key file lock so concurrent requests (from any worker)
+    wait for a single build.
+    """
+    DIR = os.getenv("ARTIFACT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "yt-artifacts"))
+    MAX_BYTES = int(float(os.getenv("ARTIFACT_CACHE_MAX_GB", "5")) * 1024 ** 3)
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.dir = directory or self.DIR
+        self.max_bytes = max_bytes if max_bytes is not None else self.MAX_BYTES
+        os.makedirs(self.dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(video_id, itag, kind, params):
+        raw = f"{video_id}|{itag or 'best'}|{kind}|{params}"
+        return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+    def path(self, key, ext):
+        return os.path.join(self.dir, f"{key}.{ext}")
+
+    def staging_path(self, key, ext):
+        # Same directory as the final file so publish() is a same-filesystem rename
+        return os.path.join(self.dir, f"{key}.{uuid.uuid4().hex[:12]}.part.{ext}")
+
+    def lookup(self, key, ext, count=True):
+        """Path of a published artifact (and bumps its LRU position), or None."""
+        path = self.path(key, ext)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            if count: self.misses += 1
+            return None
+        if count: self.hits += 1
+        return path
+
+    def publish(self, staging, key, ext):
+        path = self.path(key, ext)
+        os.replace(staging, path)
+        self.evict()
+        return path
+
+    @asynccontextmanager
+    async def building(self, key, poll=0.25):
+        """
+        Exclusive build lock for one artifact, held across processes via flock.
+        The holder deletes the lock file on release, so they don't pile up one per key;
+        a waiter that then gets the lock on the deleted inode opens the path again.
+        """
+        path = os.path.join(self.dir, f"{key}.lock")
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        await asyncio.sleep(poll)
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+        try:
+            yield
+        finally:
+            try: os.unlink(path)
+            except FileNotFoundError: pass
+            os.close(fd)
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.dir):
+            if name.endswith(".lock") or ".part." in name:
+                continue
+            try:
+                st = os.stat(os.path.join(self.dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        if total <= self.max_bytes:
+            return
+        for _, size, name in sorted(entries):
+            try:
+                os.unlink(os.path.join(self.dir, name))
+                total -= size
+                print(f"[Artifacts] Evicted {name}")
+            except FileNotFoundError:
+                pass
+            if total <= self.max_bytes:
+                break
+
+    def cleanup_staging(self, max_age=3600):
+        """Removes stale half-built files and idle lock files left by crashed builders."""
+        now = time.time()
+        for name in os.listdir(self.dir):
+            if ".part." not in name and not name.endswith(".lock"):
+                continue
+            path = os.path.join(self.dir, name)
+            try:
+                if now - os.stat(path).st_mtime <= max_age:
+                    continue
+                if name.endswith(".lock"):
+                    self._unlink_idle_lock(path)
+                else:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _unlink_idle_lock(self, path):
+        # Only remove a lock nobody holds, otherwise a waiter would lock a different inode
+        fd = os.open(path, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.unlink(path)
+        except BlockingIOError:
+            pass
+        finally:
+            os.close(fd)
+
+    def stats(self):
+        files = [n for n in os.listdir(self.dir) if not n.endswith(".lock") and ".part." not in n]
+        size = 0
+        for name in files:
+            try: size += os.path.getsize(os.path.join(self.dir, name))
+            except FileNotFoundError: pass
+        return {"hits": self.hits, "misses": self.misses, "files": len(files), "bytes": size, "max_bytes": self.max_bytes}
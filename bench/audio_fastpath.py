@@ -0,0 +1,111 @@
+"""
+Audio fast path benchmark: bytes downloaded and FFmpeg CPU per MP3/M4A request.
+
+    python bench/audio_fastpath.py "https://www.youtube.com/watch?v=..."
+    python bench/audio_fastpath.py --combined video.mp4 --audio audio.m4a   # offline (files or URLs)
+
+Scenarios:
+  legacy       progressive video+audio stream -> 192k MP3 (what type=audio used to do)
+  audio-mp3    audio-only stream -> 192k MP3
+  audio-remux  audio-only stream -> m4a/ogg, no re-encode (transcode=false)
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import AUDIO_ARGS, audio_copy_spec, downloader
+from ffmpeg_runner import run_ffmpeg
+from http_pool import HttpPool
+from segmented_download import SegmentedDownloader
+from youtube_downloader import USER_AGENT
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def fetch(src, workdir, name):
+    """Local path as-is, URLs through the same segmented downloader the app uses. Returns (path, bytes)."""
+    if os.path.exists(src):
+        return src, os.path.getsize(src)
+    path = os.path.join(workdir, name)
+    size = await SegmentedDownloader(src, path, headers={"User-Agent": USER_AGENT}, proxy=os.getenv("PROXY_URL")).run()
+    return path, size
+
+
+async def scenario(name, src, out_ext, out_args, workdir):
+    started = time.perf_counter()
+    path, size = await fetch(src, workdir, f"{name}.src")
+    downloaded = time.perf_counter()
+    cpu = children_cpu()
+    out = os.path.join(workdir, f"{name}.{out_ext}")
+    await run_ffmpeg(["-i", path], [*out_args, out])
+    return {
+        "scenario": name,
+        "bytes_in": size,
+        "bytes_out": os.path.getsize(out),
+        "download_s": round(downloaded - started, 2),
+        "ffmpeg_cpu_s": round(children_cpu() - cpu, 2),
+        "ffmpeg_wall_s": round(time.perf_counter() - downloaded, 2),
+    }
+
+
+async def resolve(url):
+    combined = await downloader.get_media_info(url)
+    audio = await downloader.get_media_info(url, mode="audio", codec="aac")
+    if not combined or not combined.get("play"):
+        raise SystemExit("No progressive stream to compare against")
+    if not audio or audio.get("mode") != "audio":
+        raise SystemExit("No audio-only stream found")
+    return combined["play"], audio["audio_url"], audio.get("acodec")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("url", nargs="?")
+    parser.add_argument("--combined", help="progressive (video+audio) file or URL")
+    parser.add_argument("--audio", help="audio-only file or URL")
+    parser.add_argument("--acodec", help="codec of --audio (default: mp4a)", default="mp4a")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    try:
+        if args.url:
+            combined, audio, acodec = await resolve(args.url)
+        elif args.combined and args.audio:
+            combined, audio, acodec = args.combined, args.audio, args.acodec
+        else:
+            parser.error("give a YouTube URL, or --combined and --audio")
+
+        remux_ext, remux_args = audio_copy_spec(acodec)
+        with tempfile.TemporaryDirectory() as workdir:
+            results = [
+                await scenario("legacy", combined, "mp3", AUDIO_ARGS, workdir),
+                await scenario("audio-mp3", audio, "mp3", AUDIO_ARGS, workdir),
+                await scenario("audio-remux", audio, remux_ext, remux_args, workdir),
+            ]
+    finally:
+        await HttpPool.close()
+
+    base = results[0]
+    print(f"{'scenario':<12} {'bytes in':>12} {'saved':>7} {'ffmpeg cpu':>11} {'saved':>7} {'download':>9}")
+    for r in results:
+        r["bytes_saved_pct"] = round(100 * (1 - r["bytes_in"] / base["bytes_in"]), 1) if base["bytes_in"] else 0.0
+        r["cpu_saved_pct"] = round(100 * (1 - r["ffmpeg_cpu_s"] / base["ffmpeg_cpu_s"]), 1) if base["ffmpeg_cpu_s"] else 0.0
+        print(f"{r['scenario']:<12} {r['bytes_in']:>12,} {r['bytes_saved_pct']:>6}% {r['ffmpeg_cpu_s']:>10}s {r['cpu_saved_pct']:>6}% {r['download_s']:>8}s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,384 @@
+"""
+Load test against the local fake-YouTube stubs (bench/stubs.py): no network needed.
+
+    python bench/load.py                                   # all scenarios, defaults
+    python bench/load.py --scenarios info,stream -n 500 -c 50 --videos 20 --json run.json
+    python bench/load.py --fail piped=0.5 --latency media=80 --rate-kbps 2048
+    python bench/load.py --json new.json --baseline old.json   # compare two commits
+
+Starts the stubs and the app (uvicorn, or gunicorn with --workers > 1) with its engines
+pointed at the stubs, then drives each scenario at the given concurrency:
+  info      GET /info
+  download  GET /start-download, poll /task-status, fetch /download-file
+  stream    GET /stream (whole body)
+  proxy     GET /proxy of the resolved stream URL (whole body)
+Reports throughput, p50/p95/p99 latency (and time to first byte), and the app's RSS
+and open fds (summed over its worker processes).
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import stubs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("info", "download", "stream", "proxy")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, max(0, int(round(q * len(values))) - 1))]
+    return {
+        "p50": round(pick(0.50) * 1000, 1), "p95": round(pick(0.95) * 1000, 1), "p99": round(pick(0.99) * 1000, 1),
+        "max": round(values[-1] * 1000, 1), "mean": round(sum(values) / len(values) * 1000, 1),
+    }
+
+
+# --- process metrics (Linux /proc) -------------------------------------------------
+
+def process_tree(pid):
+    """pid plus all its descendants (gunicorn master + workers, ffmpeg children)."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def rss_and_fds(pid):
+    rss = fds = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                rss += next((int(line.split()[1]) for line in f if line.startswith("VmRSS:")), 0) * 1024
+            fds += len(os.listdir(f"/proc/{p}/fd"))
+        except OSError:
+            continue
+    return rss, fds
+
+
+class Sampler:
+    """Polls the app's RSS/fd count while a scenario runs."""
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.task = None
+
+    async def _run(self):
+        while True:
+            self.samples.append(rss_and_fds(self.pid))
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        if self.pid:
+            self.task = asyncio.ensure_future(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        if self.task:
+            self.task.cancel()
+            self.samples.append(rss_and_fds(self.pid))
+
+    def summary(self):
+        if not self.samples:
+            return {}
+        rss = [s[0] for s in self.samples]
+        fds = [s[1] for s in self.samples]
+        mb = lambda b: round(b / 1024 / 1024, 1)
+        return {
+            "rss_mb": {"start": mb(rss[0]), "peak": mb(max(rss)), "end": mb(rss[-1])},
+            "fds": {"start": fds[0], "peak": max(fds), "end": fds[-1]},
+        }
+
+
+# --- scenarios ----------------------------------------------------------------------
+
+def video_url(scenario, n):
+    # 11-character ids, one namespace per scenario so caches don't leak between them
+    return f"https://www.youtube.com/watch?v={scenario[0]}{n:010d}"
+
+
+async def read_body(resp, timing):
+    size = 0
+    async for chunk in resp.content.iter_chunked(64 * 1024):
+        if "ttfb" not in timing:
+            timing["ttfb"] = time.perf_counter() - timing["start"]
+        size += len(chunk)
+    return size
+
+
+async def run_info(session, base, url, timing):
+    async with session.get(f"{base}/info", params={"url": url}) as resp:
+        await resp.read()
+        return resp.status == 200, 0
+
+
+async def run_download(session, base, url, timing):
+    async with session.get(f"{base}/start-download", params={"url": url, "type": "video"}) as resp:
+        if resp.status != 200:
+            return False, 0
+        task_id = (await resp.json())["task_id"]
+    while True:
+        async with session.get(f"{base}/task-status/{task_id}") as resp:
+            status = (await resp.json()).get("status")
+        if status == "completed":
+            break
+        if status in ("error", None):
+            return False, 0
+        await asyncio.sleep(0.1)
+    async with session.get(f"{base}/download-file/{task_id}") as resp:
+        size = await read_body(resp, timing)
+        return resp.status == 200, size
+
+
+async def run_stream(session, base, url, timing):
+    async with session.get(f"{base}/stream", params={"url": url, "filename": "bench.mp4"}) as resp:
+        size = await read_body(resp, timing)
+        return resp.status == 200 and size > 0, size
+
+
+async def run_proxy(session, base, url, timing):
+    async with session.get(f"{base}/proxy", params={"url": url, "filename": "bench.mp4"}) as resp:
+        size = await read_body(resp, timing)
+        return resp.status == 200 and size > 0, size
+
+
+RUNNERS = {"info": run_info, "download": run_download, "stream": run_stream, "proxy": run_proxy}
+
+
+async def proxy_targets(session, base, count):
+    """/proxy needs googlevideo-style URLs: resolve them up front, outside the timing."""
+    urls = []
+    for n in range(count):
+        async with session.get(f"{base}/info", params={"url": video_url("proxy", n)}) as resp:
+            info = await resp.json() if resp.status == 200 else {}
+        if info.get("play"):
+            urls.append(info["play"])
+    if not urls:
+        raise SystemExit("[Bench] Could not resolve any stream URL for the proxy scenario")
+    return urls
+
+
+async def scenario(name, base, requests, concurrency, videos, pid, timeout):
+    session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout))
+    try:
+        targets = await proxy_targets(session, base, videos) if name == "proxy" else [video_url(name, n) for n in range(videos)]
+        runner = RUNNERS[name]
+        latencies, ttfbs, errors = [], [], {}
+        total_bytes = 0
+        queue = asyncio.Queue()
+        for n in range(requests):
+            queue.put_nowait(targets[n % len(targets)])
+
+        async def worker():
+            nonlocal total_bytes
+            while not queue.empty():
+                url = queue.get_nowait()
+                timing = {"start": time.perf_counter()}
+                try:
+                    ok, size = await runner(session, base, url, timing)
+                except Exception as e:
+                    ok, size = False, 0
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                else:
+                    if not ok:
+                        errors["bad_status"] = errors.get("bad_status", 0) + 1
+                if ok:
+                    latencies.append(time.perf_counter() - timing["start"])
+                    total_bytes += size
+                    if "ttfb" in timing:
+                        ttfbs.append(timing["ttfb"])
+
+        with Sampler(pid) as sampler:
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+    finally:
+        await session.close()
+
+    result = {
+        "scenario": name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "ok": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "mb_per_s": round(total_bytes / elapsed / 1024 / 1024, 1) if elapsed else 0.0,
+        "latency_ms": percentiles(latencies),
+    }
+    if ttfbs:
+        result["ttfb_ms"] = percentiles(ttfbs)
+    result.update(sampler.summary())
+    return result
+
+
+# --- app process --------------------------------------------------------------------
+
+def start_app(port, workers, stub_base, workdir):
+    env = dict(os.environ)
+    env.update(stubs.app_env(stub_base))
+    env.setdefault("TASK_STORE_PATH", os.path.join(workdir, "tasks.db"))
+    env.setdefault("ARTIFACT_CACHE_DIR", os.path.join(workdir, "artifacts"))
+    env.setdefault("FFMPEG_SLOT_DIR", os.path.join(workdir, "ffmpeg-slots"))
+    if workers > 1:
+        env.update(WEB_CONCURRENCY=str(workers), BIND=f"127.0.0.1:{port}")
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app", "--log-level", "warning"]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    log = open(os.path.join(workdir, "app.log"), "wb")
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(base, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                raise SystemExit(f"[Bench] App exited with {process.returncode} during startup")
+            try:
+                async with session.get(f"{base}/ready", timeout=aiohttp.ClientTimeout(total=2)) as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise SystemExit(f"[Bench] App not ready after {timeout}s")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# --- reporting ----------------------------------------------------------------------
+
+def print_table(results):
+    print(f"{'scenario':<9} {'ok':>6} {'err':>5} {'req/s':>8} {'MB/s':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'rss peak':>9} {'fds peak':>9}")
+    for r in results:
+        lat = r["latency_ms"] or {}
+        print(f"{r['scenario']:<9} {r['ok']:>6} {sum(r['errors'].values()):>5} {r['throughput_rps']:>8} {r['mb_per_s']:>7} "
+              f"{lat.get('p50', '-'):>8} {lat.get('p95', '-'):>8} {lat.get('p99', '-'):>8} "
+              f"{r.get('rss_mb', {}).get('peak', '-'):>9} {r.get('fds', {}).get('peak', '-'):>9}")
+
+
+def print_comparison(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    old = {r["scenario"]: r for r in baseline["results"]}
+    print(f"\nvs {baseline_path} (commit {baseline.get('commit')}), change in %:")
+    print(f"{'scenario':<9} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'rss peak':>9}")
+    delta = lambda new, prev: f"{100 * (new - prev) / prev:+.1f}" if new is not None and prev else "-"
+    for r in results:
+        prev = old.get(r["scenario"])
+        if not prev:
+            continue
+        lat, prev_lat = r["latency_ms"] or {}, prev["latency_ms"] or {}
+        print(f"{r['scenario']:<9} {delta(r['throughput_rps'], prev['throughput_rps']):>8} "
+              f"{delta(lat.get('p50'), prev_lat.get('p50')):>8} {delta(lat.get('p95'), prev_lat.get('p95')):>8} "
+              f"{delta(lat.get('p99'), prev_lat.get('p99')):>8} "
+              f"{delta(r.get('rss_mb', {}).get('peak'), prev.get('rss_mb', {}).get('peak')):>9}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma-separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("-n", "--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("-c", "--concurrency", type=int, default=20)
+    parser.add_argument("--videos", type=int, default=50, help="distinct video ids per scenario (fewer = more cache hits)")
+    parser.add_argument("--workers", type=int, default=1, help="app workers (>1 runs gunicorn)")
+    parser.add_argument("--timeout", type=float, default=120, help="per-request timeout, seconds")
+    parser.add_argument("--target", help="benchmark an already running app instead (its engines must point at the stubs)")
+    parser.add_argument("--pid", type=int, help="with --target: app pid for RSS/fd sampling")
+    parser.add_argument("--stub-port", type=int, default=0)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="earlier --json output to compare against")
+    stubs.add_stub_args(parser)
+    args = parser.parse_args()
+
+    names = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in names if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        config = stubs.config_from_args(args, workdir)
+        stub_port = args.stub_port or free_port()
+        stub_runner = await stubs.start(config, port=stub_port)
+        stub_base = f"http://127.0.0.1:{stub_port}"
+        process = None
+        try:
+            if args.target:
+                base, pid = args.target.rstrip("/"), args.pid
+            else:
+                port = free_port()
+                process = start_app(port, args.workers, stub_base, workdir)
+                base, pid = f"http://127.0.0.1:{port}", process.pid
+            await wait_ready(base, process)
+            print(f"[Bench] App at {base}, stubs at {stub_base}")
+
+            results = []
+            for name in names:
+                print(f"[Bench] {name}: {args.requests} requests, concurrency {args.concurrency}")
+                results.append(await scenario(name, base, args.requests, args.concurrency, args.videos, pid, args.timeout))
+        finally:
+            if process is not None:
+                process.terminate()
+                try: process.wait(timeout=15)
+                except subprocess.TimeoutExpired: process.kill()
+            await stub_runner.cleanup()
+
+    print()
+    print_table(results)
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "requests": args.requests, "concurrency": args.concurrency, "videos": args.videos,
+            "workers": args.workers, "rate_kbps": args.rate_kbps,
+            "latency": config.latency, "fail": config.fail,
+        },
+        "stubs": {"hits": config.hits, "bytes_sent": config.bytes_sent},
+        "results": results,
+    }
+    if args.baseline:
+        print_comparison(results, args.baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n[Bench] Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,134 @@
+"""
+Cold-start benchmark: how long until the app is alive and ready, and what its workers cost.
+
+    python bench/startup.py                          # 4 workers, default vs preload, 3 runs each
+    python bench/startup.py --workers 2 --modes preload --runs 5 --json startup.json
+
+For each mode it launches gunicorn (gunicorn.conf.py) on a free port and measures
+  import    `import app` in a fresh interpreter (what every non-preloaded worker pays)
+  alive     seconds until / answers
+  ready     seconds until /ready answers 200 on every worker (sampled repeatedly)
+  rss/pss   memory of master + workers once ready; PSS splits shared copy-on-write
+            pages between the processes sharing them, so preloading shows up there
+No network needed: warm-up only builds local pools and the yt-dlp extractor.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load import ROOT, free_port, process_tree
+
+MODES = {"default": {"GUNICORN_PRELOAD": "false"}, "preload": {"GUNICORN_PRELOAD": "true"}}
+
+
+def import_time():
+    code = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def memory(pid):
+    """(rss, pss) in bytes over the whole process tree."""
+    rss = pss = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Rss:"): rss += int(line.split()[1]) * 1024
+                    elif line.startswith("Pss:"): pss += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return rss, pss
+
+
+async def probe(session, url):
+    try:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=2)) as resp:
+            return resp.status
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+
+async def run(mode, workers, workdir, timeout):
+    port = free_port()
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), BIND=f"127.0.0.1:{port}", **MODES[mode])
+    env.setdefault("TASK_STORE_PATH", os.path.join(workdir, "tasks.db"))
+    env.setdefault("ARTIFACT_CACHE_DIR", os.path.join(workdir, "artifacts"))
+    env.setdefault("FFMPEG_SLOT_DIR", os.path.join(workdir, "ffmpeg-slots"))
+    env.setdefault("METRICS_DIR", os.path.join(workdir, "metrics"))
+    base = f"http://127.0.0.1:{port}"
+    log = open(os.path.join(workdir, f"{mode}.log"), "wb")
+    started = time.monotonic()
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app", "--log-level", "warning"],
+                               cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    alive = ready = None
+    streak = 0
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(force_close=True)) as session:
+            while time.monotonic() - started < timeout:
+                if process.poll() is not None:
+                    raise SystemExit(f"[Startup] gunicorn exited with {process.returncode}, see {log.name}")
+                if alive is None and await probe(session, f"{base}/") == 200:
+                    alive = time.monotonic() - started
+                if alive is not None:
+                    # Requests land on whichever worker accepts: many 200s in a row ~ all workers ready
+                    streak = streak + 1 if await probe(session, f"{base}/ready") == 200 else 0
+                    if streak >= workers * 4:
+                        ready = time.monotonic() - started
+                        break
+                await asyncio.sleep(0.05)
+        if ready is None:
+            raise SystemExit(f"[Startup] {mode}: not ready after {timeout}s")
+        await asyncio.sleep(0.5)
+        rss, pss = memory(process.pid)
+    finally:
+        process.terminate()
+        try: process.wait(15)
+        except subprocess.TimeoutExpired: process.kill()
+    return {"alive_s": round(alive, 2), "ready_s": round(ready, 2), "rss_mb": round(rss / 2**20, 1), "pss_mb": round(pss / 2**20, 1)}
+
+
+def summarize(runs):
+    keys = runs[0].keys()
+    return {k: round(sorted(r[k] for r in runs)[len(runs) // 2], 2) for k in keys}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--modes", default="default,preload", help=f"comma-separated, from {', '.join(MODES)}")
+    parser.add_argument("--runs", type=int, default=3, help="runs per mode (medians are reported)")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    unknown = [m for m in modes if m not in MODES]
+    if unknown:
+        parser.error(f"unknown mode(s): {', '.join(unknown)}")
+
+    results = {"workers": args.workers, "import_s": round(import_time(), 3), "modes": {}}
+    print(f"[Startup] import app: {results['import_s']}s")
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in modes:
+            runs = [await run(mode, args.workers, workdir, args.timeout) for _ in range(args.runs)]
+            results["modes"][mode] = summarize(runs)
+
+    print(f"\n{'mode':<9} {'alive s':>8} {'ready s':>8} {'rss MB':>8} {'pss MB':>8}   ({args.workers} workers, median of {args.runs})")
+    for mode, r in results["modes"].items():
+        print(f"{mode:<9} {r['alive_s']:>8} {r['ready_s']:>8} {r['rss_mb']:>8} {r['pss_mb']:>8}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\n[Startup] Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,244 @@
+"""
+Local fake-YouTube stand-in for benchmarks: one aiohttp server that plays the
+googlevideo media host and the cobalt / piped / invidious / savefrom / InnerTube APIs.
+
+    python bench/stubs.py --port 9100 --media-latency 20 --rate-kbps 4096 --fail piped=0.3
+
+Point the app at it with the environment from `app_env()` (printed on start).
+Every service takes a latency (ms, +/- 50% jitter) and a failure rate; failures are
+HTTP 503s, or for the media host a connection dropped mid-body.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from aiohttp import web
+
+SERVICES = ("media", "cobalt", "piped", "invidious", "savefrom", "innertube")
+
+
+class StubConfig:
+    def __init__(self, media, latency=None, fail=None, rate_kbps=0):
+        self.media = media
+        self.latency = {s: 0.0 for s in SERVICES}
+        self.latency.update(latency or {})
+        self.fail = {s: 0.0 for s in SERVICES}
+        self.fail.update(fail or {})
+        self.rate = rate_kbps * 1024        # bytes/s per media connection, 0 = unthrottled
+        self.hits = {s: 0 for s in SERVICES}
+        self.bytes_sent = 0
+
+
+def make_media(path, seconds=20):
+    """A small real MP4 (so ffmpeg paths work) if ffmpeg is around, otherwise random bytes."""
+    if shutil.which("ffmpeg"):
+        subprocess.run([
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc=size=640x360:rate=25:duration={seconds}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+            "-c:v", "libx264", "-preset", "ultrafast", "-b:v", "800k", "-c:a", "aac", "-b:a", "128k",
+            "-movflags", "faststart", path
+        ], check=True)
+    else:
+        with open(path, "wb") as f:
+            f.write(os.urandom(2 * 1024 * 1024))
+    return path
+
+
+def build_app(config):
+    with open(config.media, "rb") as f:
+        data = f.read()
+
+    async def service(name):
+        """Latency + failure injection shared by every route. True if the request should fail."""
+        config.hits[name] += 1
+        delay = config.latency[name] / 1000
+        if delay:
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        return random.random() < config.fail[name]
+
+    def media_url(request, video_id, itag, mime):
+        expire = int(time.time()) + 6 * 3600
+        return f"{request.scheme}://{request.host}/videoplayback?id={video_id}&itag={itag}&mime={mime}&expire={expire}"
+
+    def formats(request, video_id):
+        """(progressive, video-only, audio-only) in InnerTube shape, all served from the same file."""
+        size = str(len(data))
+        return [
+            {"itag": 18, "url": media_url(request, video_id, 18, "video/mp4"), "mimeType": 'video/mp4; codecs="avc1.42001E, mp4a.40.2"',
+             "width": 640, "height": 360, "fps": 25, "bitrate": 928000, "contentLength": size},
+            {"itag": 134, "url": media_url(request, video_id, 134, "video/mp4"), "mimeType": 'video/mp4; codecs="avc1.4d401e"',
+             "width": 640, "height": 360, "fps": 25, "bitrate": 800000, "contentLength": size},
+            {"itag": 140, "url": media_url(request, video_id, 140, "audio/mp4"), "mimeType": 'audio/mp4; codecs="mp4a.40.2"',
+             "bitrate": 128000, "contentLength": size},
+        ]
+
+    async def videoplayback(request):
+        fail = await service("media")
+        size = len(data)
+        start, end = 0, size - 1
+        status = 200
+        header = request.headers.get("Range", "")
+        if header.startswith("bytes="):
+            first, _, last = header[6:].split(",")[0].partition("-")
+            if first:
+                start, end = int(first), min(int(last) if last else size - 1, size - 1)
+            else:
+                start = max(0, size - int(last))
+            if start >= size:
+                return web.Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+            status = 206
+        headers = {"Content-Type": request.query.get("mime", "video/mp4"), "Accept-Ranges": "bytes",
+                   "Content-Length": str(end - start + 1)}
+        if status == 206:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        resp = web.StreamResponse(status=status, headers=headers)
+        await resp.prepare(request)
+        chunk = 64 * 1024
+        cut = start + (end - start) // 2 if fail else None
+        pos = start
+        while pos <= end:
+            piece = data[pos:min(pos + chunk, end + 1)]
+            if cut is not None and pos >= cut:
+                # Injected failure: drop the connection mid-body
+                request.transport.close()
+                return resp
+            await resp.write(piece)
+            config.bytes_sent += len(piece)
+            pos += len(piece)
+            if config.rate:
+                await asyncio.sleep(len(piece) / config.rate)
+        await resp.write_eof()
+        return resp
+
+    async def cobalt(request):
+        if await service("cobalt"): return web.Response(status=503)
+        body = await request.json()
+        video_id = body["url"].rsplit("=", 1)[-1]
+        return web.json_response({"status": "stream", "url": media_url(request, video_id, 18, "video/mp4"), "text": f"Stub {video_id}"})
+
+    async def savefrom(request):
+        if await service("savefrom"): return web.Response(status=503)
+        body = await request.json()
+        video_id = body["url"].rsplit("=", 1)[-1]
+        return web.json_response({"title": f"Stub {video_id}", "url": [{"url": media_url(request, video_id, 18, "video/mp4")}]})
+
+    async def piped(request):
+        if await service("piped"): return web.Response(status=503)
+        video_id = request.match_info["video_id"]
+        progressive, video, audio = formats(request, video_id)
+        return web.json_response({
+            "title": f"Stub {video_id}", "thumbnailUrl": None,
+            "videoStreams": [
+                {"itag": 18, "url": progressive["url"], "mimeType": "video/mp4", "codec": "avc1.42001E", "videoOnly": False, "width": 640, "height": 360, "fps": 25, "bitrate": 928000},
+                {"itag": 134, "url": video["url"], "mimeType": "video/mp4", "codec": "avc1.4d401e", "videoOnly": True, "width": 640, "height": 360, "fps": 25, "bitrate": 800000},
+            ],
+            "audioStreams": [{"itag": 140, "url": audio["url"], "mimeType": "audio/mp4", "codec": "mp4a.40.2", "bitrate": 128000}],
+        })
+
+    async def invidious(request):
+        if await service("invidious"): return web.Response(status=503)
+        video_id = request.match_info["video_id"]
+        progressive, video, audio = formats(request, video_id)
+        return web.json_response({
+            "title": f"Stub {video_id}", "videoThumbnails": [{"url": None}],
+            "formatStreams": [{"itag": "18", "url": progressive["url"], "type": progressive["mimeType"], "resolution": "360p", "size": "640x360"}],
+            "adaptiveFormats": [
+                {"itag": "134", "url": video["url"], "type": video["mimeType"], "resolution": "360p", "size": "640x360", "bitrate": "800000"},
+                {"itag": "140", "url": audio["url"], "type": audio["mimeType"], "bitrate": "128000"},
+            ],
+        })
+
+    async def innertube(request):
+        if await service("innertube"): return web.Response(status=503)
+        body = await request.json()
+        video_id = body["videoId"]
+        progressive, video, audio = formats(request, video_id)
+        return web.json_response({
+            "playabilityStatus": {"status": "OK"},
+            "streamingData": {"formats": [progressive], "adaptiveFormats": [video, audio]},
+            "videoDetails": {"videoId": video_id, "title": f"Stub {video_id}", "thumbnail": {"thumbnails": []}},
+        })
+
+    async def stats(request):
+        return web.json_response({"hits": config.hits, "bytes_sent": config.bytes_sent})
+
+    app = web.Application()
+    app.router.add_get("/videoplayback", videoplayback)
+    app.router.add_post("/cobalt/api/json", cobalt)
+    app.router.add_post("/savefrom/api/convert", savefrom)
+    app.router.add_get("/piped/streams/{video_id}", piped)
+    app.router.add_get("/invidious/api/v1/videos/{video_id}", invidious)
+    app.router.add_post("/youtubei/v1/player", innertube)
+    app.router.add_get("/_stats", stats)
+    return app
+
+
+def app_env(base):
+    """Environment that points the app's engines at the stub and leaves out yt-dlp/selenium."""
+    return {
+        "COBALT_INSTANCES": f"{base}/cobalt/api/json",
+        "PIPED_INSTANCES": f"{base}/piped",
+        "INVIDIOUS_INSTANCES": f"{base}/invidious",
+        "SAVEFROM_API": f"{base}/savefrom/api/convert",
+        "INNERTUBE_HOST": base,
+        "DISABLED_ENGINES": "ytdlp-proxy,ytdlp-direct,selenium",
+        "PROXY_URL": "",
+        # Every load-test client shares one IP; the global admission caps stay on
+        "RATE_LIMIT_PER_MIN": "0",
+    }
+
+
+async def start(config, host="127.0.0.1", port=9100):
+    runner = web.AppRunner(build_app(config))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def parse_pairs(values):
+    """['piped=0.3', 'media=0.1'] -> {'piped': 0.3, 'media': 0.1}"""
+    pairs = {}
+    for value in values or []:
+        name, _, number = value.partition("=")
+        if name not in SERVICES:
+            raise SystemExit(f"unknown service {name!r} (one of {', '.join(SERVICES)})")
+        pairs[name] = float(number)
+    return pairs
+
+
+def add_stub_args(parser):
+    parser.add_argument("--media", help="file served as every stream (default: generated test clip)")
+    parser.add_argument("--rate-kbps", type=int, default=0, help="per-connection media throttle (0 = none)")
+    parser.add_argument("--latency", action="append", metavar="SERVICE=MS", help="latency per service, repeatable")
+    parser.add_argument("--fail", action="append", metavar="SERVICE=RATE", help="failure rate 0..1 per service, repeatable")
+
+
+def config_from_args(args, workdir):
+    media = args.media or make_media(os.path.join(workdir, "stub.mp4"))
+    return StubConfig(media, latency=parse_pairs(args.latency), fail=parse_pairs(args.fail), rate_kbps=args.rate_kbps)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9100)
+    add_stub_args(parser)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        runner = await start(config_from_args(args, workdir), port=args.port)
+        print(f"[Stub] Listening on http://127.0.0.1:{args.port}")
+        for key, value in app_env(f"http://127.0.0.1:{args.port}").items():
+            print(f"{key}={value}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,30 @@
+import asyncio
+import threading
+
+
+async def run_cancellable(fn, *args, executor=None, start=None):
+    """
+    Runs a blocking `fn(*args, cancel_event=...)` in an executor.
+    If the awaiting coroutine is cancelled, the queued job is dropped before it starts,
+    or, if already running, `cancel_event` is set so the worker can bail out at its
+    next checkpoint instead of holding the thread until it finishes.
+    `start(job)` overrides how the job is submitted (returning an awaitable future).
+    """
+    cancel_event = threading.Event()
+    loop = asyncio.get_running_loop()
+    job = lambda: fn(*args, cancel_event=cancel_event)
+    future = start(job) if start else loop.run_in_executor(executor, job)
+    try:
+        return await future
+    except asyncio.CancelledError:
+        cancel_event.set()
+        raise
+
+
+async def cancel_all(tasks):
+    """Cancels pending tasks and waits for them to unwind (closing their HTTP responses)."""
+    tasks = [t for t in tasks if not t.done()]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
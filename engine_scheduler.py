@@ -0,0 +1,199 @@
+import os
+import time
+from collections import deque
+
+import metrics
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+class EngineSkipped(Exception):
+    """Raised by an engine that declined to run (e.g. its pool is full): no health verdict."""
+
+
+class EngineStats:
+    """Rolling success rate and latency percentiles for one engine or instance."""
+    WINDOW = int(os.getenv("SCHED_WINDOW", "50"))
+
+    def __init__(self):
+        self.outcomes = deque(maxlen=self.WINDOW)
+        self.latencies = deque(maxlen=self.WINDOW)
+        self.total = 0
+        self.failures = 0
+        self.cancelled = 0
+
+    def record(self, ok, latency):
+        self.total += 1
+        if not ok: self.failures += 1
+        self.outcomes.append(1 if ok else 0)
+        # Only successful calls describe how long a useful answer takes
+        if ok: self.latencies.append(latency)
+
+    @property
+    def success_rate(self):
+        # Laplace-smoothed so a new engine starts at 0.5 instead of 0 or 1
+        return (sum(self.outcomes) + 1) / (len(self.outcomes) + 2)
+
+    def percentile(self, pct):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[idx]
+
+    def snapshot(self):
+        p50, p95 = self.percentile(50), self.percentile(95)
+        return {
+            "calls": self.total,
+            "failures": self.failures,
+            "cancelled": self.cancelled,
+            "success_rate": round(self.success_rate, 3),
+            "p50": round(p50, 3) if p50 is not None else None,
+            "p95": round(p95, 3) if p95 is not None else None,
+        }
+
+
+class CircuitBreaker:
+    """
+    closed -> open after N consecutive failures.
+    open -> half_open once the cooldown passes; a single probe call is let through.
+    Probe success closes it, probe failure re-opens it with a doubled cooldown.
+    """
+    FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURES", "4"))
+    COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+    MAX_COOLDOWN = float(os.getenv("BREAKER_MAX_COOLDOWN", "600"))
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.cooldown = self.COOLDOWN
+        self.opened_at = 0.0
+        self.probing = False
+
+    def available(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= self.cooldown
+        return not self.probing
+
+    def on_launch(self):
+        if self.state == "open" and self.available():
+            self.state = "half_open"
+        if self.state == "half_open":
+            self.probing = True
+
+    def on_result(self, ok):
+        self.probing = False
+        if ok:
+            self.state = "closed"
+            self.failures = 0
+            self.cooldown = self.COOLDOWN
+            return
+        if self.state == "half_open":
+            self.cooldown = min(self.cooldown * 2, self.MAX_COOLDOWN)
+            self._open()
+            return
+        self.failures += 1
+        if self.failures >= self.FAILURE_THRESHOLD:
+            self._open()
+
+    def on_abandon(self):
+        # Call was cancelled before it could tell us anything
+        self.probing = False
+
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+
+
+class EngineScheduler:
+    """
+    Health-scored ordering for engines and their API instances.
+    Engines are launched best-first and hedged: the next one starts only when the
+    current leader has not answered within its typical (p50) latency.
+    """
+    HEDGE_DEFAULT = float(os.getenv("SCHED_HEDGE_DEFAULT", "1.5"))
+    HEDGE_MIN = float(os.getenv("SCHED_HEDGE_MIN", "0.3"))
+    HEDGE_MAX = float(os.getenv("SCHED_HEDGE_MAX", "4"))
+
+    def __init__(self):
+        self.stats = {}
+        self.breakers = {}
+
+    def _stats(self, name):
+        if name not in self.stats:
+            self.stats[name] = EngineStats()
+        return self.stats[name]
+
+    def _breaker(self, name):
+        if name not in self.breakers:
+            self.breakers[name] = CircuitBreaker()
+        return self.breakers[name]
+
+    def available(self, name):
+        return self._breaker(name).available()
+
+    def score(self, name):
+        stats = self._stats(name)
+        p50 = stats.percentile(50)
+        latency = p50 if p50 is not None else self.HEDGE_DEFAULT
+        return stats.success_rate / (latency + 0.5)
+
+    def ordered(self, names):
+        """Available names, best score first (stable for ties, so declaration order wins)."""
+        live = [n for n in names if self.available(n)]
+        return sorted(live, key=self.score, reverse=True)
+
+    def hedge_delay(self, name):
+        p50 = self._stats(name).percentile(50)
+        if p50 is None:
+            return self.HEDGE_DEFAULT
+        return max(self.HEDGE_MIN, min(self.HEDGE_MAX, p50))
+
+    async def run(self, name, coro_fn):
+        """
+        Runs one engine/instance call, recording latency and outcome.
+        A falsy result or an exception both count as a failure.
+        """
+        breaker = self._breaker(name)
+        breaker.on_launch()
+        engine, instance = metrics.split_engine(name)
+        started = time.monotonic()
+        error = None
+        with metrics.span(f"engine:{name}") as span:
+            try:
+                result = await coro_fn()
+            except EngineSkipped:
+                breaker.on_abandon()
+                span.set(outcome="skipped")
+                return None
+            except Exception as e:
+                result = None
+                error = e
+            except BaseException:
+                # Cancelled (lost the race): no verdict on the engine's health
+                self._stats(name).cancelled += 1
+                breaker.on_abandon()
+                span.set(outcome="cancelled")
+                metrics.ENGINE_LATENCY.observe(time.monotonic() - started, engine=engine, instance=instance, outcome="cancelled")
+                raise
+            ok = bool(result)
+            latency = time.monotonic() - started
+            self._stats(name).record(ok, latency)
+            breaker.on_result(ok)
+            outcome = "ok" if ok else "error"
+            span.set(outcome=outcome)
+            metrics.ENGINE_LATENCY.observe(latency, engine=engine, instance=instance, outcome=outcome)
+            if not ok:
+                reason = metrics.failure_reason(error)
+                span.set(reason=reason)
+                metrics.ENGINE_FAILURES.inc(engine=engine, instance=instance, reason=reason)
+            return result
+
+    def snapshot(self):
+        return {
+            name: dict(self._stats(name).snapshot(), state=self._breaker(name).state)
+            for name in sorted(set(self.stats) | set(self.breakers))
+        }
@@ -0,0 +1,158 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from cancellation import run_cancellable
+import metrics
+import ytdlp_worker
+import selenium_worker
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+class ExecutorSaturated(Exception):
+    """Raised instead of queueing when an executor's backlog is full."""
+
+
+class BoundedExecutor:
+    """
+    Dedicated pool with a cap on queued + running jobs.
+    Callers past the cap are rejected immediately (backpressure) instead of piling
+    up behind a burst of slow extractions.
+    """
+    def __init__(self, name, workers, queue_limit, kind="thread", initializer=None, on_shutdown=None):
+        self.name = name
+        self.workers = max(1, workers)
+        self.queue_limit = max(0, queue_limit)
+        self.kind = kind
+        self.initializer = initializer
+        self.on_shutdown = on_shutdown
+        self._executor = None
+        self.inflight = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                # spawn: workers only import the job module, not the running app + event loop
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=self.initializer
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+        return self._executor
+
+    async def submit(self, fn, *args):
+        """
+        Runs fn(*args) on the pool. In thread mode fn also receives `cancel_event`
+        (see cancellation.run_cancellable); process jobs can only be dropped while queued.
+        """
+        if self.inflight >= self.workers + self.queue_limit:
+            self.rejected += 1
+            raise ExecutorSaturated(f"{self.name} pool is full ({self.inflight} jobs)")
+        self.inflight += 1
+        jobs = []
+        try:
+            if self.kind == "process":
+                return await self._start(functools.partial(fn, *args), jobs)
+            return await run_cancellable(fn, *args, start=lambda job: self._start(job, jobs))
+        except asyncio.CancelledError:
+            if jobs: jobs[0].abandoned = True
+            raise
+        finally:
+            # Never submitted (pool shut down): no done callback will give the slot back
+            if not jobs: self.inflight -= 1
+
+    def _start(self, job, jobs):
+        """
+        Submits `job`. Its slot is given back when the pool is done with it, not when the
+        caller stops waiting: a cancelled thread job keeps running until its next
+        checkpoint (and a process job to the end), so it still counts against the cap.
+        """
+        loop = asyncio.get_running_loop()
+        future = self.executor.submit(job)
+        future.abandoned = False
+        jobs.append(future)
+
+        def done(f):
+            try: loop.call_soon_threadsafe(self._finished, f)
+            except RuntimeError: pass   # loop already closed (shutdown)
+        future.add_done_callback(done)
+        return asyncio.wrap_future(future, loop=loop)
+
+    def _finished(self, future):
+        self.inflight -= 1
+        if future.cancelled() or future.abandoned:
+            self.cancelled += 1
+        elif future.exception() is not None:
+            self.failed += 1
+        else:
+            self.completed += 1
+
+    async def warm(self, fn=None, count=1):
+        """Starts the workers (and runs `fn` on `count` of them at once) ahead of the first request."""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.executor, fn or (lambda: None)) for _ in range(max(1, count))))
+
+    def shutdown(self):
+        if self.on_shutdown:
+            try: self.on_shutdown()
+            except: pass
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "running": min(self.inflight, self.workers),
+            "queued": max(0, self.inflight - self.workers),
+            "queue_limit": self.queue_limit,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+        }
+
+
+ytdlp_pool = BoundedExecutor(
+    "ytdlp",
+    workers=int(os.getenv("YTDLP_WORKERS", "4")),
+    queue_limit=int(os.getenv("YTDLP_QUEUE", "16")),
+    kind=os.getenv("YTDLP_POOL", "thread").lower(),
+    initializer=ytdlp_worker.init_worker
+)
+
+selenium_pool = BoundedExecutor(
+    "selenium",
+    workers=int(os.getenv("SELENIUM_DRIVERS", "2")),
+    queue_limit=int(os.getenv("SELENIUM_QUEUE", "4")),
+    on_shutdown=selenium_worker.quit_all
+)
+
+
+def shutdown_all():
+    ytdlp_pool.shutdown()
+    selenium_pool.shutdown()
+
+
+def stats():
+    return {"ytdlp": ytdlp_pool.stats(), "selenium": selenium_pool.stats()}
+
+
+@metrics.collector
+def _collect():
+    for pool in (ytdlp_pool, selenium_pool):
+        pool_stats = pool.stats()
+        metrics.EXECUTOR_QUEUED.set(pool_stats["queued"], pool=pool.name)
+        metrics.EXECUTOR_RUNNING.set(pool_stats["running"], pool=pool.name)
@@ -0,0 +1,325 @@
+import asyncio
+import bisect
+import fcntl
+import itertools
+import os
+import re
+import tempfile
+import time
+from collections import deque
+
+from cancellation import cancel_all
+import metrics
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+DURATION_RE = re.compile(rb"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+# Tuning (CPU only, no hardware encoders): -threads per process, 0 = ffmpeg decides
+THREADS = int(os.getenv("FFMPEG_THREADS", "1"))
+# Encoder speed/quality presets by job priority: fast | balanced | quality ("" = encoder defaults)
+PRESET = {"live": os.getenv("FFMPEG_LIVE_PRESET", "fast"), "background": os.getenv("FFMPEG_PRESET", "")}
+
+ENCODER_PRESETS = {
+    # LAME: 0 = slowest/best psychoacoustics, 9 = fastest (bitrate unchanged)
+    "libmp3lame": {"fast": ["-compression_level", "7"], "balanced": ["-compression_level", "5"], "quality": ["-compression_level", "2"]},
+    "libopus": {"fast": ["-compression_level", "3"], "balanced": ["-compression_level", "7"], "quality": ["-compression_level", "10"]},
+    "libx264": {"fast": ["-preset", "veryfast"], "balanced": ["-preset", "medium"], "quality": ["-preset", "slow"]},
+}
+CODEC_FLAGS = ("-c", "-c:a", "-c:v", "-codec", "-codec:a", "-codec:v", "-acodec", "-vcodec")
+
+
+class FFmpegError(Exception):
+    pass
+
+
+def _encoders(output_args):
+    """Encoders an output will run (stream copies excluded); MP3 output implies LAME."""
+    found = [value for flag, value in zip(output_args, output_args[1:]) if flag in CODEC_FLAGS and value != "copy"]
+    explicit_audio = any(flag in ("-c", "-codec", "-c:a", "-codec:a", "-acodec") for flag in output_args)
+    if not explicit_audio and output_args and ("mp3" in output_args[-3:-1] or str(output_args[-1]).endswith(".mp3")):
+        found.append("libmp3lame")
+    return found
+
+
+def tuning_args(output_args, priority="background"):
+    """-threads plus the priority's preset flags for whichever encoders `output_args` uses."""
+    preset = PRESET.get(priority, "")
+    args = ["-threads", str(THREADS)] if THREADS else []
+    for encoder in _encoders(output_args) if preset else ():
+        args += ENCODER_PRESETS.get(encoder, {}).get(preset, [])
+    return args
+
+
+class FFmpegSlot:
+    """A held scheduler slot; release() is idempotent."""
+    def __init__(self, scheduler, fd):
+        self.scheduler = scheduler
+        self.fd = fd
+
+    def release(self):
+        if self.fd is None:
+            return
+        fd, self.fd = self.fd, None
+        try: fcntl.flock(fd, fcntl.LOCK_UN)
+        except OSError: pass
+        os.close(fd)
+        self.scheduler.running -= 1
+
+
+class FFmpegScheduler:
+    """
+    Host-wide CPU budget for ffmpeg processes.
+    At most LIMIT jobs (default: one per core) run at once across all gunicorn workers,
+    each holding one flock'd slot file. LIVE_RESERVE of those slots only go to live
+    /stream jobs, and inside a worker live jobs queue ahead of background download tasks.
+    Waiters get their queue position (within this worker) through on_queue.
+    """
+    LIMIT = int(os.getenv("FFMPEG_MAX_JOBS", "0")) or (os.cpu_count() or 1)
+    LIVE_RESERVE = int(os.getenv("FFMPEG_LIVE_RESERVE", "1"))
+    DIR = os.getenv("FFMPEG_SLOT_DIR", os.path.join(tempfile.gettempdir(), "yt-ffmpeg-slots"))
+    PRIORITIES = {"live": 0, "background": 1}
+    POLL = 0.1
+
+    def __init__(self, limit=None, live_reserve=None, directory=None):
+        self.limit = max(1, limit or self.LIMIT)
+        reserve = self.LIVE_RESERVE if live_reserve is None else live_reserve
+        self.background_limit = max(1, self.limit - reserve)
+        self.dir = directory or self.DIR
+        os.makedirs(self.dir, exist_ok=True)
+        self._waiters = []   # [priority, seq, reported position, on_queue], kept sorted
+        self._seq = itertools.count()
+        self.running = 0
+        self.started = 0
+        self.failed = 0
+        self.wait_total = 0.0
+
+    async def acquire(self, priority="background", on_queue=None):
+        """
+        Waits for a slot and returns it (call release() when the process is gone).
+        on_queue(position) fires whenever the queue position changes, and with 0
+        when a job that had to queue starts.
+        """
+        entry = [self.PRIORITIES.get(priority, 1), next(self._seq), None, on_queue]
+        bisect.insort(self._waiters, entry)
+        started = time.monotonic()
+        try:
+            while True:
+                # Only the head of the line claims, so priority and arrival order hold
+                if self._waiters[0] is entry:
+                    fd = self._try_claim(entry[0])
+                    if fd is not None:
+                        break
+                self._report_positions()
+                await asyncio.sleep(self.POLL)
+        finally:
+            self._waiters.remove(entry)
+            self._report_positions()
+
+        self.running += 1
+        self.started += 1
+        self.wait_total += time.monotonic() - started
+        if entry[2] and on_queue:
+            on_queue(0)
+        return FFmpegSlot(self, fd)
+
+    def _try_claim(self, priority):
+        slots = self.limit if priority == self.PRIORITIES["live"] else self.background_limit
+        for idx in range(slots):
+            fd = os.open(os.path.join(self.dir, f"slot-{idx}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def _report_positions(self):
+        for position, entry in enumerate(self._waiters, 1):
+            if entry[2] != position:
+                entry[2] = position
+                if entry[3]: entry[3](position)
+
+    def load(self):
+        """Jobs this worker has running or waiting for a slot, any priority."""
+        return self.running + len(self._waiters)
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "background_limit": self.background_limit,
+            "running": self.running,
+            "queued_live": sum(1 for e in self._waiters if e[0] == self.PRIORITIES["live"]),
+            "queued_background": sum(1 for e in self._waiters if e[0] != self.PRIORITIES["live"]),
+            "started": self.started,
+            "failed": self.failed,
+            "avg_wait": round(self.wait_total / self.started, 3) if self.started else 0.0,
+        }
+
+
+scheduler = FFmpegScheduler()
+
+
+@metrics.collector
+def _collect():
+    stats = scheduler.stats()
+    metrics.FFMPEG_RUNNING.set(stats["running"])
+    metrics.FFMPEG_QUEUED.set(stats["queued_live"], priority="live")
+    metrics.FFMPEG_QUEUED.set(stats["queued_background"], priority="background")
+
+
+class PipeInput:
+    """
+    Extra ffmpeg input fed through an inherited pipe ('-i pipe:N') instead of stdin,
+    so several network streams (e.g. adaptive video + audio) can be muxed without staging.
+    Spawn ffmpeg with pass_fds=[p.read_fd], call spawned(), then await pump().
+    """
+    def __init__(self, feed):
+        self.feed = feed
+        self.read_fd, self.write_fd = os.pipe()
+
+    @property
+    def arg(self):
+        return f"pipe:{self.read_fd}"
+
+    def spawned(self):
+        # ffmpeg holds its own copy now; ours would keep the pipe open after it exits
+        self._close("read_fd")
+
+    async def pump(self):
+        loop = asyncio.get_running_loop()
+        pipe = os.fdopen(self.write_fd, "wb", 0)
+        self.write_fd = None
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, pipe)
+        writer = asyncio.StreamWriter(transport, protocol, None, loop)
+        try:
+            async for chunk in self.feed:
+                writer.write(chunk)
+                await writer.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg exited early; its exit code says why
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self._close("read_fd")
+        self._close("write_fd")
+
+    def _close(self, name):
+        fd = getattr(self, name)
+        if fd is not None:
+            setattr(self, name, None)
+            try: os.close(fd)
+            except OSError: pass
+
+
+async def run_ffmpeg(input_args, output_args, feed=None, on_progress=None, pipes=(),
+                     priority="background", on_queue=None):
+    """
+    Runs one ffmpeg job under the scheduler and waits for it.
+    - input_args:  e.g. ["-i", path] or ["-i", "pipe:0"]
+    - feed:        async iterator of bytes written to stdin while ffmpeg runs (pipelined mode)
+    - pipes:       PipeInputs referenced in input_args (pumped alongside, closed afterwards)
+    - on_progress: callback(fraction 0..1) driven by ffmpeg's `-progress pipe:1` output
+      against the input duration ffmpeg reports on stderr
+    - priority / on_queue: scheduler class ('live' or 'background') and queue position callback;
+      the priority also picks the tuning (FFMPEG_THREADS, FFMPEG_LIVE_PRESET / FFMPEG_PRESET)
+    Raises FFmpegError with the tail of stderr as soon as ffmpeg exits non-zero.
+    """
+    queued = time.monotonic()
+    try:
+        with metrics.span("ffmpeg_queue", priority=priority):
+            slot = await scheduler.acquire(priority, on_queue)
+    except BaseException:
+        for p in pipes: p.close()
+        raise
+    started = time.monotonic()
+    metrics.FFMPEG_WAIT.observe(started - queued, priority=priority)
+    outcome = "error"
+    try:
+        with metrics.span("ffmpeg", priority=priority):
+            result = await _run(input_args, [*tuning_args(output_args, priority), *output_args], feed, on_progress, pipes)
+        outcome = "ok"
+        return result
+    finally:
+        slot.release()
+        metrics.FFMPEG_DURATION.observe(time.monotonic() - started, priority=priority, outcome=outcome)
+
+
+async def _run(input_args, output_args, feed, on_progress, pipes):
+    cmd = ["ffmpeg", "-y", "-nostats", "-progress", "pipe:1", *input_args, *output_args]
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if feed is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            pass_fds=[p.read_fd for p in pipes]
+        )
+    except BaseException:
+        for p in pipes: p.close()
+        raise
+    for p in pipes: p.spawned()
+    state = {"duration": None}
+    tail = deque(maxlen=15)
+
+    async def read_stderr():
+        async for line in process.stderr:
+            tail.append(line.decode(errors="replace").rstrip())
+            if state["duration"] is None:
+                match = DURATION_RE.search(line)
+                if match:
+                    h, m, sec = match.groups()
+                    state["duration"] = int(h) * 3600 + int(m) * 60 + float(sec)
+
+    async def read_progress():
+        async for line in process.stdout:
+            key, _, value = line.decode(errors="replace").strip().partition("=")
+            # out_time_ms is (despite the name) microseconds, same as out_time_us
+            if key in ("out_time_us", "out_time_ms") and on_progress and state["duration"]:
+                try:
+                    on_progress(min(1.0, int(value) / 1e6 / state["duration"]))
+                except ValueError:
+                    pass
+
+    async def write_stdin():
+        try:
+            async for chunk in feed:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg exited early; its exit code says why
+            pass
+        finally:
+            try: process.stdin.close()
+            except: pass
+
+    writers = [asyncio.ensure_future(p.pump()) for p in pipes]
+    if feed is not None:
+        writers.append(asyncio.ensure_future(write_stdin()))
+    try:
+        # stdout/stderr hit EOF when ffmpeg exits, whether or not the download is done
+        await asyncio.gather(read_stderr(), read_progress())
+        await process.wait()
+        # A download that failed midway closed ffmpeg's input early: that's the real error
+        for writer in writers:
+            if writer.done() and not writer.cancelled() and writer.exception() is not None:
+                raise writer.exception()
+    except BaseException:
+        if process.returncode is None:
+            try: process.kill()
+            except ProcessLookupError: pass
+            await process.wait()
+        raise
+    finally:
+        # Fail fast: nothing left to feed a finished (or failed) ffmpeg, stop downloading
+        await cancel_all(writers)
+        for p in pipes: p.close()
+
+    if process.returncode != 0:
+        scheduler.failed += 1
+        raise FFmpegError(f"ffmpeg exited with {process.returncode}: " + " | ".join(list(tail)[-3:]))
+    return state["duration"]
@@ -0,0 +1,225 @@
+import re
+
+
+# Normalized stream format, whatever engine produced it:
+# {"itag", "url", "ext", "vcodec", "acodec", "height", "width", "fps", "bitrate", "size"}
+# vcodec/acodec are None when the stream has no video/audio track.
+
+CODEC_FAMILIES = {
+    "h264": "avc1", "avc": "avc1", "avc1": "avc1",
+    "vp9": "vp9", "vp09": "vp9",
+    "av1": "av01", "av01": "av01",
+    "aac": "mp4a", "mp4a": "mp4a",
+    "opus": "opus", "vorbis": "vorbis",
+}
+
+# Audio that plays best next to each video container
+PREFERRED_AUDIO = {"mp4": "m4a", "webm": "webm"}
+
+
+def parse_mime(mime):
+    """'video/mp4; codecs="avc1.640028, mp4a.40.2"' -> ("video", "mp4", ["avc1.640028", "mp4a.40.2"])"""
+    kind, _, rest = (mime or "").partition(";")
+    media, _, container = kind.strip().partition("/")
+    match = re.search(r'codecs="([^"]*)"', rest)
+    codecs = [c.strip() for c in match.group(1).split(",") if c.strip()] if match else []
+    return media, container, codecs
+
+
+def _to_int(value):
+    try: return int(float(value))
+    except (TypeError, ValueError): return 0
+
+
+def _from_mime(mime, **fields):
+    media, container, codecs = parse_mime(mime)
+    vcodec = acodec = None
+    if media == "audio":
+        acodec = codecs[0] if codecs else container
+    elif media == "video":
+        vcodec = codecs[0] if codecs else container
+        if len(codecs) > 1: acodec = codecs[1]
+    ext = "m4a" if media == "audio" and container == "mp4" else container
+    return dict(fields, ext=ext or None, vcodec=vcodec, acodec=acodec)
+
+
+def from_innertube(f):
+    """Entry of streamingData.formats / adaptiveFormats (native + selenium engines)."""
+    return _from_mime(
+        f.get("mimeType"),
+        itag=str(f.get("itag", "")), url=f.get("url"),
+        height=_to_int(f.get("height")), width=_to_int(f.get("width")), fps=_to_int(f.get("fps")),
+        bitrate=_to_int(f.get("bitrate") or f.get("averageBitrate")), size=_to_int(f.get("contentLength"))
+    )
+
+
+def from_invidious(f):
+    """Entry of formatStreams / adaptiveFormats from the Invidious API."""
+    width, _, height = (f.get("size") or "").partition("x")
+    return _from_mime(
+        f.get("type"),
+        itag=str(f.get("itag", "")), url=f.get("url"),
+        height=_to_int(height) or _to_int((f.get("resolution") or "").rstrip("p")), width=_to_int(width),
+        fps=_to_int(f.get("fps")), bitrate=_to_int(f.get("bitrate")), size=_to_int(f.get("clen"))
+    )
+
+
+def from_piped(s, audio=False):
+    """Entry of videoStreams / audioStreams from the Piped API."""
+    media, container, _ = parse_mime(s.get("mimeType"))
+    codec = s.get("codec") or container
+    ext = "m4a" if audio and container == "mp4" else container
+    return {
+        "itag": str(s.get("itag", "")), "url": s.get("url"), "ext": ext or None,
+        "vcodec": None if audio else codec,
+        # Piped only tells us a video stream is muxed, not which audio codec it carries
+        "acodec": codec if audio else (None if s.get("videoOnly", True) else "mp4a"),
+        "height": _to_int(s.get("height")), "width": _to_int(s.get("width")), "fps": _to_int(s.get("fps")),
+        "bitrate": _to_int(s.get("bitrate")), "size": _to_int(s.get("contentLength")),
+    }
+
+
+def from_ytdlp(f):
+    """Entry of yt-dlp's info['formats']."""
+    vcodec = f.get("vcodec")
+    acodec = f.get("acodec")
+    return {
+        "itag": str(f.get("format_id", "")), "url": f.get("url"), "ext": f.get("ext"),
+        "vcodec": None if vcodec in (None, "none") else vcodec,
+        "acodec": None if acodec in (None, "none") else acodec,
+        "height": _to_int(f.get("height")), "width": _to_int(f.get("width")), "fps": _to_int(f.get("fps")),
+        "bitrate": _to_int((f.get("tbr") or 0) * 1000), "size": _to_int(f.get("filesize") or f.get("filesize_approx")),
+    }
+
+
+def codec_family(codec):
+    if not codec: return None
+    return CODEC_FAMILIES.get(codec.split(".")[0].lower(), codec.split(".")[0].lower())
+
+
+def parse_quality(quality):
+    """'1080', '1080p' -> 1080; None/'best'/garbage -> None (no cap)."""
+    if quality is None: return None
+    match = re.match(r"\s*(\d+)", str(quality))
+    return int(match.group(1)) if match else None
+
+
+# Format kinds, in the order an index lists them
+KINDS = ("combined", "video", "audio")
+
+
+def format_kind(f):
+    """'combined' (video + audio), 'video' (video-only), 'audio' (audio-only); None if unplayable."""
+    if not f.get("url"): return None
+    if f.get("vcodec"): return "combined" if f.get("acodec") else "video"
+    return "audio" if f.get("acodec") else None
+
+
+# Best-first order within each kind
+RANKS = {
+    "combined": lambda f: (f["height"], f["bitrate"]),
+    "video": lambda f: (f["height"], f["fps"], f["bitrate"]),
+    "audio": lambda f: f["bitrate"],
+}
+
+
+class FormatIndex:
+    """
+    Lookup tables over one video's formats, built once when it's resolved and cached
+    with the result (info["index"]), so itag/quality/codec/container picks on later
+    requests are dict hits instead of re-filtering and sorting the whole list.
+    - formats: the playable formats tagged with "kind", best-first within each kind
+      (combined, then video-only, then audio-only)
+    - tables:  positions into `formats` (JSON-safe): "itag" -> position; "combined",
+      "video", "audio", "height", "vcodec"/"acodec" (codec family) and "ext" -> lists
+      of positions, best-first; "heights" = video-only heights, tallest first
+    """
+    def __init__(self, formats, tables=None):
+        if tables is None:
+            formats, tables = self._build(formats)
+        self.formats = formats
+        self.tables = tables
+
+    @classmethod
+    def of(cls, info):
+        """Index of a resolved result; entries cached before it had one get built on the spot."""
+        return cls(info.get("formats") or [], info.get("index"))
+
+    @staticmethod
+    def _build(formats):
+        by_kind = {kind: [] for kind in KINDS}
+        for f in formats:
+            kind = format_kind(f)
+            if kind: by_kind[kind].append(dict(f, kind=kind))
+        ordered = [f for kind in KINDS for f in sorted(by_kind[kind], key=RANKS[kind], reverse=True)]
+
+        tables = {"itag": {}, "height": {}, "vcodec": {}, "acodec": {}, "ext": {}}
+        tables.update((kind, []) for kind in KINDS)
+        for pos, f in enumerate(ordered):
+            tables["itag"].setdefault(f["itag"], pos)
+            tables[f["kind"]].append(pos)
+            if f["kind"] != "audio":
+                tables["height"].setdefault(str(f["height"]), []).append(pos)
+            for field in ("vcodec", "acodec"):
+                family = codec_family(f.get(field))
+                if family: tables[field].setdefault(family, []).append(pos)
+            if f.get("ext"):
+                tables["ext"].setdefault(f["ext"], []).append(pos)
+        tables["heights"] = sorted({ordered[pos]["height"] for pos in tables["video"]}, reverse=True)
+        return ordered, tables
+
+    def _best(self, kind, prefer=None):
+        """Best `kind` format, the best one listed in `prefer` (a codec/ext table entry) if any."""
+        pos = next((p for p in prefer or () if self.formats[p]["kind"] == kind), None)
+        if pos is None:
+            pos = next(iter(self.tables[kind]), None)
+        return None if pos is None else self.formats[pos]
+
+    def itag(self, itag):
+        pos = self.tables["itag"].get(str(itag))
+        return None if pos is None else self.formats[pos]
+
+    def combined(self, quality=None):
+        """Tallest progressive (video + audio) format, at most `quality` tall if given, or None."""
+        cap = parse_quality(quality)
+        if not cap:
+            return self._best("combined")
+        return next((self.formats[p] for p in self.tables["combined"] if self.formats[p]["height"] <= cap), None)
+
+    def audio(self, codec=None):
+        """Best audio-only format (preferring the `codec` family, e.g. aac/opus), or None."""
+        return self._best("audio", self.tables["acodec"].get(codec_family(codec)))
+
+    def audio_for(self, video):
+        """Best audio-only format to mux with `video`, preferring its container."""
+        return self._best("audio", self.tables["ext"].get(PREFERRED_AUDIO.get(video.get("ext"))))
+
+    def adaptive(self, quality=None, codec=None):
+        """
+        Best video-only + audio-only pair for muxing, as (video, audio) or (None, None).
+        - quality: max height ('1080p'); (None, None) if no video-only stream fits it
+        - codec:   preferred video codec family (h264/avc1, vp9, av1); a tie-breaker, not a filter
+        """
+        heights = self.tables["heights"]
+        if not heights or not self.tables["audio"]:
+            return None, None
+        cap = parse_quality(quality)
+        height = next((h for h in heights if h <= cap), None) if cap else heights[0]
+        if height is None:
+            return None, None
+        prefer = self.tables["vcodec"].get(codec_family(codec)) or ()
+        at_height = [p for p in self.tables["height"][str(height)] if self.formats[p]["kind"] == "video"]
+        video = self.formats[next((p for p in at_height if p in prefer), at_height[0])]
+        return video, self.audio_for(video)
+
+
+# One-off picks over a fresh format list (engine results); cached results use FormatIndex.of(info)
+
+def pick_combined(formats):
+    """Tallest progressive (video + audio) format, or None."""
+    return FormatIndex(formats).combined()
+
+
+def pick_adaptive(formats, quality=None, codec=None):
+    """Best video-only + audio-only pair for muxing, as (video, audio) or (None, None); see FormatIndex.adaptive."""
+    return FormatIndex(formats).adaptive(quality, codec)
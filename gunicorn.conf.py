@@ -0,0 +1,36 @@
+"""
+Gunicorn settings (gunicorn -c gunicorn.conf.py app:app), all overridable from the environment.
+
+GUNICORN_PRELOAD=true imports the app (plus yt_dlp) once in the master before forking,
+so the workers share those pages copy-on-write instead of each loading its own copy,
+and start faster. Everything created at import time is fork-safe: sessions, pools and
+the ffmpeg scheduler's slots are opened lazily inside each worker.
+"""
+import gc
+import os
+
+from dotenv import load_dotenv
+load_dotenv()
+
+bind = os.getenv("BIND", "0.0.0.0:8088")
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Allows for deep extraction fallbacks
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "150"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() in ("1", "true", "yes")
+# Recycle workers now and then (0 = never); jitter keeps them from restarting together
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "0"))
+
+
+def when_ready(server):
+    # Runs in the master after the (pre)loaded app is imported and before any fork
+    if not preload_app:
+        return
+    import ytdlp_worker
+    ytdlp_worker.preload()
+    # Keep the GC from touching (and so un-sharing) every preloaded object in each worker
+    gc.freeze()
+    server.log.info("Preloaded app and yt_dlp for copy-on-write sharing")
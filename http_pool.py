@@ -0,0 +1,75 @@
+import asyncio
+import os
+import aiohttp
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+class HttpPool:
+    """
+    App-lifetime aiohttp sessions.
+    One pooled session for direct traffic and one for traffic routed through PROXY_URL,
+    so keep-alive connections to googlevideo/piped/invidious are reused across requests.
+    """
+    _sessions = {}
+    _lock = None
+
+    LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "200"))
+    LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))
+    KEEPALIVE = float(os.getenv("HTTP_POOL_KEEPALIVE", "30"))
+    DNS_TTL = int(os.getenv("HTTP_POOL_DNS_TTL", "300"))
+
+    @classmethod
+    def _build(cls):
+        connector = aiohttp.TCPConnector(
+            ssl=False,
+            limit=cls.LIMIT,
+            limit_per_host=cls.LIMIT_PER_HOST,
+            keepalive_timeout=cls.KEEPALIVE,
+            use_dns_cache=True,
+            ttl_dns_cache=cls.DNS_TTL,
+            enable_cleanup_closed=True,
+        )
+        # No session-wide timeout: callers pass their own per request
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None))
+
+    @classmethod
+    async def start(cls):
+        await cls.get(proxied=False)
+        await cls.get(proxied=True)
+
+    @classmethod
+    async def get(cls, proxied=False):
+        """
+        Returns the shared session for the given route ('proxy' pool or 'direct' pool).
+        Sessions are created lazily so the engines also work outside the FastAPI lifespan.
+        """
+        key = "proxy" if proxied else "direct"
+        session = cls._sessions.get(key)
+        if session is not None and not session.closed:
+            return session
+        if cls._lock is None:
+            cls._lock = asyncio.Lock()
+        async with cls._lock:
+            session = cls._sessions.get(key)
+            if session is None or session.closed:
+                session = cls._build()
+                cls._sessions[key] = session
+            return session
+
+    @classmethod
+    async def for_proxy(cls, proxy):
+        """Picks the pool matching a per-request proxy argument (None -> direct)."""
+        return await cls.get(proxied=bool(proxy))
+
+    @classmethod
+    async def close(cls):
+        sessions = list(cls._sessions.values())
+        cls._sessions = {}
+        cls._lock = None
+        for session in sessions:
+            try: await session.close()
+            except: pass
+        # Give the connectors a tick to close their transports
+        await asyncio.sleep(0.25)
@@ -0,0 +1,228 @@
+import json
+import os
+import re
+
+from http_pool import HttpPool
+from formats import from_innertube, pick_combined
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+YOUTUBE = os.getenv("INNERTUBE_HOST", "https://www.youtube.com").rstrip("/")
+PLAYER_URL = f"{YOUTUBE}/youtubei/v1/player?prettyPrint=false"
+WATCH_URL = YOUTUBE + "/watch?v={video_id}&bpctr=9999999999&has_verified=1"
+
+# Mobile clients get direct (unciphered) stream URLs from the player endpoint
+CLIENTS = {
+    "ios": {
+        "context": {
+            "clientName": "IOS", "clientVersion": "19.45.4",
+            "deviceMake": "Apple", "deviceModel": "iPhone16,2",
+            "osName": "iPhone", "osVersion": "18.1.0.22B83",
+            "hl": "en", "gl": "US",
+        },
+        "client_id": "5",
+        "user_agent": "com.google.ios.youtube/19.45.4 (iPhone16,2; U; CPU iOS 18_1_0 like Mac OS X;)",
+    },
+    "android": {
+        "context": {
+            "clientName": "ANDROID", "clientVersion": "19.44.38",
+            "androidSdkVersion": 30, "osName": "Android", "osVersion": "11",
+            "hl": "en", "gl": "US",
+        },
+        "client_id": "3",
+        "user_agent": "com.google.android.youtube/19.44.38 (Linux; U; Android 11) gzip",
+    },
+}
+
+# Client order for the player endpoint, then the watch page as the last resort
+INNERTUBE_CLIENTS = [c.strip() for c in os.getenv("INNERTUBE_CLIENTS", "ios,android").split(",") if c.strip() in CLIENTS]
+# Cap on watch-page bytes read while looking for ytInitialPlayerResponse
+WATCH_PAGE_MAX_KB = int(os.getenv("WATCH_PAGE_MAX_KB", "2048"))
+TIMEOUT = float(os.getenv("INNERTUBE_TIMEOUT", "7"))
+
+
+class JsonScanner:
+    """
+    Incremental extractor for one JSON object embedded in a page, e.g.
+    `var ytInitialPlayerResponse = {...};`. Bytes are fed as they arrive; once the
+    object's closing brace shows up, `result` holds its text and the caller can stop
+    reading. Braces inside strings (and escaped quotes) are handled, unlike a `{.+?};`
+    regex, and at most `limit` bytes are ever buffered.
+    """
+    _STRUCTURE = re.compile(rb'[{}"]')
+    _IN_STRING = re.compile(rb'["\\]')
+
+    def __init__(self, marker, limit=WATCH_PAGE_MAX_KB * 1024):
+        self.marker = re.compile(re.escape(marker.encode()) + rb"\s*=\s*\{")
+        self.limit = limit
+        self.buffer = bytearray()
+        self.start = None       # offset of the opening brace in buffer
+        self.pos = 0            # scan position
+        self.depth = 0
+        self.in_string = False
+        self.result = None
+        self.seen = 0
+
+    def feed(self, data):
+        """Consumes a chunk; returns the JSON text once complete, else None. Raises ValueError past `limit`."""
+        if self.result is not None:
+            return self.result
+        self.seen += len(data)
+        self.buffer += data
+        if self.start is None:
+            match = self.marker.search(self.buffer)
+            if not match:
+                # Keep a tail in case the marker straddles two chunks
+                keep = len(self.marker.pattern) + 16
+                if len(self.buffer) > keep:
+                    del self.buffer[:-keep]
+                if self.seen > self.limit:
+                    raise ValueError("marker not found")
+                return None
+            del self.buffer[:match.end() - 1]
+            self.start = self.pos = 0
+        result = self._scan()
+        if result is None and len(self.buffer) > self.limit:
+            raise ValueError(f"object larger than {self.limit} bytes")
+        return result
+
+    def _scan(self):
+        buf = self.buffer
+        pos = self.pos
+        while True:
+            if self.in_string:
+                match = self._IN_STRING.search(buf, pos)
+                if not match:
+                    break
+                if buf[match.start()] == 0x5C:  # backslash: skip the escaped byte
+                    if match.start() + 1 >= len(buf):
+                        pos = match.start()
+                        break
+                    pos = match.start() + 2
+                    continue
+                self.in_string = False
+                pos = match.end()
+                continue
+            match = self._STRUCTURE.search(buf, pos)
+            if not match:
+                pos = len(buf)
+                break
+            char = buf[match.start()]
+            pos = match.end()
+            if char == 0x22:
+                self.in_string = True
+            elif char == 0x7B:
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.result = bytes(buf[self.start:pos])
+                    return self.result
+        self.pos = pos
+        return None
+
+
+def player_request(video_id, client):
+    """(headers, payload) for a /youtubei/v1/player call as `client`."""
+    spec = CLIENTS[client]
+    headers = {
+        "User-Agent": spec["user_agent"],
+        "Content-Type": "application/json",
+        "Accept-Encoding": "gzip, deflate",
+        "X-YouTube-Client-Name": spec["client_id"],
+        "X-YouTube-Client-Version": spec["context"]["clientVersion"],
+        "Origin": "https://www.youtube.com",
+    }
+    payload = {
+        "context": {"client": spec["context"]},
+        "videoId": video_id,
+        "playbackContext": {"contentPlaybackContext": {"html5Preference": "HTML5_PREF_WANTS"}},
+        "contentCheckOk": True,
+        "racyCheckOk": True,
+    }
+    return headers, payload
+
+
+def parse_player(data, engine):
+    """Engine result from a player response (API, watch page or the browser), or None if unplayable."""
+    if not data:
+        return None
+    status = data.get("playabilityStatus", {}).get("status")
+    if status and status != "OK":
+        print(f"[InnerTube] {engine}: {status} ({data['playabilityStatus'].get('reason', '')})")
+        return None
+    streaming_data = data.get("streamingData", {})
+    formats = streaming_data.get("formats", []) + streaming_data.get("adaptiveFormats", [])
+    # Ciphered entries (signatureCipher) need the player JS; only direct URLs are usable here
+    formats = [from_innertube(f) for f in formats if "url" in f]
+    if not formats:
+        return None
+    # Progressive formats only: adaptive ones are video-only or audio-only
+    best = pick_combined(formats)
+    details = data.get("videoDetails", {})
+    return {
+        "title": details.get("title"),
+        "url": best["url"] if best else None,
+        "thumbnail": (details.get("thumbnail", {}).get("thumbnails") or [{}])[-1].get("url"),
+        "quality": f"{best['height'] if best else 720}p",
+        "width": best["width"] if best else 1280, "height": best["height"] if best else 720,
+        "formats": formats,
+        "engine": engine
+    }
+
+
+def parse_watch_page(html, limit=WATCH_PAGE_MAX_KB * 1024):
+    """Player response embedded in a whole watch page (bytes), or None."""
+    scanner = JsonScanner("ytInitialPlayerResponse", limit)
+    try:
+        text = scanner.feed(html)
+    except ValueError:
+        return None
+    return json.loads(text) if text else None
+
+
+async def fetch_player(video_id, client, proxy=None):
+    """Player response from the InnerTube API: a ~1 KB request and a compressed JSON reply."""
+    headers, payload = player_request(video_id, client)
+    session = await HttpPool.for_proxy(proxy)
+    async with session.post(PLAYER_URL, json=payload, headers=headers, proxy=proxy, timeout=TIMEOUT) as resp:
+        if resp.status != 200:
+            print(f"[InnerTube] {client}: HTTP {resp.status}")
+            return None
+        return await resp.json(content_type=None)
+
+
+async def fetch_watch_page(video_id, user_agent, proxy=None):
+    """
+    Player response from the watch page, read incrementally: the download stops as soon
+    as ytInitialPlayerResponse is complete instead of pulling the rest of the page.
+    """
+    headers = {"User-Agent": user_agent, "Accept-Language": "en-US,en;q=0.9", "Accept-Encoding": "gzip, deflate"}
+    scanner = JsonScanner("ytInitialPlayerResponse")
+    session = await HttpPool.for_proxy(proxy)
+    async with session.get(WATCH_URL.format(video_id=video_id), headers=headers, proxy=proxy, timeout=TIMEOUT) as resp:
+        if resp.status != 200:
+            return None
+        try:
+            async for chunk in resp.content.iter_chunked(64 * 1024):
+                text = scanner.feed(chunk)
+                if text:
+                    return json.loads(text)
+        except ValueError as e:
+            print(f"[InnerTube] Watch page: {e}")
+    return None
+
+
+async def resolve(video_id, user_agent, proxy=None):
+    """Tries each InnerTube client, then the watch page. Returns an engine result or None."""
+    for client in INNERTUBE_CLIENTS:
+        try:
+            result = parse_player(await fetch_player(video_id, client, proxy), f"native-{client}")
+            if result:
+                return result
+        except Exception as e:
+            print(f"[InnerTube] {client} failed: {e}")
+    return parse_player(await fetch_watch_page(video_id, user_agent, proxy), "native-watchpage")
+
@@ -0,0 +1,251 @@
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlparse, parse_qs
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+def url_expiry(url):
+    """
+    Reads the signed expiry (unix seconds) out of a googlevideo URL.
+    Handles both '?expire=123' and the '/expire/123/' path form used by manifests.
+    """
+    if not url:
+        return None
+    try:
+        qs = parse_qs(urlparse(url).query)
+        if qs.get("expire"):
+            return int(qs["expire"][0])
+        match = re.search(r"/expire/(\d+)", url)
+        if match:
+            return int(match.group(1))
+    except: pass
+    return None
+
+
+class MemoryBackend:
+    """In-process LRU. Default backend; one per worker."""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+
+    async def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.time():
+            self._data.pop(key, None)
+            return None
+        self._data.move_to_end(key)
+        return json.loads(value)
+
+    async def set(self, key, value, ttl):
+        self._data[key] = (time.time() + ttl, json.dumps(value))
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    async def delete(self, key):
+        self._data.pop(key, None)
+
+    def size(self):
+        return len(self._data)
+
+
+class DiskBackend:
+    """
+    SQLite file shared by all gunicorn workers on the host.
+    LRU by last access time, trimmed to max_entries on write.
+    """
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS media_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS media_cache_accessed ON media_cache(accessed)")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try: yield db
+        finally: db.close()
+
+    def _get(self, key):
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute("SELECT value, expires_at FROM media_cache WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+            if row[1] <= now:
+                db.execute("DELETE FROM media_cache WHERE key = ?", (key,))
+                return None
+            db.execute("UPDATE media_cache SET accessed = ? WHERE key = ?", (now, key))
+            return json.loads(row[0])
+
+    def _set(self, key, value, ttl):
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO media_cache (key, value, expires_at, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + ttl, now)
+            )
+            db.execute("DELETE FROM media_cache WHERE expires_at <= ?", (now,))
+            db.execute(
+                "DELETE FROM media_cache WHERE key IN ("
+                "SELECT key FROM media_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def _delete(self, key):
+        with self._connect() as db:
+            db.execute("DELETE FROM media_cache WHERE key = ?", (key,))
+
+    async def get(self, key):
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key, value, ttl):
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def delete(self, key):
+        await asyncio.to_thread(self._delete, key)
+
+    def size(self):
+        try:
+            with self._connect() as db:
+                return db.execute("SELECT COUNT(*) FROM media_cache").fetchone()[0]
+        except: return None
+
+
+class RedisBackend:
+    """
+    Redis shared cache (optional dependency: `pip install redis`).
+    Expiry is native; LRU comes from the server's maxmemory-policy (allkeys-lru).
+    """
+    def __init__(self, url, prefix="ytmeta:"):
+        import redis.asyncio as redis
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, key):
+        raw = await self.client.get(self.prefix + key)
+        return json.loads(raw) if raw else None
+
+    async def set(self, key, value, ttl):
+        await self.client.set(self.prefix + key, json.dumps(value), ex=max(1, int(ttl)))
+
+    async def delete(self, key):
+        await self.client.delete(self.prefix + key)
+
+    def size(self):
+        return None
+
+
+class MediaCache:
+    """
+    TTL cache for get_media_info results, keyed by video id + itag
+    (+ a variant such as 'adaptive' for results raced under different rules).
+    Entries expire a safety margin before the signed stream URL does.
+
+    Backend is picked with MEDIA_CACHE_BACKEND = memory | disk | redis.
+    """
+    MAX_ENTRIES = int(os.getenv("MEDIA_CACHE_MAX_ENTRIES", "2048"))
+    DEFAULT_TTL = int(os.getenv("MEDIA_CACHE_DEFAULT_TTL", "300"))
+    MAX_TTL = int(os.getenv("MEDIA_CACHE_MAX_TTL", "18000"))
+    EXPIRY_MARGIN = int(os.getenv("MEDIA_CACHE_EXPIRY_MARGIN", "600"))
+
+    def __init__(self, backend=None):
+        self.backend = backend or self._backend_from_env()
+        self.hits = 0
+        self.misses = 0
+
+    def _backend_from_env(self):
+        kind = os.getenv("MEDIA_CACHE_BACKEND", "memory").lower()
+        if kind == "redis":
+            try:
+                return RedisBackend(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+            except Exception as e:
+                print(f"[Cache] Redis unavailable ({e}), falling back to memory")
+        elif kind == "disk":
+            path = os.getenv("MEDIA_CACHE_PATH", os.path.join(tempfile.gettempdir(), "yt-media-cache.sqlite"))
+            try:
+                return DiskBackend(path, self.MAX_ENTRIES)
+            except Exception as e:
+                print(f"[Cache] Disk cache unavailable ({e}), falling back to memory")
+        return MemoryBackend(self.MAX_ENTRIES)
+
+    @staticmethod
+    def key(video_id, itag=None, variant=None):
+        key = f"{video_id}:{itag or 'best'}"
+        return f"{key}:{variant}" if variant else key
+
+    def ttl_for(self, info):
+        """Seconds this result may be served for, or 0 if it should not be cached."""
+        served_until = self.served_until(info)
+        if served_until is None:
+            return self.DEFAULT_TTL
+        return max(0, min(self.MAX_TTL, int(served_until - time.time())))
+
+    def served_until(self, info):
+        """Unix time the cache stops serving this result (signed expiry - margin), None if the URL has none."""
+        url = None
+        if info:
+            # Adaptive-only results have no progressive URL; their formats expire together
+            url = info.get("play") or next((f["url"] for f in info.get("formats") or [] if f.get("url")), None)
+        expire = url_expiry(url)
+        return None if expire is None else expire - self.EXPIRY_MARGIN
+
+    async def get(self, video_id, itag=None, variant=None):
+        try:
+            value = await self.backend.get(self.key(video_id, itag, variant))
+        except Exception as e:
+            print(f"[Cache] get failed: {e}")
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def peek(self, key):
+        """Raw lookup by full key, without touching the hit/miss counters."""
+        try:
+            return await self.backend.get(key)
+        except Exception:
+            return None
+
+    async def set(self, video_id, itag, info, variant=None):
+        ttl = self.ttl_for(info)
+        if ttl <= 0:
+            return
+        try:
+            await self.backend.set(self.key(video_id, itag, variant), info, ttl)
+        except Exception as e:
+            print(f"[Cache] set failed: {e}")
+
+    async def invalidate(self, video_id, itag=None, variant=None):
+        try:
+            await self.backend.delete(self.key(video_id, itag, variant))
+        except: pass
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+            "entries": self.backend.size(),
+        }
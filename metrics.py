@@ -0,0 +1,390 @@
+import asyncio
+import contextvars
+import glob
+import json
+import os
+import random
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+# --- Prometheus metrics ---------------------------------------------------------------
+#
+# Small dependency-free registry rendered in the Prometheus text format. Each gunicorn
+# worker keeps its own counters and dumps them to METRICS_DIR every few seconds; /metrics
+# (served by whichever worker gets the scrape) sums the live workers' dumps, so the
+# numbers cover the whole host like the TaskStore and the FFmpeg slots do.
+
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "yt-metrics"))
+FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DURATION_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+THROUGHPUT_BUCKETS = (256e3, 1e6, 4e6, 16e6, 64e6, 256e6)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.samples = {}
+        _registry[name] = self
+
+    def _key(self, labels):
+        return tuple(str(labels.get(l, "")) for l in self.labels)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.samples[key] = self.samples.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Set at collection time by a collector (see `collector`)."""
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.samples[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        sample = self.samples.get(key)
+        if sample is None:
+            # per-bucket counts (+Inf last), sum
+            sample = self.samples[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                sample[0][idx] += 1
+                break
+        else:
+            sample[0][-1] += 1
+        sample[1] += value
+
+
+_registry = OrderedDict()
+_collectors = []
+
+
+def collector(fn):
+    """Registers fn() to refresh gauges right before a dump."""
+    _collectors.append(fn)
+    return fn
+
+
+ENGINE_LATENCY = Histogram("ytdown_engine_latency_seconds", "Engine/instance call latency", ("engine", "instance", "outcome"))
+ENGINE_FAILURES = Counter("ytdown_engine_failures_total", "Failed engine/instance calls by reason", ("engine", "instance", "reason"))
+RACES = Counter("ytdown_races_total", "Engine races by result", ("mode", "result"))
+RACE_WINS = Counter("ytdown_race_wins_total", "Races won, per engine (win rate = wins / races)", ("engine",))
+RACE_DURATION = Histogram("ytdown_race_duration_seconds", "Time to resolve a video through the engine race", ("mode", "result"))
+LOOKUPS = Counter("ytdown_media_lookups_total", "get_media_info calls by cache outcome", ("cache",))
+PREWARM_REFRESHES = Counter("ytdown_prewarm_refreshes_total", "Background re-resolves of hot entries", ("trigger", "result"))
+DOWNLOAD_BYTES = Counter("ytdown_download_bytes_total", "Bytes fetched from the media host", ("path",))
+ADMISSION_REJECTED = Counter("ytdown_admission_rejected_total", "Requests turned away by admission control (429/503)", ("endpoint", "reason"))
+URL_REFRESHES = Counter("ytdown_url_refreshes_total", "Stream URLs re-resolved after a 403/expiry", ("result",))
+RESUMES = Counter("ytdown_resumes_total", "Transfers continued at a byte offset after a failure", ("path",))
+DOWNLOAD_THROUGHPUT = Histogram("ytdown_download_throughput_bytes_per_second", "Per-download throughput", ("path",), THROUGHPUT_BUCKETS)
+FFMPEG_DURATION = Histogram("ytdown_ffmpeg_duration_seconds", "FFmpeg run time (excluding queueing)", ("priority", "outcome"), DURATION_BUCKETS)
+FFMPEG_WAIT = Histogram("ytdown_ffmpeg_queue_wait_seconds", "Time spent waiting for an FFmpeg slot", ("priority",))
+TASKS = Counter("ytdown_tasks_total", "Finished download tasks by status", ("status",))
+TASKS_ACTIVE = Gauge("ytdown_tasks_active", "Download tasks running")
+STREAMS_ACTIVE = Gauge("ytdown_streams_active", "Live /stream pipelines")
+STREAM_BUFFERED = Gauge("ytdown_stream_buffered_bytes", "Bytes buffered by live /stream pipelines")
+EXECUTOR_QUEUED = Gauge("ytdown_executor_queue_depth", "Jobs waiting for an executor worker", ("pool",))
+EXECUTOR_RUNNING = Gauge("ytdown_executor_running", "Jobs running on an executor", ("pool",))
+FFMPEG_RUNNING = Gauge("ytdown_ffmpeg_running", "FFmpeg processes running")
+FFMPEG_QUEUED = Gauge("ytdown_ffmpeg_queued", "FFmpeg jobs waiting for a slot", ("priority",))
+
+_active_tasks = 0
+
+
+def task_started():
+    global _active_tasks
+    _active_tasks += 1
+
+
+def task_finished(status):
+    global _active_tasks
+    _active_tasks -= 1
+    TASKS.inc(status=status)
+
+
+def active_tasks():
+    return _active_tasks
+
+
+@collector
+def _collect_tasks():
+    TASKS_ACTIVE.set(_active_tasks)
+
+
+def split_engine(name):
+    """'piped:pipedapi.kavin.rocks' -> ('piped', 'pipedapi.kavin.rocks'); 'native' -> ('native', '')"""
+    engine, _, instance = name.partition(":")
+    return engine, instance
+
+
+def failure_reason(exc):
+    if exc is None:
+        return "empty"
+    if isinstance(exc, asyncio.TimeoutError):
+        return "timeout"
+    return type(exc).__name__
+
+
+def snapshot():
+    for fn in _collectors:
+        try: fn()
+        except Exception as e: print(f"[Metrics] Collector failed: {e}")
+    return {
+        name: {
+            "kind": m.kind, "help": m.help, "labels": m.labels,
+            "buckets": getattr(m, "buckets", None),
+            "samples": [[list(key), value] for key, value in m.samples.items()],
+        }
+        for name, m in _registry.items()
+    }
+
+
+def dump(snap=None):
+    """Writes this worker's metrics for the other workers' /metrics to pick up."""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"worker-{os.getpid()}.json")
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(snap or snapshot(), f)
+    os.replace(tmp, path)
+
+
+async def flush_loop():
+    while True:
+        try: dump()
+        except Exception as e: print(f"[Metrics] Dump failed: {e}")
+        await asyncio.sleep(FLUSH_INTERVAL)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _merge(into, snap):
+    for name, metric in snap.items():
+        target = into.setdefault(name, dict(metric, samples={}))
+        for key, value in metric["samples"]:
+            key = tuple(key)
+            current = target["samples"].get(key)
+            if current is None:
+                # Copy: the first snapshot merged is this worker's live registry
+                target["samples"][key] = [list(value[0]), value[1]] if metric["kind"] == "histogram" else value
+            elif metric["kind"] == "histogram":
+                current[0] = [a + b for a, b in zip(current[0], value[0])]
+                current[1] += value[1]
+            else:
+                target["samples"][key] = current + value
+
+
+def _num(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [(n, v) for n, v in zip(names, values) if v != ""] + list(extra)
+    if not pairs:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{n}="{escape(v)}"' for n, v in pairs) + "}"
+
+
+def render():
+    """Prometheus text exposition of every live worker's metrics, summed."""
+    merged = {}
+    snap = snapshot()
+    _merge(merged, snap)
+    try: dump(snap)
+    except OSError: pass
+    for path in glob.glob(os.path.join(METRICS_DIR, "worker-*.json")):
+        pid = int(os.path.basename(path)[7:-5]) if os.path.basename(path)[7:-5].isdigit() else None
+        if pid is None or pid == os.getpid():
+            continue
+        if not _alive(pid):
+            try: os.unlink(path)
+            except OSError: pass
+            continue
+        try:
+            with open(path) as f:
+                _merge(merged, json.load(f))
+        except (OSError, ValueError):
+            continue
+
+    lines = []
+    for name, metric in merged.items():
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for key, value in sorted(metric["samples"].items()):
+            if metric["kind"] == "histogram":
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip([*metric["buckets"], "+Inf"], counts):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else f"{bound:g}"
+                    lines.append(f"{name}_bucket{_format_labels(metric['labels'], key, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(metric['labels'], key)} {_num(total)}")
+                lines.append(f"{name}_count{_format_labels(metric['labels'], key)} {cumulative}")
+            else:
+                lines.append(f"{name}{_format_labels(metric['labels'], key)} {_num(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# --- Request tracing ------------------------------------------------------------------
+#
+# Opt-in per request: an `X-Trace: 1` header, or TRACE_SAMPLE_RATE (0..1) of requests.
+# span() records name, start offset, duration and attributes into the request's trace;
+# with no trace active it costs one contextvar lookup. Background work started by the
+# request (download tasks) inherits the trace and keeps adding spans after the response.
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_HEADER = os.getenv("TRACE_HEADER", "x-trace").lower()
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "200"))
+
+_trace = contextvars.ContextVar("trace", default=None)
+_span = contextvars.ContextVar("span", default=None)
+_recent = OrderedDict()
+
+
+class Trace:
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+        _recent[self.id] = self
+        while len(_recent) > TRACE_KEEP:
+            _recent.popitem(last=False)
+
+    def to_dict(self):
+        return {"trace_id": self.id, "name": self.name, "spans": self.spans}
+
+    def server_timing(self):
+        """Finished spans as a Server-Timing header value."""
+        return ", ".join(
+            f'{s["name"].replace(":", "-").replace(" ", "_")};dur={s["duration_ms"]}'
+            for s in self.spans if s["duration_ms"] is not None
+        )
+
+
+class _Span:
+    __slots__ = ("trace", "record", "tokens", "started")
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        parent = _span.get()
+        self.started = time.perf_counter()
+        self.record = {
+            "name": name, "parent": parent["name"] if parent else None,
+            "start_ms": round((self.started - trace.started) * 1000, 1),
+            "duration_ms": None, **attrs
+        }
+        self.tokens = None
+
+    def set(self, **attrs):
+        self.record.update(attrs)
+
+    def __enter__(self):
+        self.trace.spans.append(self.record)
+        self.tokens = _span.set(self.record)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.record["duration_ms"] = round((time.perf_counter() - self.started) * 1000, 1)
+        if exc_type is not None:
+            self.record["error"] = exc_type.__name__
+        _span.reset(self.tokens)
+        return False
+
+
+class _NoSpan:
+    def set(self, **attrs): pass
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, **attrs):
+    """with span("ffmpeg", priority="live") as s: ...; s.set(bytes=n)"""
+    trace = _trace.get()
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name, attrs)
+
+
+def report_trace():
+    """Logs the current trace again, e.g. once background work it started has finished."""
+    trace = _trace.get()
+    if trace is not None:
+        print(f"[Trace] {trace.id} {json.dumps(trace.to_dict(), separators=(',', ':'))}")
+
+
+def get_trace(trace_id):
+    trace = _recent.get(trace_id)
+    return trace.to_dict() if trace else None
+
+
+class TraceMiddleware:
+    """ASGI middleware: starts a trace for sampled/flagged requests and reports it."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        flagged = any(k.decode().lower() == TRACE_HEADER and v not in (b"0", b"") for k, v in scope.get("headers", []))
+        if not flagged and not (TRACE_SAMPLE_RATE and random.random() < TRACE_SAMPLE_RATE):
+            return await self.app(scope, receive, send)
+
+        trace = Trace(f"{scope['method']} {scope['path']}")
+        token = _trace.set(trace)
+        root = _Span(trace, "request", {"path": scope["path"]})
+
+        async def traced_send(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-trace-id", trace.id.encode()))
+                timing = trace.server_timing()
+                if timing:
+                    headers.append((b"server-timing", timing.encode()))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            with root:
+                await self.app(scope, receive, traced_send)
+            report_trace()
+        finally:
+            _trace.reset(token)
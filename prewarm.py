@@ -0,0 +1,182 @@
+import asyncio
+import math
+import os
+import time
+
+import metrics
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+class HotSet:
+    """
+    Bounded request-frequency tracker per cache key (video id + itag + variant).
+    Scores decay exponentially (HOT_HALF_LIFE seconds), so yesterday's trending video
+    cools off by itself. When full, a new key replaces the coldest one.
+    """
+    SIZE = int(os.getenv("HOT_SET_SIZE", "256"))
+    HALF_LIFE = float(os.getenv("HOT_HALF_LIFE", "900"))
+
+    def __init__(self, size=None, half_life=None):
+        self.size = max(1, size or self.SIZE)
+        self.decay = math.log(2) / (half_life or self.HALF_LIFE)
+        # key -> {"score", "seen", "url", "itag", "adaptive", "expires"}
+        self.entries = {}
+
+    def _score(self, entry, now):
+        return entry["score"] * math.exp(-self.decay * (now - entry["seen"]))
+
+    def touch(self, key, url, itag=None, adaptive=False):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is None:
+            if len(self.entries) >= self.size:
+                coldest = min(self.entries, key=lambda k: self._score(self.entries[k], now))
+                del self.entries[coldest]
+            entry = self.entries[key] = {"score": 0.0, "seen": now, "url": url, "itag": itag, "adaptive": adaptive, "expires": None}
+        entry["score"] = self._score(entry, now) + 1
+        entry["seen"] = now
+        return entry
+
+    def resolved(self, key, ttl):
+        """Records when the freshly cached result for `key` stops being served."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry["expires"] = time.time() + ttl
+
+    def hottest(self, limit, min_score=0):
+        now = time.time()
+        scored = [(self._score(e, now), k) for k, e in self.entries.items()]
+        scored = sorted((s, k) for s, k in scored if s >= min_score)[::-1]
+        return [(k, self.entries[k], s) for s, k in scored[:limit]]
+
+
+class Prewarmer:
+    """
+    Keeps hot videos resolved so their requests never wait for an engine race.
+    - stale-while-revalidate: a cache hit within REFRESH_AHEAD seconds of expiry is
+      served as-is while a background race refreshes the entry
+    - every INTERVAL seconds the hottest keys whose entry expires (or already has)
+      before the next round are re-resolved ahead of time
+    Refreshes go through downloader.revalidate (the old entry keeps serving until the
+    new one lands; a failed race leaves it alone) and are budgeted: at most BUDGET per
+    INTERVAL, CONCURRENCY at a time, and none while foreground races are above
+    MAX_INFLIGHT. Hot sets are per worker; the cache is checked before re-racing, so
+    a key another worker already refreshed (shared backend) is skipped. A refresh that
+    fails (or whose result can't be cached) backs off INTERVAL x 2^failures, and after
+    MAX_FAILURES in a row the key leaves the hot set until requests make it hot again.
+    """
+    INTERVAL = float(os.getenv("PREWARM_INTERVAL", "60"))
+    REFRESH_AHEAD = float(os.getenv("PREWARM_REFRESH_AHEAD", "120"))
+    BUDGET = int(os.getenv("PREWARM_BUDGET", "20"))
+    CONCURRENCY = int(os.getenv("PREWARM_CONCURRENCY", "2"))
+    MIN_SCORE = float(os.getenv("PREWARM_MIN_SCORE", "3"))
+    MAX_INFLIGHT = int(os.getenv("PREWARM_MAX_INFLIGHT", "4"))
+    MAX_FAILURES = int(os.getenv("PREWARM_MAX_FAILURES", "3"))
+
+    def __init__(self, downloader, hot):
+        self.downloader = downloader
+        self.hot = hot
+        self.semaphore = asyncio.Semaphore(max(1, self.CONCURRENCY))
+        self.refreshing = set()
+        self.spent = 0              # refreshes started in the current interval
+        self.refreshed = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def on_hit(self, key, info):
+        """Cache hit: serve it, and refresh in the background if it's hot and about to expire."""
+        entry = self.hot.entries.get(key)
+        if entry is None or self.hot._score(entry, time.time()) < self.MIN_SCORE:
+            return
+        if entry["expires"] is None:
+            entry["expires"] = time.time() + self.downloader.cache.ttl_for(info)
+        if entry["expires"] - time.time() < self.REFRESH_AHEAD:
+            self._schedule(key, entry, "stale")
+
+    def _schedule(self, key, entry, trigger):
+        if key in self.refreshing or entry.get("retry_at", 0) > time.time():
+            return False
+        if self.spent >= self.BUDGET or self.downloader.inflight.stats()["in_flight"] >= self.MAX_INFLIGHT:
+            self.skipped += 1
+            return False
+        self.spent += 1
+        self.refreshing.add(key)
+        asyncio.ensure_future(self._refresh(key, entry, trigger))
+        return True
+
+    async def _refresh(self, key, entry, trigger):
+        try:
+            async with self.semaphore:
+                with metrics.span("prewarm", trigger=trigger):
+                    info = await self.downloader.revalidate(entry["url"], entry["itag"], entry["adaptive"])
+            # Only counts if it landed in the cache (hot.resolved moved `expires` ahead)
+            result = "ok" if info and (entry["expires"] or 0) > time.time() else "failed"
+        except Exception as e:
+            print(f"[Prewarm] {key} failed: {e}")
+            result = "failed"
+        finally:
+            self.refreshing.discard(key)
+        if result == "ok":
+            self.refreshed += 1
+            entry["failures"] = 0
+            entry.pop("retry_at", None)
+        else:
+            self.failed += 1
+            self._backoff(key, entry)
+        metrics.PREWARM_REFRESHES.inc(trigger=trigger, result=result)
+
+    def _backoff(self, key, entry):
+        entry["failures"] = entry.get("failures", 0) + 1
+        if entry["failures"] >= self.MAX_FAILURES:
+            if self.hot.entries.get(key) is entry:
+                del self.hot.entries[key]
+            print(f"[Prewarm] Dropping {key} after {entry['failures']} failed refreshes")
+            return
+        entry["retry_at"] = time.time() + self.INTERVAL * 2 ** entry["failures"]
+
+    async def run_once(self):
+        """One scheduling round; returns how many refreshes it started."""
+        self.spent = 0
+        started = 0
+        now = time.time()
+        horizon = now + self.REFRESH_AHEAD + self.INTERVAL
+        cache = self.downloader.cache
+        for key, entry, score in self.hot.hottest(self.hot.size, self.MIN_SCORE):
+            if entry.get("retry_at", 0) > now:
+                continue
+            if entry["expires"] is not None and entry["expires"] > horizon:
+                continue
+            # Check the cache before racing: another worker (shared backend) may have
+            # refreshed it, or this worker never learned when its entry expires
+            info = await cache.peek(key)
+            if info:
+                served_until = cache.served_until(info) or now + cache.ttl_for(info)
+                entry["expires"] = served_until
+                if served_until > horizon:
+                    continue
+            if self._schedule(key, entry, "hot"):
+                started += 1
+            if self.spent >= self.BUDGET:
+                break
+        return started
+
+    async def loop(self):
+        while True:
+            await asyncio.sleep(self.INTERVAL)
+            try:
+                started = await self.run_once()
+                if started: print(f"[Prewarm] Refreshing {started} hot entries")
+            except Exception as e:
+                print(f"[Prewarm] Round failed: {e}")
+
+    def stats(self):
+        return {
+            "hot_keys": len(self.hot.entries),
+            "refreshing": len(self.refreshing),
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "skipped_budget": self.skipped,
+            "top": [{"key": k, "score": round(s, 1)} for k, _, s in self.hot.hottest(5)],
+        }
@@ -0,0 +1,153 @@
+import os
+import uuid
+
+import anyio
+from starlette.responses import Response
+
+
+MAX_RANGES = 16
+CHUNK = 256 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_ranges(header, size):
+    """
+    Parses a 'Range: bytes=...' header against a known size.
+    Returns a list of inclusive (start, end) pairs, or None when the whole entity should
+    be sent (no header, not bytes, malformed, or too many ranges - RFC 9110 lets us ignore it).
+    Raises RangeNotSatisfiable when no range overlaps the entity.
+    """
+    if not header or not header.strip().lower().startswith("bytes="):
+        return None
+    specs = header.split("=", 1)[1].split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first == "":
+                # Suffix range: last N bytes
+                length = int(last)
+                if length <= 0: continue
+                ranges.append((max(0, size - length), size - 1))
+                continue
+            start = int(first)
+            end = int(last) if last else size - 1
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        if start > end:
+            return None
+        ranges.append((start, min(end, size - 1)))
+    if not ranges:
+        raise RangeNotSatisfiable()
+    return ranges
+
+
+def multipart_layout(ranges, size, content_type):
+    """
+    Part headers for a multipart/byteranges body.
+    Returns (boundary, [(part_header_bytes, start, end)], trailer_bytes, content_length).
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    length = 0
+    for start, end in ranges:
+        head = (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ).encode()
+        parts.append((head, start, end))
+        length += len(head) + end - start + 1
+    trailer = f"\r\n--{boundary}--\r\n".encode()
+    return boundary, parts, trailer, length + len(trailer)
+
+
+class RangeFileResponse(Response):
+    """
+    File response with single/multi Range support (206, 416, multipart/byteranges).
+    The body is pread() in CHUNK pieces on worker threads: ASGI servers (uvicorn
+    included) give the app no socket to sendfile() into, so there's no zero-copy path.
+    HEAD requests get the headers only.
+    """
+    def __init__(self, path, media_type, filename=None, range_header=None, extra_headers=None):
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = None
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.range_header = range_header
+        self.raw_headers = [(b"content-type", media_type.encode("latin-1"))]
+        self.headers["Accept-Ranges"] = "bytes"
+        if filename:
+            self.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        for key, value in (extra_headers or {}).items():
+            self.headers[key] = value
+
+    async def __call__(self, scope, receive, send):
+        try:
+            ranges = parse_ranges(self.range_header, self.size)
+        except RangeNotSatisfiable:
+            self.status_code = 416
+            self.headers["Content-Range"] = f"bytes */{self.size}"
+            self.headers["Content-Length"] = "0"
+            await send({"type": "http.response.start", "status": 416, "headers": self.raw_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        send_body = scope.get("method") != "HEAD"
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            if ranges is None:
+                self.status_code = 200
+                self.headers["Content-Length"] = str(self.size)
+                await self._start(send)
+                if send_body: await self._send_span(send, fd, 0, self.size - 1, last=True)
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.status_code = 206
+                self.headers["Content-Range"] = f"bytes {start}-{end}/{self.size}"
+                self.headers["Content-Length"] = str(end - start + 1)
+                await self._start(send)
+                if send_body: await self._send_span(send, fd, start, end, last=True)
+            else:
+                boundary, parts, trailer, length = multipart_layout(ranges, self.size, self.media_type)
+                self.status_code = 206
+                self.headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+                self.headers["Content-Length"] = str(length)
+                await self._start(send)
+                if send_body:
+                    for head, start, end in parts:
+                        await send({"type": "http.response.body", "body": head, "more_body": True})
+                        await self._send_span(send, fd, start, end, last=False)
+                    await send({"type": "http.response.body", "body": trailer, "more_body": False})
+            if not send_body:
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            os.close(fd)
+
+    async def _start(self, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+
+    async def _send_span(self, send, fd, start, end, last):
+        count = end - start + 1
+        offset = start
+        remaining = count
+        while remaining > 0:
+            chunk = await anyio.to_thread.run_sync(os.pread, fd, min(CHUNK, remaining), offset)
+            if not chunk:
+                # Truncated under us: Content-Length can't be met, so let the server drop the connection
+                raise OSError(f"{self.path} ended at byte {offset} while sending {start}-{end}")
+            offset += len(chunk)
+            remaining -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0 or not last})
+        if count == 0 and last:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import re
+
+import aiohttp
+
+from http_pool import HttpPool
+from segmented_download import DownloadError
+import metrics
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+# Statuses meaning the signed URL itself is dead (expired, other IP), not the connection
+STALE_STATUSES = (403, 410)
+RETRIES = int(os.getenv("RESUME_RETRIES", "4"))
+
+
+class UpstreamClosed(DownloadError):
+    pass
+
+
+class UrlRefresher:
+    """
+    Fresh URL for one media stream once its signed googlevideo URL stops working
+    (403/410: expired or bound to another IP). `resolve(itag)` re-runs the engine race
+    with the cache bypassed and returns the URL of the same itag, so the transfer can
+    continue at its byte offset instead of starting over.
+    Concurrent callers (parallel segments hitting the same 403) share one refresh.
+    """
+    MAX_REFRESHES = int(os.getenv("URL_REFRESH_MAX", "3"))
+
+    def __init__(self, resolve, url, itag=None):
+        self.resolve = resolve
+        self.url = url
+        self.itag = itag
+        self.refreshes = 0
+        self._lock = asyncio.Lock()
+
+    async def __call__(self, stale_url):
+        async with self._lock:
+            if self.url != stale_url:
+                # Somebody already refreshed while we were waiting
+                return self.url
+            if self.refreshes >= self.MAX_REFRESHES:
+                raise DownloadError(f"Stream URL still rejected after {self.refreshes} refreshes")
+            self.refreshes += 1
+            print(f"[Resume] Re-resolving stream URL (itag {self.itag or 'best'}, attempt {self.refreshes})")
+            with metrics.span("url_refresh", itag=self.itag):
+                try:
+                    fresh = await self.resolve(self.itag)
+                except Exception as e:
+                    print(f"[Resume] Refresh failed: {e}")
+                    fresh = None
+            metrics.URL_REFRESHES.inc(result="ok" if fresh else "failed")
+            if not fresh:
+                raise DownloadError(f"Could not refresh the stream URL for itag {self.itag or 'best'}")
+            self.url = fresh
+            return fresh
+
+
+def content_total(resp):
+    """Full entity size from Content-Range ('bytes 0-99/1234' -> 1234), or None."""
+    match = re.search(r"/(\d+)\s*$", resp.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+
+async def iter_resumable(url, headers=None, proxy=None, start=0, end=None, refresh=None,
+                         response=None, chunk_size=256 * 1024, path="pipe"):
+    """
+    Yields bytes start..end (inclusive; end=None for the rest) of `url`, surviving failures:
+    - dropped connection / read timeout: reconnects with Range from the last byte received
+    - 403/410: asks `refresh` (a UrlRefresher) for a new URL and continues at the same offset
+    `response` is an already opened response for `start` to drain first (e.g. /proxy's).
+    Raises DownloadError when retries run out or a refreshed URL points at different content.
+    """
+    headers = dict(headers or {})
+    offset = start
+    total = None
+    failures = 0
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=60)
+    while True:
+        try:
+            if response is None:
+                session = await HttpPool.for_proxy(proxy)
+                wanted = f"bytes={offset}-{'' if end is None else end}"
+                response = await session.get(url, headers=dict(headers, Range=wanted), proxy=proxy, timeout=timeout)
+            resp, response = response, None
+            try:
+                if resp.status in STALE_STATUSES and refresh is not None:
+                    failures += 1
+                    if failures > RETRIES:
+                        raise DownloadError(f"Upstream kept answering {resp.status}")
+                    url = await refresh(url)
+                    continue
+                if resp.status == 416 and end is None and total is not None and offset >= total:
+                    return
+                if resp.status not in (200, 206):
+                    raise DownloadError(f"YouTube stream error: {resp.status}")
+
+                skip = 0
+                if resp.status == 206:
+                    seen = content_total(resp)
+                    if total is not None and seen is not None and seen != total:
+                        raise DownloadError(f"Resumed stream has a different size ({seen} != {total})")
+                    total = seen or total
+                else:
+                    # Range ignored (or never sent): the whole entity, minus what we already have
+                    skip = offset
+                    total = total or int(resp.headers.get("Content-Length", 0)) or None
+
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    if skip:
+                        drop = min(skip, len(chunk))
+                        chunk = chunk[drop:]
+                        skip -= drop
+                        if not chunk: continue
+                    if end is not None:
+                        chunk = chunk[:end + 1 - offset]
+                    offset += len(chunk)
+                    failures = 0
+                    yield chunk
+                    if end is not None and offset > end:
+                        return
+                if end is None and (total is None or offset >= total):
+                    return
+                if end is not None and offset > end:
+                    return
+                raise UpstreamClosed(f"Upstream closed early at byte {offset}")
+            finally:
+                resp.release()
+        except (aiohttp.ClientError, asyncio.TimeoutError, UpstreamClosed) as e:
+            failures += 1
+            if failures > RETRIES:
+                raise DownloadError(f"Transfer failed at byte {offset}: {e}")
+            metrics.RESUMES.inc(path=path)
+            print(f"[Resume] {type(e).__name__} at byte {offset}, reconnecting ({failures}/{RETRIES})")
+            await asyncio.sleep(min(2 ** (failures - 1) * 0.5, 8))
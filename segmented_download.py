@@ -0,0 +1,359 @@
+import asyncio
+import fcntl
+import json
+import os
+import re
+import tempfile
+import time
+from collections import deque
+
+import aiohttp
+
+from http_pool import HttpPool
+import metrics
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+class DownloadError(Exception):
+    pass
+
+
+# Staged downloads named by stream (video id + itag + segment size) rather than by task,
+# so a retried task finds the earlier attempt's file and '.state' and resumes it
+STAGING_DIR = os.getenv("DOWNLOAD_STAGING_DIR", os.path.join(tempfile.gettempdir(), "yt-staging"))
+# Partial downloads nobody retried are swept after this long
+STAGING_MAX_AGE = float(os.getenv("DOWNLOAD_STAGING_MAX_AGE", "21600"))
+
+
+def staging_path(video_id, itag, segment_size=None):
+    segment_size = segment_size or SegmentedDownloader.SEGMENT_SIZE
+    return os.path.join(STAGING_DIR, f"raw-{video_id}-{itag}-{segment_size // 1024}k")
+
+
+def claim_staging(path):
+    """
+    Locks the staging file at `path` for one builder (creating it if needed) and returns
+    the lock's fd, or None if another build of the same stream holds it right now.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # A finished build may have unlinked the path between our open and flock
+        if os.fstat(fd).st_ino == os.stat(path).st_ino:
+            return fd
+    except (BlockingIOError, FileNotFoundError):
+        pass
+    os.close(fd)
+    return None
+
+
+def release_staging(fd):
+    try: os.close(fd)   # closing drops the flock
+    except OSError: pass
+
+
+def sweep_staging(max_age=None):
+    """Deletes staging files (and their '.state') that nobody holds and nobody touched in `max_age` seconds."""
+    max_age = STAGING_MAX_AGE if max_age is None else max_age
+    try: names = os.listdir(STAGING_DIR)
+    except FileNotFoundError: return 0
+    now = time.time()
+    removed = 0
+    for name in names:
+        if name.endswith((".state", ".tmp")):
+            continue
+        path = os.path.join(STAGING_DIR, name)
+        try:
+            if now - os.stat(path).st_mtime <= max_age:
+                continue
+            fd = claim_staging(path)
+        except FileNotFoundError:
+            continue
+        if fd is None:
+            continue
+        try:
+            for stale in (path, path + ".state"):
+                try: os.unlink(stale)
+                except FileNotFoundError: pass
+            removed += 1
+        finally:
+            release_staging(fd)
+    return removed
+
+
+class SegmentedDownloader:
+    """
+    Parallel HTTP Range downloader.
+    googlevideo throttles each connection, so the file is split into fixed-size
+    segments fetched over N connections and written in place (pwrite) into a
+    preallocated file. Failed segments are retried on their own from the last
+    written byte, and a sidecar '.state' file lets a later run against the same `dest`
+    resume (it's left in place when done; the caller deletes `dest` + '.state').
+    stream() yields the same segments in order instead, for piping into FFmpeg.
+    `refresh` (a resumable.UrlRefresher) swaps in a re-resolved URL when the signed one
+    expires (403/410) so segments carry on from their offset instead of failing the job.
+    """
+    CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", "4"))
+    SEGMENT_SIZE = int(float(os.getenv("DOWNLOAD_SEGMENT_MB", "8")) * 1024 * 1024)
+    RETRIES = int(os.getenv("DOWNLOAD_SEGMENT_RETRIES", "4"))
+    CHUNK = 256 * 1024
+
+    def __init__(self, url, dest=None, headers=None, proxy=None, on_progress=None, connections=None, segment_size=None, refresh=None):
+        self.url = url
+        self.dest = dest
+        self.headers = dict(headers or {})
+        self.proxy = proxy
+        self.on_progress = on_progress
+        self.refresh = refresh
+        self.connections = max(1, connections or self.CONNECTIONS)
+        self.segment_size = max(256 * 1024, segment_size or self.SEGMENT_SIZE)
+        self.state_file = dest + ".state" if dest else None
+        self._state_lock = asyncio.Lock()
+        self.total = 0
+        self.downloaded = 0
+        # Bytes held by stream()'s prefetch window (for per-stream memory accounting)
+        self.buffered = 0
+
+    async def run(self):
+        """Downloads to `dest` and returns the size in bytes."""
+        started = time.monotonic()
+        with metrics.span("download", connections=self.connections) as span:
+            size = await self._run()
+            span.set(bytes=size)
+        self._record("file", self.downloaded, time.monotonic() - started)
+        return size
+
+    def _record(self, path, size, elapsed):
+        metrics.DOWNLOAD_BYTES.inc(size, path=path)
+        if size and elapsed > 0:
+            metrics.DOWNLOAD_THROUGHPUT.observe(size / elapsed, path=path)
+
+    async def _run(self):
+        session = await HttpPool.for_proxy(self.proxy)
+        total = await self._probe(session)
+        if not total:
+            # Upstream ignores Range: plain single-connection download
+            return await self._single(session)
+
+        self.total = total
+        done = self._load_state(total)
+        segments = [
+            (idx, start, min(start + self.segment_size, total) - 1)
+            for idx, start in enumerate(range(0, total, self.segment_size))
+        ]
+        self.downloaded = sum(end - start + 1 for idx, start, end in segments if idx in done)
+        if done: print(f"[Segment] Resuming {self.dest}: {len(done)}/{len(segments)} segments already on disk")
+        self._report()
+
+        fd = os.open(self.dest, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self._preallocate(fd, total)
+            queue = asyncio.Queue()
+            for seg in segments:
+                if seg[0] not in done: queue.put_nowait(seg)
+
+            async def worker():
+                while True:
+                    try: idx, start, end = queue.get_nowait()
+                    except asyncio.QueueEmpty: return
+                    await self._segment(session, start, end, lambda offset, chunk: os.pwrite(fd, chunk, offset))
+                    done.add(idx)
+                    await self._save_state(total, done)
+
+            workers = [asyncio.ensure_future(worker()) for _ in range(min(self.connections, queue.qsize() or 1))]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for w in workers:
+                    if not w.done(): w.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            os.close(fd)
+        return total
+
+    async def _probe(self, session):
+        """Returns the total size if the server honours Range requests, else None."""
+        headers = dict(self.headers, Range="bytes=0-0")
+        while True:
+            async with session.get(self.url, headers=headers, proxy=self.proxy, timeout=30) as resp:
+                if await self._refreshed(resp):
+                    continue
+                if resp.status >= 400:
+                    raise DownloadError(f"YouTube stream error: {resp.status}")
+                if resp.status != 206:
+                    return None
+                match = re.search(r"/(\d+)", resp.headers.get("Content-Range", ""))
+                return int(match.group(1)) if match else None
+
+    async def _refreshed(self, resp):
+        """True if `resp` says the signed URL is dead and a fresh one is now in self.url."""
+        if resp.status not in (403, 410) or self.refresh is None:
+            return False
+        # The refresher raises DownloadError once it runs out of attempts
+        self.url = await self.refresh(self.url)
+        return True
+
+    async def stream(self):
+        """
+        Yields the file in order while up to `connections` segments download ahead.
+        Feeds FFmpeg's stdin without staging on disk; memory is bounded by
+        connections x segment_size.
+        """
+        session = await HttpPool.for_proxy(self.proxy)
+        started = time.monotonic()
+        chunks = self._stream(session)
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            # Close explicitly so the prefetch tasks are cancelled now, not at garbage collection
+            await chunks.aclose()
+            self._record("pipe", self.downloaded, time.monotonic() - started)
+
+    async def _stream(self, session):
+        total = await self._probe(session)
+        if not total:
+            async for chunk in self._single_stream(session, "pipe"):
+                yield chunk
+            return
+
+        self.total = total
+        self.downloaded = 0
+        segments = iter(range(0, total, self.segment_size))
+
+        async def fetch(start):
+            end = min(start + self.segment_size, total) - 1
+            buf = bytearray(end - start + 1)
+            self.buffered += len(buf)
+            def write(offset, chunk):
+                buf[offset - start:offset - start + len(chunk)] = chunk
+            try:
+                await self._segment(session, start, end, write)
+            except BaseException:
+                self.buffered -= len(buf)
+                raise
+            return buf
+
+        pending = deque()
+        buf = None
+        try:
+            for _ in range(self.connections):
+                start = next(segments, None)
+                if start is None: break
+                pending.append(asyncio.ensure_future(fetch(start)))
+            while pending:
+                buf = await pending.popleft()
+                # Refill before handing data out so the network keeps working while the consumer writes
+                start = next(segments, None)
+                if start is not None:
+                    pending.append(asyncio.ensure_future(fetch(start)))
+                yield buf
+                self.buffered -= len(buf)
+                buf = None
+        finally:
+            for task in pending: task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            # Segments fetched but never handed out (the consumer left early) no longer count
+            if buf is not None:
+                self.buffered -= len(buf)
+            for task in pending:
+                if not task.cancelled() and task.exception() is None:
+                    self.buffered -= len(task.result())
+
+    async def _segment(self, session, start, end, write):
+        offset = start
+        for attempt in range(self.RETRIES + 1):
+            try:
+                headers = dict(self.headers, Range=f"bytes={offset}-{end}")
+                async with session.get(self.url, headers=headers, proxy=self.proxy, timeout=aiohttp.ClientTimeout(total=None, sock_read=30)) as resp:
+                    if await self._refreshed(resp):
+                        raise DownloadError(f"Stream URL expired ({resp.status}), refreshed")
+                    if resp.status != 206:
+                        raise DownloadError(f"YouTube stream error: {resp.status}")
+                    match = re.search(r"/(\d+)", resp.headers.get("Content-Range", ""))
+                    if self.total and match and int(match.group(1)) != self.total:
+                        # A refreshed URL for a different encode would corrupt the file
+                        raise DownloadError(f"Stream size changed ({match.group(1)} != {self.total})")
+                    async for chunk in resp.content.iter_chunked(self.CHUNK):
+                        chunk = chunk[:end + 1 - offset]
+                        write(offset, chunk)
+                        offset += len(chunk)
+                        self.downloaded += len(chunk)
+                        self._report()
+                        if offset > end: break
+                if offset > end:
+                    return
+                raise DownloadError(f"Segment {start}-{end} ended early at {offset}")
+            except (aiohttp.ClientError, asyncio.TimeoutError, DownloadError) as e:
+                if attempt >= self.RETRIES or "size changed" in str(e):
+                    raise DownloadError(f"Segment {start}-{end} failed: {e}")
+                print(f"[Segment] Retry {attempt + 1} for {start}-{end} from {offset}: {e}")
+                await asyncio.sleep(min(2 ** attempt * 0.5, 8))
+
+    async def _single_stream(self, session, path):
+        # Imported here: resumable imports DownloadError from this module
+        from resumable import iter_resumable
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=60)
+        while True:
+            resp = await session.get(self.url, headers=self.headers, proxy=self.proxy, timeout=timeout)
+            if not await self._refreshed(resp):
+                break
+            resp.release()
+        if resp.status >= 400:
+            resp.release()
+            raise DownloadError(f"YouTube stream error: {resp.status}")
+        self.total = int(resp.headers.get('content-length', 0))
+        self.downloaded = 0
+        # Like the segmented path: drops reconnect, a URL expiring mid-transfer gets refreshed
+        body = iter_resumable(
+            self.url, self.headers, self.proxy, refresh=self.refresh, response=resp,
+            chunk_size=1024 * 1024, path=path
+        )
+        try:
+            async for chunk in body:
+                self.downloaded += len(chunk)
+                self._report()
+                yield chunk
+        finally:
+            await body.aclose()
+
+    async def _single(self, session):
+        with open(self.dest, "wb") as f:
+            async for chunk in self._single_stream(session, "file"):
+                f.write(chunk)
+        return self.downloaded
+
+    def _preallocate(self, fd, total):
+        if os.fstat(fd).st_size == total:
+            return
+        try: os.posix_fallocate(fd, 0, total)
+        except (AttributeError, OSError): os.ftruncate(fd, total)
+
+    def _load_state(self, total):
+        """Segment indices finished by an earlier run against the same file."""
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            if state.get("total") == total and state.get("segment_size") == self.segment_size and os.path.exists(self.dest):
+                return set(state.get("done", []))
+        except: pass
+        return set()
+
+    async def _save_state(self, total, done):
+        # Off the event loop; the lock keeps segment workers from interleaving writes
+        state = {"total": total, "segment_size": self.segment_size, "done": sorted(done)}
+        async with self._state_lock:
+            await asyncio.to_thread(self._write_state, state)
+
+    def _write_state(self, state):
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_file)
+
+    def _report(self):
+        if self.on_progress and self.total:
+            self.on_progress(self.downloaded, self.total)
@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+
+from innertube import parse_player
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# Long-lived headless Chrome per executor thread, recycled after MAX_USES pages or on error
+MAX_USES = int(os.getenv("SELENIUM_MAX_USES", "50"))
+
+_local = threading.local()
+_drivers = []
+_drivers_lock = threading.Lock()
+
+
+def _new_driver():
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    chrome_options = Options()
+    chrome_options.add_argument("--headless")
+    chrome_options.add_argument("--no-sandbox")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    driver = webdriver.Chrome(options=chrome_options)
+    with _drivers_lock:
+        _drivers.append(driver)
+    return driver
+
+
+def _release(driver):
+    with _drivers_lock:
+        if driver in _drivers:
+            _drivers.remove(driver)
+    try: driver.quit()
+    except: pass
+
+
+def _thread_driver():
+    driver = getattr(_local, "driver", None)
+    if driver is not None and _local.uses >= MAX_USES:
+        _release(driver)
+        driver = None
+    if driver is None:
+        driver = _local.driver = _new_driver()
+        _local.uses = 0
+    _local.uses += 1
+    return driver
+
+
+def warm():
+    """Pre-launches the calling thread's driver (not counted as a use towards MAX_USES)."""
+    if getattr(_local, "driver", None) is None:
+        _local.driver = _new_driver()
+        _local.uses = 0
+
+
+def quit_all():
+    with _drivers_lock:
+        drivers = list(_drivers)
+    for driver in drivers:
+        _release(driver)
+
+
+def scrape(url, cancel_event=None):
+    if cancel_event is not None and cancel_event.is_set(): return None
+    driver = _thread_driver()
+    try:
+        driver.get(url)
+        # Interruptible settle time: bail out as soon as the race is lost
+        if cancel_event is not None and cancel_event.wait(5):
+            driver.get("about:blank")
+            return None
+        data_json = driver.execute_script("return JSON.stringify(window.ytInitialPlayerResponse);")
+        # Leave the tab idle between calls so the player stops buffering
+        driver.get("about:blank")
+    except Exception:
+        # A wedged browser is dropped; the next call on this thread starts a fresh one
+        _release(driver)
+        _local.driver = None
+        raise
+    if data_json:
+        return parse_player(json.loads(data_json), "selenium")
+    return None
@@ -0,0 +1,51 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Request coalescing: concurrent callers with the same key share one in-flight call.
+    The shared work runs as its own task, so a caller that disconnects does not
+    cancel the lookup for everybody else waiting on it; once the last waiter is gone
+    the work is cancelled too (nobody is left to use the result).
+    """
+    def __init__(self):
+        self._inflight = {}     # key -> [task, waiters]
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    async def do(self, key, coro_fn):
+        entry = self._inflight.get(key)
+        if entry is not None:
+            self.coalesced += 1
+        else:
+            self.leaders += 1
+            entry = self._inflight[key] = [asyncio.ensure_future(coro_fn()), 0]
+            entry[0].add_done_callback(lambda _t, k=key, e=entry: self._forget(k, e))
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if not entry[1] and not task.done():
+                # Last waiter left: stop the work, and let the next caller start afresh
+                self.abandoned += 1
+                self._forget(key, entry)
+                task.cancel()
+
+    def running(self, key):
+        """True if a call for `key` is in flight (a new caller would join it)."""
+        return key in self._inflight
+
+    def _forget(self, key, entry):
+        if self._inflight.get(key) is entry:
+            del self._inflight[key]
+
+    def stats(self):
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
@@ -0,0 +1,291 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+from starlette.responses import Response
+
+from cancellation import cancel_all
+import metrics
+from ffmpeg_runner import PipeInput, tuning_args, scheduler as ffmpeg_scheduler
+from resumable import iter_resumable
+from segmented_download import SegmentedDownloader
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+class StreamIdle(Exception):
+    pass
+
+
+class StreamPipeline:
+    """
+    upstream -> ffmpeg -> client, with every stage bounded.
+    - ffmpeg stdout is pulled into a buffer until HIGH_WATER bytes and paused until the
+      client drains it to LOW_WATER, so a slow client stalls ffmpeg (and, through the
+      pipes, the upstream download) instead of growing memory
+    - adaptive inputs prefetch CONNECTIONS x SEGMENT_KB at most
+    - nothing moving for IDLE_TIMEOUT seconds (upstream or client) tears the stream down
+    - close() kills ffmpeg, cancels the downloads and frees the scheduler slot at once
+    - an upstream 403/drop mid-stream resumes at the byte offset (`refreshers`, one per
+      source, re-resolve expired URLs) so ffmpeg never sees a gap
+    """
+    HIGH_WATER = int(os.getenv("STREAM_HIGH_WATER_KB", "1024")) * 1024
+    LOW_WATER = int(os.getenv("STREAM_LOW_WATER_KB", "256")) * 1024
+    IDLE_TIMEOUT = float(os.getenv("STREAM_IDLE_TIMEOUT", "30"))
+    CONNECTIONS = int(os.getenv("STREAM_CONNECTIONS", "2"))
+    SEGMENT_SIZE = int(os.getenv("STREAM_SEGMENT_KB", "1024")) * 1024
+    READ_CHUNK = 64 * 1024
+    SEND_CHUNK = 256 * 1024
+
+    def __init__(self, sources, out_args, proxy=None, headers=None, refreshers=None):
+        self.sources = sources
+        self.refreshers = refreshers or [None] * len(sources)
+        self.out_args = out_args
+        self.proxy = proxy
+        self.headers = headers or {}
+        self.process = None
+        self.slot = None
+        self.pipes = []
+        self.downloaders = []
+        self.workers = []
+        self.tail = deque(maxlen=15)
+        self.out = deque()
+        self.out_bytes = 0
+        self.in_flight = 0
+        self.peak = 0
+        self.eof = False
+        self.closed = False
+        self.started = None
+        self.upstream_bytes = 0
+        self._readable = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+
+    async def start(self):
+        """Waits for a live FFmpeg slot and starts ffmpeg plus its feeders."""
+        queued = time.monotonic()
+        with metrics.span("ffmpeg_queue", priority="live"):
+            self.slot = await ffmpeg_scheduler.acquire("live")
+        self.started = time.monotonic()
+        metrics.FFMPEG_WAIT.observe(self.started - queued, priority="live")
+        _active.add(self)
+        try:
+            if len(self.sources) > 1:
+                # Adaptive: each input gets its own pipe and a small prefetch window
+                self.downloaders = [
+                    SegmentedDownloader(src, headers=self.headers, proxy=self.proxy, refresh=refresh,
+                                        connections=self.CONNECTIONS, segment_size=self.SEGMENT_SIZE)
+                    for src, refresh in zip(self.sources, self.refreshers)
+                ]
+                self.pipes = [PipeInput(d.stream()) for d in self.downloaders]
+            input_args = [arg for p in self.pipes for arg in ("-i", p.arg)] or ["-i", "pipe:0"]
+            self.process = await asyncio.create_subprocess_exec(
+                "ffmpeg", *input_args, *tuning_args(self.out_args, "live"), *self.out_args,
+                stdin=asyncio.subprocess.DEVNULL if self.pipes else asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                pass_fds=[p.read_fd for p in self.pipes]
+            )
+            for p in self.pipes: p.spawned()
+        except BaseException:
+            await self.close()
+            raise
+
+        self.workers = [asyncio.ensure_future(self._read_stderr()), asyncio.ensure_future(self._read_output())]
+        if self.pipes:
+            self.workers.extend(asyncio.ensure_future(p.pump()) for p in self.pipes)
+        else:
+            self.workers.append(asyncio.ensure_future(self._write_stdin()))
+
+    async def ready(self):
+        """
+        True once ffmpeg produced output; False if it exited without any (see error()).
+        Raises StreamIdle if neither happens within IDLE_TIMEOUT (stalled upstream, hung ffmpeg).
+        """
+        while not self.out and not self.eof:
+            self._readable.clear()
+            try:
+                await asyncio.wait_for(self._readable.wait(), self.IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise StreamIdle(f"no output for {self.IDLE_TIMEOUT:.0f}s")
+        if self.out:
+            return True
+        await self.process.wait()
+        # Let the stderr reader catch the last lines
+        await asyncio.wait(self.workers[:1], timeout=1)
+        return False
+
+    def error(self):
+        return f"ffmpeg exit {self.process.returncode}: " + " | ".join(list(self.tail)[-3:])
+
+    async def chunks(self):
+        """Output in up to SEND_CHUNK pieces; raises StreamIdle if ffmpeg stays silent too long."""
+        while True:
+            while not self.out:
+                if self.eof:
+                    return
+                self._readable.clear()
+                try:
+                    await asyncio.wait_for(self._readable.wait(), self.IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    raise StreamIdle(f"no output for {self.IDLE_TIMEOUT:.0f}s")
+            parts = []
+            size = 0
+            while self.out and size < self.SEND_CHUNK:
+                chunk = self.out.popleft()
+                parts.append(chunk)
+                size += len(chunk)
+            self.out_bytes -= size
+            if self.out_bytes <= self.LOW_WATER:
+                self._drained.set()
+            yield b"".join(parts)
+
+    async def _read_output(self):
+        try:
+            while True:
+                if self.out_bytes >= self.HIGH_WATER:
+                    # Client is behind: stop reading so ffmpeg blocks on its stdout pipe
+                    self._drained.clear()
+                    await self._drained.wait()
+                chunk = await self.process.stdout.read(self.READ_CHUNK)
+                if not chunk:
+                    break
+                self.out.append(chunk)
+                self.out_bytes += len(chunk)
+                self.peak = max(self.peak, self.memory())
+                self._readable.set()
+        finally:
+            self.eof = True
+            self._readable.set()
+
+    async def _read_stderr(self):
+        async for line in self.process.stderr:
+            self.tail.append(line.decode(errors="replace").rstrip())
+
+    async def _write_stdin(self):
+        stdin = self.process.stdin
+        try:
+            upstream = iter_resumable(self.sources[0], self.headers, self.proxy, refresh=self.refreshers[0],
+                                      chunk_size=self.READ_CHUNK, path="stream")
+            try:
+                async for chunk in upstream:
+                    self.in_flight = len(chunk)
+                    self.upstream_bytes += len(chunk)
+                    stdin.write(chunk)
+                    # Bounded by the pipe: blocks while ffmpeg (and so the client) is behind
+                    await stdin.drain()
+                    self.in_flight = 0
+            finally:
+                await upstream.aclose()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            print(f"[Stream Writer Error] {e}")
+        finally:
+            self.in_flight = 0
+            try: stdin.close()
+            except: pass
+            metrics.DOWNLOAD_BYTES.inc(self.upstream_bytes, path="pipe")
+
+    def memory(self):
+        """Bytes this stream holds in Python: output buffer + prefetched segments + chunk being written."""
+        return self.out_bytes + self.in_flight + sum(d.buffered for d in self.downloaders)
+
+    async def close(self):
+        """Immediate teardown (idempotent): ffmpeg, feeders, pipes, scheduler slot."""
+        if self.closed:
+            return
+        self.closed = True
+        _active.discard(self)
+        process = self.process
+        if process is not None and process.returncode is None:
+            try: process.kill()
+            except ProcessLookupError: pass
+        self._drained.set()
+        await cancel_all(self.workers)
+        if process is not None:
+            await process.wait()
+        for p in self.pipes: p.close()
+        if self.slot is not None:
+            self.slot.release()
+            code = process.returncode if process is not None else None
+            # Killed = torn down by us (client gone, idle), not a conversion failure
+            outcome = "ok" if code == 0 else "killed" if code is not None and code < 0 else "error"
+            metrics.FFMPEG_DURATION.observe(time.monotonic() - self.started, priority="live", outcome=outcome)
+        self.out.clear()
+        self.out_bytes = 0
+        _counters["peak_bytes"] = max(_counters["peak_bytes"], self.peak)
+
+
+class PipelineResponse(Response):
+    """
+    Sends a started StreamPipeline. Unlike StreamingResponse it watches for the client
+    disconnecting while a send is blocked, and gives up on a client that accepts
+    nothing for IDLE_TIMEOUT seconds; either way the pipeline is torn down right away.
+    """
+    def __init__(self, pipeline, media_type, headers=None):
+        self.pipeline = pipeline
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = None
+        self.raw_headers = [(b"content-type", media_type.encode("latin-1"))]
+        for key, value in (headers or {}).items():
+            self.headers[key] = value
+
+    async def __call__(self, scope, receive, send):
+        pipeline = self.pipeline
+
+        async def disconnected():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+
+        watcher = asyncio.ensure_future(disconnected())
+        sender = None
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            async for chunk in pipeline.chunks():
+                sender = asyncio.ensure_future(send({"type": "http.response.body", "body": chunk, "more_body": True}))
+                done, _ = await asyncio.wait({sender, watcher}, timeout=pipeline.IDLE_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+                if watcher in done:
+                    _counters["disconnects"] += 1
+                    return
+                if sender not in done:
+                    _counters["slow_clients"] += 1
+                    print(f"[Stream] Client accepted nothing for {pipeline.IDLE_TIMEOUT:.0f}s, dropping it")
+                    return
+                sender.result()
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            if await pipeline.process.wait() != 0:
+                print(f"[Stream] FFmpeg exited with {pipeline.error()}")
+        except StreamIdle as e:
+            _counters["idle_upstream"] += 1
+            print(f"[Stream] Upstream idle ({e}), closing")
+        finally:
+            await cancel_all([t for t in (watcher, sender) if t is not None])
+            await pipeline.close()
+
+
+# Pipelines alive in this worker, for /status
+_active = set()
+_counters = {"disconnects": 0, "slow_clients": 0, "idle_upstream": 0, "peak_bytes": 0}
+
+
+def stats():
+    memory = [p.memory() for p in _active]
+    return {
+        "active": len(memory),
+        "buffered_bytes": sum(memory),
+        "max_stream_bytes": max(memory, default=0),
+        "peak_stream_bytes": max([_counters["peak_bytes"], *(p.peak for p in _active)]),
+        "disconnects": _counters["disconnects"],
+        "slow_clients": _counters["slow_clients"],
+        "idle_upstream": _counters["idle_upstream"],
+    }
+
+
+@metrics.collector
+def _collect():
+    metrics.STREAMS_ACTIVE.set(len(_active))
+    metrics.STREAM_BUFFERED.set(sum(p.memory() for p in _active))
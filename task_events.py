@@ -0,0 +1,135 @@
+import asyncio
+import json
+import os
+import time
+
+from task_store import FINISHED
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+class Subscription:
+    """One /events client: latest unsent state per task (older ones are overwritten, never queued)."""
+    def __init__(self, task_ids):
+        self.task_ids = list(task_ids)
+        self.sent = {}
+        self.pending = {}
+        self.ready = asyncio.Event()
+
+    def offer(self, task_id, data):
+        if data is not None and self.sent.get(task_id) == data:
+            return
+        self.pending[task_id] = data
+        self.ready.set()
+
+    def take(self):
+        pending, self.pending = self.pending, {}
+        self.ready.clear()
+        self.sent.update(pending)
+        return pending
+
+
+class TaskEvents:
+    """
+    Push side of /events, instead of clients polling /task-status.
+    One loop per worker reads every watched task from the shared TaskStore in a single
+    batched query per tick, however many clients are connected, and hands each client
+    only what changed. Reading the store (not in-process state) is what makes it work
+    across gunicorn workers; writes made by this worker wake the loop early, but never
+    more often than MIN_INTERVAL, and a slow client just gets the latest state.
+    """
+    INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", "1"))
+    MIN_INTERVAL = float(os.getenv("EVENTS_MIN_INTERVAL", "0.25"))
+    HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", "15"))
+    MAX_TASKS = int(os.getenv("EVENTS_MAX_TASKS", "100"))
+
+    def __init__(self, store):
+        self.store = store
+        self.watchers = {}      # task_id -> set of Subscription
+        self._wake = asyncio.Event()
+        self._loop = None
+        self.ticks = 0
+        store.listeners.append(self.notify)
+
+    def notify(self, task_id):
+        if task_id in self.watchers:
+            self._wake.set()
+
+    def subscribe(self, task_ids):
+        sub = Subscription(task_ids)
+        for task_id in sub.task_ids:
+            self.watchers.setdefault(task_id, set()).add(sub)
+        if self._loop is None or self._loop.done():
+            self._loop = asyncio.ensure_future(self._run())
+        self._wake.set()
+        return sub
+
+    def unsubscribe(self, sub, task_ids=None):
+        for task_id in task_ids or sub.task_ids:
+            subs = self.watchers.get(task_id)
+            if subs is None: continue
+            subs.discard(sub)
+            if not subs: del self.watchers[task_id]
+
+    async def _run(self):
+        while self.watchers:
+            started = time.monotonic()
+            self._wake.clear()
+            ids = list(self.watchers)
+            try:
+                states = await self.store.get_many(ids)
+                self.ticks += 1
+                for task_id in ids:
+                    for sub in list(self.watchers.get(task_id, ())):
+                        sub.offer(task_id, states.get(task_id))
+            except Exception as e:
+                print(f"[Events] Poll failed: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            # Coalesce bursts of local writes into one read
+            spent = time.monotonic() - started
+            if spent < self.MIN_INTERVAL:
+                await asyncio.sleep(self.MIN_INTERVAL - spent)
+
+    async def stream(self, task_ids):
+        """
+        SSE body for `task_ids`: a `progress`, `status`, `completed` or `error` event per
+        change (data = the task record plus task_id), `: ping` comments while idle, and
+        the end of the stream once every task has finished or turned out not to exist.
+        """
+        sub = self.subscribe(task_ids)
+        open_ids = set(sub.task_ids)
+        try:
+            yield "retry: 3000\n\n"
+            while open_ids:
+                try:
+                    await asyncio.wait_for(sub.ready.wait(), self.HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                previous = dict(sub.sent)
+                for task_id, data in sub.take().items():
+                    if data is None:
+                        event, data = "error", {"status": "error", "error": "Task not found"}
+                    elif data["status"] in FINISHED:
+                        event = data["status"]
+                    elif data["status"] != (previous.get(task_id) or {}).get("status"):
+                        event = "status"
+                    else:
+                        event = "progress"
+                    yield f"event: {event}\ndata: {json.dumps(dict(data, task_id=task_id))}\n\n"
+                    if event in ("completed", "error"):
+                        open_ids.discard(task_id)
+                        self.unsubscribe(sub, [task_id])
+        finally:
+            self.unsubscribe(sub)
+
+    def stats(self):
+        return {
+            "watched_tasks": len(self.watchers),
+            "clients": len({sub for subs in self.watchers.values() for sub in subs}),
+            "polls": self.ticks,
+        }
@@ -0,0 +1,398 @@
+import asyncio
+import glob
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+load_dotenv()
+
+FINISHED = ("completed", "error")
+
+DEFAULTS = {"status": "starting", "progress": 0, "file": None, "error": None, "queue_position": None}
+
+
+class SQLiteTaskBackend:
+    """
+    Task rows in a WAL-mode SQLite file shared by every gunicorn worker on the host.
+    Field updates are merged with json_patch inside one statement, so concurrent
+    writers never lose each other's fields.
+    """
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "id TEXT PRIMARY KEY, data TEXT NOT NULL, status TEXT NOT NULL, "
+                "slot INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks(status, updated)")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try: yield db
+        finally: db.close()
+
+    def create(self, task_id, data):
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO tasks (id, data, status, created, updated) VALUES (?, ?, ?, ?, ?)",
+                (task_id, json.dumps(data), data.get("status", "starting"), now, now)
+            )
+
+    def get(self, task_id):
+        with self._connect() as db:
+            row = db.execute("SELECT data FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, task_ids):
+        found = {}
+        with self._connect() as db:
+            # Stay under SQLite's bound-parameter limit
+            for i in range(0, len(task_ids), 500):
+                chunk = task_ids[i:i + 500]
+                rows = db.execute(f"SELECT id, data FROM tasks WHERE id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                found.update((row[0], json.loads(row[1])) for row in rows)
+        return found
+
+    def update(self, task_id, fields, only_unfinished=False):
+        # json_patch treats null as 'remove key', so nulls are set with json_set in the same
+        # statement (one statement = the only_unfinished check and the write are atomic)
+        patch = json.dumps({k: v for k, v in fields.items() if v is not None})
+        nulls = [k for k, v in fields.items() if v is None]
+        data = "json_patch(data, ?)"
+        if nulls:
+            data = "json_set(%s, %s)" % (data, ", ".join(f"'$.{k}', json('null')" for k in nulls))
+        sql = f"UPDATE tasks SET data = {data}, updated = ?"
+        args = [patch, time.time()]
+        if "status" in fields:
+            sql += ", status = ?"
+            args.append(fields["status"])
+        sql += " WHERE id = ?"
+        args.append(task_id)
+        if only_unfinished:
+            sql += " AND status NOT IN (?, ?)"
+            args.extend(FINISHED)
+        with self._connect() as db:
+            db.execute(sql, args)
+
+    def claim_slot(self, task_id, limit, dead_before):
+        """Takes a slot unless `limit` are held; holders silent since `dead_before` lose theirs."""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("UPDATE tasks SET slot = 0 WHERE slot = 1 AND updated < ?", (dead_before,))
+                running = db.execute("SELECT COUNT(*) FROM tasks WHERE slot = 1").fetchone()[0]
+                if running >= limit:
+                    db.execute("COMMIT")
+                    return False
+                db.execute("UPDATE tasks SET slot = 1, updated = ? WHERE id = ?", (time.time(), task_id))
+                db.execute("COMMIT")
+                return True
+            except:
+                db.execute("ROLLBACK")
+                raise
+
+    def heartbeat(self, task_id):
+        with self._connect() as db:
+            db.execute("UPDATE tasks SET updated = ? WHERE id = ? AND slot = 1", (time.time(), task_id))
+
+    def release_slot(self, task_id):
+        with self._connect() as db:
+            db.execute("UPDATE tasks SET slot = 0 WHERE id = ?", (task_id,))
+
+    def expired(self, finished_before, stale_before):
+        """Finished tasks past their TTL plus unfinished ones nobody has touched in a long time."""
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT id, data FROM tasks WHERE (status IN (?, ?) AND updated < ?) OR updated < ?",
+                (*FINISHED, finished_before, stale_before)
+            ).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def delete(self, task_ids):
+        with self._connect() as db:
+            db.executemany("DELETE FROM tasks WHERE id = ?", [(t,) for t in task_ids])
+
+    def count(self, status=None):
+        with self._connect() as db:
+            if status:
+                return db.execute("SELECT COUNT(*) FROM tasks WHERE status = ?", (status,)).fetchone()[0]
+            return db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+
+# Lua scripts: each runs atomically on the server, so no read-then-write races between workers.
+# Field values are JSON; `status:<status>` sets of task ids back count(status).
+_FINISHED_LUA = " or ".join(f"old == '{json.dumps(s)}'" for s in FINISHED)
+
+# KEYS: task hash, index; ARGV: task id, now, only_unfinished (1/0), status set prefix, field, value, ...
+_UPDATE_LUA = f"""
+local old = redis.call('HGET', KEYS[1], 'status')
+if not old then return 0 end
+if ARGV[3] == '1' and ({_FINISHED_LUA}) then return 0 end
+for i = 5, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    if ARGV[i] == 'status' and ARGV[i + 1] ~= old then
+        redis.call('SREM', ARGV[4] .. cjson.decode(old), ARGV[1])
+        redis.call('SADD', ARGV[4] .. cjson.decode(ARGV[i + 1]), ARGV[1])
+    end
+end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+return 1
+"""
+
+# KEYS: slots; ARGV: task id, now, dead_before, limit
+_CLAIM_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[3])
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) and redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+return 1
+"""
+
+# KEYS: index, slots; ARGV: key prefix, status set prefix, task id, ...
+_DELETE_LUA = """
+for i = 3, #ARGV do
+    local key = ARGV[1] .. ARGV[i]
+    local status = redis.call('HGET', key, 'status')
+    if status then redis.call('SREM', ARGV[2] .. cjson.decode(status), ARGV[i]) end
+    redis.call('DEL', key)
+    redis.call('ZREM', KEYS[1], ARGV[i])
+    redis.call('ZREM', KEYS[2], ARGV[i])
+end
+return 1
+"""
+
+
+class RedisTaskBackend:
+    """
+    Redis hashes (optional dependency: `pip install redis`), one per task, a sorted
+    set of slot holders scored by their last heartbeat and a set of task ids per
+    status. Uses the synchronous client from worker threads.
+    """
+    def __init__(self, url, prefix="ytask:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.slots = prefix + "slots"
+        self.index = prefix + "index"
+        self.by_status = prefix + "status:"
+        self._update = self.client.register_script(_UPDATE_LUA)
+        self._claim = self.client.register_script(_CLAIM_LUA)
+        self._delete = self.client.register_script(_DELETE_LUA)
+
+    def _key(self, task_id):
+        return self.prefix + task_id
+
+    def create(self, task_id, data):
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.hset(self._key(task_id), mapping={k: json.dumps(v) for k, v in data.items()})
+        pipe.zadd(self.index, {task_id: now})
+        pipe.sadd(self.by_status + data.get("status", "starting"), task_id)
+        pipe.execute()
+
+    def get(self, task_id):
+        raw = self.client.hgetall(self._key(task_id))
+        if not raw:
+            return None
+        return {k.decode(): json.loads(v) for k, v in raw.items()}
+
+    def get_many(self, task_ids):
+        pipe = self.client.pipeline()
+        for task_id in task_ids:
+            pipe.hgetall(self._key(task_id))
+        return {
+            task_id: {k.decode(): json.loads(v) for k, v in raw.items()}
+            for task_id, raw in zip(task_ids, pipe.execute()) if raw
+        }
+
+    def update(self, task_id, fields, only_unfinished=False):
+        pairs = [item for k, v in fields.items() for item in (k, json.dumps(v))]
+        self._update(
+            keys=[self._key(task_id), self.index],
+            args=[task_id, time.time(), 1 if only_unfinished else 0, self.by_status, *pairs]
+        )
+
+    def claim_slot(self, task_id, limit, dead_before):
+        return bool(self._claim(keys=[self.slots], args=[task_id, time.time(), dead_before, limit]))
+
+    def heartbeat(self, task_id):
+        self.client.zadd(self.slots, {task_id: time.time()}, xx=True)
+
+    def release_slot(self, task_id):
+        self.client.zrem(self.slots, task_id)
+
+    def expired(self, finished_before, stale_before):
+        out = []
+        for raw_id in self.client.zrangebyscore(self.index, 0, finished_before):
+            task_id = raw_id.decode()
+            data = self.get(task_id) or {}
+            updated = self.client.zscore(self.index, task_id) or 0
+            if data.get("status") in FINISHED or updated < stale_before:
+                out.append((task_id, data))
+        return out
+
+    def delete(self, task_ids):
+        if not task_ids: return
+        self._delete(keys=[self.index, self.slots], args=[self.prefix, self.by_status, *task_ids])
+
+    def count(self, status=None):
+        if status:
+            return self.client.scard(self.by_status + status)
+        return self.client.zcard(self.index)
+
+
+class TaskStore:
+    """
+    Download task state shared across gunicorn workers.
+    - progress writes are throttled (PROGRESS_STEP percent or PROGRESS_INTERVAL seconds)
+    - MAX_RUNNING_DOWNLOADS caps concurrent downloads host-wide; slot holders heartbeat
+      every SLOT_HEARTBEAT seconds and a slot silent for SLOT_TIMEOUT (crashed worker) is
+      handed to the next claimer
+    - finished tasks and their files are removed after TASK_TTL seconds
+    """
+    MAX_RUNNING = int(os.getenv("MAX_RUNNING_DOWNLOADS", "8"))
+    TTL = int(os.getenv("TASK_TTL", "3600"))
+    STALE = int(os.getenv("TASK_STALE", "7200"))
+    SLOT_HEARTBEAT = float(os.getenv("SLOT_HEARTBEAT", "15"))
+    SLOT_TIMEOUT = float(os.getenv("SLOT_TIMEOUT", "60"))
+    PROGRESS_STEP = float(os.getenv("PROGRESS_STEP", "1"))
+    PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "0.5"))
+
+    def __init__(self, backend=None):
+        self.backend = backend or self._backend_from_env()
+        self._last_progress = {}
+        self._pending = {}
+        self._flushing = set()
+        self._heartbeats = {}
+        # Called with the task id after every write this worker makes (see task_events)
+        self.listeners = []
+
+    def _backend_from_env(self):
+        if os.getenv("TASK_STORE_BACKEND", "sqlite").lower() == "redis":
+            try:
+                return RedisTaskBackend(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+            except Exception as e:
+                print(f"[Tasks] Redis unavailable ({e}), falling back to SQLite")
+        path = os.getenv("TASK_STORE_PATH", os.path.join(tempfile.gettempdir(), "yt-tasks.sqlite"))
+        return SQLiteTaskBackend(path)
+
+    async def create(self, task_id, **fields):
+        data = dict(DEFAULTS, **fields)
+        await asyncio.to_thread(self.backend.create, task_id, data)
+        return data
+
+    async def get(self, task_id):
+        data = await asyncio.to_thread(self.backend.get, task_id)
+        return dict(DEFAULTS, **data) if data is not None else None
+
+    async def get_many(self, task_ids):
+        """{task_id: data} for the ids that exist, in one backend round trip."""
+        if not task_ids:
+            return {}
+        found = await asyncio.to_thread(self.backend.get_many, list(task_ids))
+        return {task_id: dict(DEFAULTS, **data) for task_id, data in found.items()}
+
+    async def update(self, task_id, **fields):
+        if fields.get("status") in FINISHED:
+            self._last_progress.pop(task_id, None)
+        await asyncio.to_thread(self.backend.update, task_id, fields)
+        self._changed(task_id)
+
+    def _changed(self, task_id):
+        for listener in self.listeners:
+            listener(task_id)
+
+    def progress(self, task_id, value):
+        """
+        Non-blocking, throttled progress report (safe to call on every chunk).
+        Writes are skipped unless progress moved PROGRESS_STEP or PROGRESS_INTERVAL passed.
+        """
+        now = time.monotonic()
+        last = self._last_progress.get(task_id)
+        if last and value < 100 and value - last[0] < self.PROGRESS_STEP and now - last[1] < self.PROGRESS_INTERVAL:
+            return
+        if last and value == last[0]:
+            return
+        self._last_progress[task_id] = (value, now)
+        self._write_behind(task_id, progress=value)
+
+    def queue_position(self, task_id, position, status="queued"):
+        """Non-blocking report of the task's place in the FFmpeg queue; position None = running as `status`."""
+        self._write_behind(task_id, status=status, queue_position=position)
+
+    def _write_behind(self, task_id, **fields):
+        # One writer per task: later fields merge into queued ones instead of racing them
+        self._pending.setdefault(task_id, {}).update(fields)
+        if task_id not in self._flushing:
+            self._flushing.add(task_id)
+            asyncio.ensure_future(self._flush(task_id))
+
+    async def _flush(self, task_id):
+        try:
+            while task_id in self._pending:
+                fields = self._pending.pop(task_id)
+                await asyncio.to_thread(self.backend.update, task_id, fields, True)
+                self._changed(task_id)
+        except Exception as e:
+            self._pending.pop(task_id, None)
+            print(f"[Tasks] Progress write failed: {e}")
+        finally:
+            self._flushing.discard(task_id)
+
+    async def acquire_slot(self, task_id, poll=1.0):
+        """Waits (as 'queued') until one of the MAX_RUNNING_DOWNLOADS slots is free."""
+        queued = False
+        while not await asyncio.to_thread(self.backend.claim_slot, task_id, self.MAX_RUNNING, time.time() - self.SLOT_TIMEOUT):
+            if not queued:
+                await self.update(task_id, status="queued")
+                queued = True
+            await asyncio.sleep(poll)
+        self._heartbeats[task_id] = asyncio.ensure_future(self._heartbeat(task_id))
+
+    async def _heartbeat(self, task_id):
+        while True:
+            await asyncio.sleep(self.SLOT_HEARTBEAT)
+            try:
+                await asyncio.to_thread(self.backend.heartbeat, task_id)
+            except Exception as e:
+                print(f"[Tasks] Slot heartbeat failed: {e}")
+
+    async def release_slot(self, task_id):
+        heartbeat = self._heartbeats.pop(task_id, None)
+        if heartbeat: heartbeat.cancel()
+        await asyncio.to_thread(self.backend.release_slot, task_id)
+
+    async def cleanup(self):
+        """Drops expired tasks and deletes their output and leftover temp files."""
+        now = time.time()
+        expired = await asyncio.to_thread(self.backend.expired, now - self.TTL, now - self.STALE)
+        if not expired:
+            return 0
+        for task_id, data in expired:
+            paths = glob.glob(os.path.join(tempfile.gettempdir(), f"raw-{task_id}*"))
+            # Shared artifact-cache files are evicted by the cache, not per task
+            if data.get("file") and not data.get("cached"): paths.append(data["file"])
+            for path in paths:
+                try: os.unlink(path)
+                except: pass
+            self._last_progress.pop(task_id, None)
+        await asyncio.to_thread(self.backend.delete, [t for t, _ in expired])
+        return len(expired)
+
+    async def cleanup_loop(self, interval=60):
+        while True:
+            try:
+                removed = await self.cleanup()
+                if removed: print(f"[Tasks] Cleaned up {removed} expired tasks")
+            except Exception as e:
+                print(f"[Tasks] Cleanup error: {e}")
+            await asyncio.sleep(interval)
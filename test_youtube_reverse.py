@@ -0,0 +1,64 @@
+"""Race outcomes for YouTubeReverse with stubbed engines (no network)."""
+import asyncio
+
+import pytest
+
+from youtube_reverse import YouTubeReverse
+
+URL = "https://www.youtube.com/watch?v=abcdefghijk"
+FORMATS = [
+    {"itag": "18", "url": "https://r1.googlevideo.com/18", "ext": "mp4", "vcodec": "avc1.42001E",
+     "acodec": "mp4a.40.2", "height": 360, "width": 640, "fps": 30, "bitrate": 500000, "size": 0},
+    {"itag": "22", "url": "https://r1.googlevideo.com/22", "ext": "mp4", "vcodec": "avc1.64001F",
+     "acodec": "mp4a.40.2", "height": 720, "width": 1280, "fps": 30, "bitrate": 1500000, "size": 0},
+]
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    """Fast URL-only cobalt, slower yt-dlp with a format list, everything else empty; all launched at once."""
+    engine = YouTubeReverse()
+    launched = []
+
+    def stub(name, result, delay=0):
+        async def run(url, *args, itag=None, **kwargs):
+            launched.append(name)
+            await asyncio.sleep(delay)
+            if name == "ytdlp" and result:
+                # Like ytdlp_worker.extract: the pinned itag if listed, else the tallest combined
+                best = next((f for f in FORMATS if f["itag"] == itag), FORMATS[-1])
+                return dict(result, url=best["url"])
+            return result
+        return run
+
+    monkeypatch.setattr(engine, "_engine_cobalt", stub("cobalt", {"url": "https://cobalt/bare", "engine": "cobalt"}))
+    monkeypatch.setattr(engine, "_engine_ytdlp", stub("ytdlp", {"formats": FORMATS, "engine": "yt-dlp-proxy"}, 0.05))
+    for name in ("native", "piped", "invidious", "savefrom", "selenium"):
+        monkeypatch.setattr(engine, f"_engine_{name}", stub(name, None))
+    monkeypatch.setattr(engine.scheduler, "hedge_delay", lambda name: 0)
+    monkeypatch.setattr(YouTubeReverse, "DISABLED_ENGINES", set())
+    engine.launched = launched
+    return engine
+
+
+def test_bare_url_wins_without_itag(engine):
+    result = asyncio.run(engine._race(URL, None, False))
+    assert result["engine"] == "cobalt"
+
+
+def test_pinned_itag_waits_for_a_format_list(engine):
+    result = asyncio.run(engine._race(URL, "22", False))
+    assert result["engine"] == "yt-dlp-proxy"
+    assert result["url"].endswith("/22")
+    assert "cobalt" not in engine.launched and "savefrom" not in engine.launched
+
+
+def test_pinned_itag_missing_everywhere_fails(engine):
+    assert asyncio.run(engine._race(URL, "999", False)) is None
+
+
+def test_playable_checks_the_pinned_itag(engine):
+    assert engine._playable({"url": "https://cobalt/bare"}, False)
+    assert not engine._playable({"url": "https://cobalt/bare"}, False, "22")
+    assert engine._playable({"url": "x", "formats": FORMATS}, False, "22")
+    assert not engine._playable({"url": "x", "formats": FORMATS}, False, "137")
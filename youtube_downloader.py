@@ -1,7 +1,16 @@
 import asyncio
 import os
-import ssl
-from youtube_reverse import YouTubeReverse
+import re
+from youtube_reverse import YouTubeReverse, ProxyManager
+from executors import ytdlp_pool
+import ytdlp_worker
+from media_cache import MediaCache
+from singleflight import SingleFlight
+from formats import FormatIndex, parse_quality
+from resumable import UrlRefresher
+from prewarm import HotSet, Prewarmer
+from cancellation import cancel_all
+import metrics
 
 
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"
@@ -15,6 +24,11 @@ class YouTubeDownloader:
     """
     def __init__(self):
         self.reverse_engine = YouTubeReverse()
+        self.cache = MediaCache()
+        self.inflight = SingleFlight()
+        # Request frequency per cache key; hot entries get refreshed before they expire
+        self.hot = HotSet()
+        self.prewarmer = Prewarmer(self, self.hot)
         # Minimal options for the yt-dlp fallback
         self.ydl_opts = {
             'nocheckcertificate': True,
@@ -24,23 +38,229 @@ class YouTubeDownloader:
             'noplaylist': True,    # CRITICAL: Ignore the playlist part of the URL
         }
 
-    async def get_media_info(self, url, itag=None):
+    PLAYLIST_MAX_ITEMS = int(os.getenv("PLAYLIST_MAX_ITEMS", "500"))
+
+    def is_playlist(self, url):
+        """Playlist pages (list=... without a video id); watch?v=...&list=... stays one video."""
+        return bool(re.search(r"[?&]list=", url)) and not self.reverse_engine._extract_video_id(url)
+
+    async def expand_playlist(self, url, limit=None, admit=None):
+        """
+        Video URLs of a playlist via yt-dlp's flat extraction, on the shared yt-dlp pool.
+        `admit` is called (and may raise) first, as before a race in get_media_info.
+        """
+        limit = min(limit or self.PLAYLIST_MAX_ITEMS, self.PLAYLIST_MAX_ITEMS)
+        if admit: admit()
+        proxy = await ProxyManager.get_proxy()
+        print(f"[Playlist] Expanding: {url}")
+        result = await ytdlp_pool.submit(ytdlp_worker.expand_playlist, url, proxy, limit)
+        return result["urls"]
+
+    async def iter_media_info(self, urls, concurrency=8, **kwargs):
+        """
+        Resolves many URLs with at most `concurrency` lookups in flight, yielding
+        (index, url, info or exception) in completion order. Every lookup goes through
+        get_media_info, so repeats share the cache and in-flight dedup like single calls.
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def one(index, url):
+            async with semaphore:
+                try:
+                    return index, url, await self.get_media_info(url, **kwargs)
+                except Exception as e:
+                    return index, url, e
+
+        pending = [asyncio.ensure_future(one(i, u)) for i, u in enumerate(urls)]
+        try:
+            for next_done in asyncio.as_completed(pending):
+                yield await next_done
+        finally:
+            # Client went away mid-batch: drop whatever is still queued or running (a race
+            # other requests are also waiting on keeps going; see SingleFlight)
+            await cancel_all(pending)
+
+    async def get_media_info(self, url, itag=None, mode="combined", quality=None, codec=None, refresh=False, admit=None):
         """
         Main analysis entry point.
+        - mode="combined": one progressive (video+audio) stream in `play`
+        - mode="adaptive": best video-only + audio-only pair in `video_url`/`audio_url`
+          for muxing, picked by `quality` (max height, e.g. '1080p') and `codec` (h264/vp9/av1)
+        - mode="audio": best audio-only stream in `audio_url` (`codec` aac/opus preferred),
+          so audio requests skip the video bytes entirely
+        Videos without a progressive stream come back as adaptive in either mode.
+        `itag` pins that stream (a video-only one gets the best audio to mux with); any
+        cached result for the video whose format index lists it answers without a race.
+        refresh=True drops the cached entry and races again (signed URLs that started failing).
+        `admit()` is called right before a new race starts (not on cache hits or when joining
+        one already in flight) and may raise to refuse it.
         """
         # Normalize URL (Convert youtu.be to youtube.com)
         if "youtu.be/" in url:
             video_id = url.split("youtu.be/")[1].split("?")[0].split("&")[0]
             url = f"https://www.youtube.com/watch?v={video_id}"
 
+        # Audio and adaptive lookups both need the full format list: same race, same cache entry
+        adaptive = mode in ("adaptive", "audio")
+        variant = "adaptive" if adaptive else None
+
+        # Cached result from an earlier race (same video id + itag, URL not yet expired)
+        video_id = self.reverse_engine._extract_video_id(url)
+        key = MediaCache.key(video_id, itag, variant)
+        with metrics.span("get_media_info", mode=mode) as span:
+            if refresh and video_id:
+                await self.cache.invalidate(video_id, itag, variant)
+            info = await self.cache.get(video_id, itag, variant) if video_id and not refresh else None
+            # Cache entry answering this lookup, as (key, itag, adaptive) for the hot set
+            served = (key, itag, adaptive)
+            if not info and itag and video_id and not refresh:
+                # Not raced for this itag yet, but another lookup's format list may have it
+                info, other = await self._cached_with_itag(video_id, itag, adaptive)
+                served = other or served
+            if video_id:
+                self.hot.touch(served[0], url, *served[1:])
+            cache = "refresh" if refresh else "hit" if info else "miss"
+            if info:
+                print(f"[Cache] Hit: {video_id} (itag={itag or 'best'}{', adaptive' if adaptive else ''})")
+                # Served now; refreshed in the background if hot and close to expiry
+                self.prewarmer.on_hit(served[0], info)
+            elif video_id:
+                # Concurrent lookups for the same video share a single race
+                if admit and not self.inflight.running(key): admit()
+                info = await self.inflight.do(key, lambda: self._resolve(url, itag, video_id, adaptive))
+            else:
+                if admit: admit()
+                info = await self._resolve(url, itag, None, adaptive)
+            span.set(cache=cache)
+            metrics.LOOKUPS.inc(cache=cache)
+        return self._select(info, mode, quality, codec, itag)
+
+    async def _cached_with_itag(self, video_id, itag, adaptive):
+        """
+        A cached itag-less result (either variant, `adaptive`'s first) whose format index
+        lists `itag`, as (info, (key, None, adaptive)); else (None, None).
+        """
+        for entry_adaptive in (adaptive, not adaptive):
+            variant = "adaptive" if entry_adaptive else None
+            info = await self.cache.get(video_id, None, variant)
+            if info and FormatIndex.of(info).itag(itag):
+                return info, (MediaCache.key(video_id, None, variant), None, entry_adaptive)
+        return None, None
+
+    async def revalidate(self, url, itag=None, adaptive=False):
+        """
+        Background re-race that replaces the cached entry only on success; unlike
+        get_media_info(refresh=True) the current entry keeps serving meanwhile.
+        """
+        video_id = self.reverse_engine._extract_video_id(url)
+        key = MediaCache.key(video_id, itag, "adaptive" if adaptive else None)
+        return await self.inflight.do(key + ":revalidate", lambda: self._resolve(url, itag, video_id, adaptive))
+
+    def url_refresher(self, url, stream_url, stream_itag=None, itag=None, mode="adaptive", shared=None):
+        """
+        UrlRefresher for one stream URL of `url`: re-races with the cache bypassed and
+        pins `stream_itag` so a resumed transfer gets the same bytes (the progressive
+        `play` stream when there's no itag). `itag`/`mode` are the original lookup's.
+        Refreshers passing the same `shared` dict reuse each other's fresh result.
+        """
+        shared = {} if shared is None else shared
+
+        def pick(info):
+            if stream_itag:
+                found = FormatIndex.of(info).itag(stream_itag)
+                return found["url"] if found else None
+            return info.get("play")
+
+        async def resolve(pinned):
+            # Video and audio usually expire together: one new race serves both
+            if shared.get("info"):
+                fresh_url = pick(shared["info"])
+                if fresh_url and fresh_url != refresher.url:
+                    return fresh_url
+            fresh = await self.get_media_info(url, itag=itag, mode=mode, refresh=True)
+            if not fresh:
+                return None
+            shared["info"] = fresh
+            return pick(fresh)
+
+        refresher = UrlRefresher(resolve, stream_url, stream_itag)
+        return refresher
+
+    def stream_itags(self, info):
+        """(url, itag) per stream of a selected result, in media_sources() order (itag None if unknown)."""
+        if info["mode"] == "adaptive":
+            return [(info["video_url"], info["video_itag"]), (info["audio_url"], info["audio_itag"])]
+        if info["mode"] == "audio":
+            return [(info["audio_url"], info["audio_itag"])]
+        match = next((f for f in info.get("formats") or [] if f.get("url") == info["play"]), None)
+        return [(info["play"], match["itag"] if match else None)]
+
+    def stream_refreshers(self, url, info, itag=None):
+        """One url_refresher per stream of a selected result, in media_sources() order."""
+        pinned = self.stream_itags(info)
+        mode = "combined" if info["mode"] == "combined" else "adaptive"
+        shared = {}
+        return [self.url_refresher(url, stream_url, stream_itag, itag, mode, shared) for stream_url, stream_itag in pinned]
+
+    def _select(self, info, mode, quality, codec, itag=None):
+        """Picks the streams to use from a (cached) result; quality/codec/itag don't need a new race."""
+        if not info:
+            return None
+        index = FormatIndex.of(info)
+        pinned = index.itag(itag) if itag else None
+        if itag and not pinned:
+            # Not listed for this video: don't pass off another stream as the one asked for
+            print(f"[!] itag {itag} not available")
+            return None
+        if pinned and pinned["kind"] == "combined" and mode != "audio":
+            return dict(
+                info, mode="combined", play=pinned["url"],
+                quality=f"{pinned['height']}p", width=pinned["width"], height=pinned["height"]
+            )
+        if mode == "audio":
+            audio = pinned if pinned and pinned["kind"] == "audio" else index.audio(codec)
+            if audio:
+                return dict(
+                    info, mode="audio",
+                    audio_url=audio["url"], audio_itag=audio["itag"], acodec=audio["acodec"]
+                )
+            # No audio-only stream listed: the progressive one still works (with -vn)
+        elif mode == "adaptive" or not info.get("play") or pinned:
+            video, audio = index.adaptive(quality, codec)
+            if pinned and pinned["kind"] == "video":
+                video, audio = pinned, index.audio_for(pinned)
+            elif pinned and pinned["kind"] == "audio":
+                audio = pinned
+            if video and audio:
+                return dict(
+                    info, mode="adaptive",
+                    video_url=video["url"], audio_url=audio["url"],
+                    video_itag=video["itag"], audio_itag=audio["itag"],
+                    vcodec=video["vcodec"], acodec=audio["acodec"],
+                    quality=f"{video['height']}p", width=video["width"], height=video["height"]
+                )
+            if parse_quality(quality) and index.formats and not pinned:
+                # Nothing to mux under the cap: the tallest progressive stream that fits, never a taller one
+                fallback = index.combined(quality)
+                if not fallback:
+                    return None
+                return dict(
+                    info, mode="combined", play=fallback["url"],
+                    quality=f"{fallback['height']}p", width=fallback["width"], height=fallback["height"]
+                )
+        if not info.get("play"):
+            return None
+        return dict(info, mode="combined")
+
+    async def _resolve(self, url, itag, video_id, adaptive=False):
         print(f"[*] Analyzing: {url}")
         
         # STEP 1: Try Reverse Engines (Fast & Lightweight)
         try:
-            media = await self.reverse_engine.fetch_video_info(url, itag=itag)
-            if media and media.get("url"):
+            media = await self.reverse_engine.fetch_video_info(url, itag=itag, adaptive=adaptive)
+            if media and (media.get("url") or media.get("formats")):
                 print(f"[+] Success using {media['engine']}!")
-                return {
+                info = {
                     "title": media.get("title", "YouTube Video"),
                     "thumbnail": media.get("thumbnail"),
                     "play": media.get("url"),
@@ -49,7 +269,18 @@ class YouTubeDownloader:
                     "height": media.get("height"),
                     "engine": media.get("engine")
                 }
-        except: pass
+                # Indexed once here and cached with the result: later picks are lookups
+                index = FormatIndex(media.get("formats") or [])
+                info.update(formats=index.formats, index=index.tables)
+                if video_id:
+                    variant = "adaptive" if adaptive else None
+                    # Without the itag in its format list the result is the plain lookup's, cached as such
+                    cached_itag = itag if itag and index.itag(itag) else None
+                    await self.cache.set(video_id, cached_itag, info, variant)
+                    self.hot.resolved(MediaCache.key(video_id, cached_itag, variant), self.cache.ttl_for(info))
+                return info
+        except Exception as e:
+            print(f"[!] Resolve failed: {e}")
 
         # STEP 2: Fallback already handled inside YouTubeReverse (which now includes yt-dlp)
         return None
@@ -1,12 +1,18 @@
 import asyncio
-import aiohttp
-import json
 import os
-import traceback
+import time
 import random
-import yt_dlp
 import re
 
+from http_pool import HttpPool
+from engine_scheduler import EngineScheduler, EngineSkipped
+from formats import FormatIndex, from_invidious, from_piped, pick_adaptive, pick_combined
+from cancellation import cancel_all
+import metrics
+from executors import ytdlp_pool, selenium_pool, ExecutorSaturated
+import innertube
+import ytdlp_worker
+import selenium_worker
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -20,267 +26,274 @@ class ProxyManager:
             return cls._residential_proxy
         return None
 
+def _instances(name, default):
+    """Comma-separated instance list from the environment (e.g. to point at mirrors or local stubs)."""
+    return [u.strip().rstrip("/") for u in os.getenv(name, default).split(",") if u.strip()]
+
 class YouTubeReverse:
     """
     Hyper-Robust YouTube Engine.
     Uses residential proxies and multi-api racing to bypass all blocks.
     """
+    RACE_TIMEOUT = float(os.getenv("RACE_TIMEOUT", "12"))
+    COBALT_INSTANCES = _instances("COBALT_INSTANCES", "https://api.cobalt.tools/api/json,https://cobalt.shizuri.com/api/json,https://api.cobalt.red/api/json")
+    PIPED_INSTANCES = _instances("PIPED_INSTANCES", "https://pipedapi.kavin.rocks,https://api.piped.victr.me,https://pipedapi.lunar.icu,https://api-piped.mha.fi")
+    INVIDIOUS_INSTANCES = _instances("INVIDIOUS_INSTANCES", "https://inv.tux.pizza,https://yewtu.be,https://iv.melmac.space,https://inv.nadeko.net")
+    SAVEFROM_API = os.getenv("SAVEFROM_API", "https://worker.savefrom.net/api/convert")
+    # Engines left out of every race, e.g. "selenium,ytdlp-direct"
+    DISABLED_ENGINES = set(_instances("DISABLED_ENGINES", ""))
+
     def __init__(self):
         self.user_agents = [
             "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
             "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
             "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1"
         ]
+        # Health scores + circuit breakers for engines and individual API instances
+        self.scheduler = EngineScheduler()
 
-    async def fetch_video_info(self, url, itag=None):
+    # Engines that only hand back one ready-made URL (no adaptive format list)
+    URL_ONLY_ENGINES = ("cobalt", "savefrom")
+
+    async def fetch_video_info(self, url, itag=None, adaptive=False):
         """
-        Ultimate Parallel Race: Engines compete for the fastest response.
+        Hedged Race: engines launch best-first by health score, and the next one
+        only starts if the leader hasn't answered within its typical latency.
+        adaptive=True only accepts results with separate video-only + audio-only
+        formats (for muxing), and a pinned itag only results listing it, so the
+        URL-only engines sit those races out.
         """
-        print(f"[*] Starting Ultimate Race for: {url}")
+        print(f"[*] Starting Ultimate Race for: {url}{' (adaptive)' if adaptive else ''}")
+        mode = "adaptive" if adaptive else "combined"
+        started = time.monotonic()
+        with metrics.span("race", mode=mode) as span:
+            result = await self._race(url, itag, adaptive)
+            span.set(winner=result.get("engine") if result else None)
+        metrics.RACES.inc(mode=mode, result="won" if result else "failed")
+        metrics.RACE_DURATION.observe(time.monotonic() - started, mode=mode, result="won" if result else "failed")
+        if result:
+            metrics.RACE_WINS.inc(engine=result.get("engine", "unknown"))
+        return result
+
+    async def _race(self, url, itag, adaptive):
+        accept = lambda result: self._playable(result, adaptive, itag)
         
         # Parallel Engines
-        fast_tasks = [
-            self._engine_cobalt(url),   # Turbo
-            self._engine_native(url),   # Resi Scraper
-            self._engine_piped(url),    # API Loop
-            self._engine_invidious(url),# API Loop
-            self._engine_savefrom(url), # External Scraper
-            self._engine_ytdlp(url, use_proxy=True, itag=itag) # Resi yt-dlp
-        ]
+        fast_engines = {
+            "cobalt": lambda: self._engine_cobalt(url),          # Turbo
+            "native": lambda: self._engine_native(url),          # Resi Scraper
+            "piped": lambda: self._engine_piped(url),            # API Loop
+            "invidious": lambda: self._engine_invidious(url),    # API Loop
+            "savefrom": lambda: self._engine_savefrom(url),      # External Scraper
+            "ytdlp-proxy": lambda: self._engine_ytdlp(url, use_proxy=True, itag=itag) # Resi yt-dlp
+        }
+        if adaptive or itag:
+            for name in self.URL_ONLY_ENGINES: fast_engines.pop(name)
+        for name in self.DISABLED_ENGINES: fast_engines.pop(name, None)
         
-        # Racer Loop: First valid response wins.
-        for future in asyncio.as_completed(fast_tasks, timeout=12):
-            try:
-                result = await future
-                if result and result.get("url"):
-                    print(f"[Race] Winner: {result.get('engine', 'unknown')}")
-                    return result
-            except: continue
+        result = await self._hedged_race(fast_engines, accept)
+        if result:
+            print(f"[Race] Winner: {result.get('engine', 'unknown')}")
+            return result
 
         # Heavy Fallbacks
         print("[*] Race Failed. Trying Sequential Fallbacks...")
-        heavy_engines = [
-            lambda u: self._engine_ytdlp(u, use_proxy=False), 
-            self._engine_selenium
-        ]
+        heavy_engines = {
+            "ytdlp-direct": lambda: self._engine_ytdlp(url, use_proxy=False, itag=itag),
+            "selenium": lambda: self._engine_selenium(url)
+        }
         
-        for engine_coro in heavy_engines:
-            try:
-                result = await engine_coro(url)
-                if result and result.get("url"):
-                    return result
-            except: continue
+        for name, engine_fn in heavy_engines.items():
+            if name in self.DISABLED_ENGINES or not self.scheduler.available(name): continue
+            result = await self.scheduler.run(name, engine_fn)
+            if accept(result):
+                return result
                 
         return None
 
+    def _playable(self, result, adaptive, itag=None):
+        """
+        A progressive URL, or (adaptive mode / no progressive stream) a muxable pair.
+        With `itag` pinned the format list has to have it, whatever the mode.
+        """
+        if not result: return False
+        if itag: return FormatIndex(result.get("formats") or []).itag(itag) is not None
+        if result.get("url") and not adaptive: return True
+        return pick_adaptive(result.get("formats") or [])[0] is not None
+
+    async def _hedged_race(self, engines, accept):
+        """
+        Staggered launch over `engines` (name -> coroutine factory).
+        A new engine starts when the last one exceeded its hedge delay or failed.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.RACE_TIMEOUT
+        # If every breaker is open, fail open rather than refusing the request outright
+        queue = self.scheduler.ordered(list(engines)) or list(engines)
+        pending = set()
+
+        try:
+            while True:
+                wait = None
+                if queue:
+                    name = queue.pop(0)
+                    pending.add(asyncio.ensure_future(self.scheduler.run(name, engines[name])))
+                    wait = self.scheduler.hedge_delay(name)
+                if not pending:
+                    return None
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                wait = remaining if wait is None else min(wait, remaining)
+                done, pending = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if accept(result):
+                        return result
+        finally:
+            # Losers (or everyone, on timeout) are cancelled: HTTP requests abort,
+            # executor-bound engines get their cancel_event set
+            await cancel_all(pending)
+
     async def _engine_cobalt(self, url):
         """
         Cobalt API (v10) Mirror Racing.
         """
-        instances = [
-            "https://api.cobalt.tools/api/json",
-            "https://cobalt.shizuri.com/api/json",
-            "https://api.cobalt.red/api/json"
-        ]
-        
+        instances = self.COBALT_INSTANCES
+
         async def _hit(api_url):
             payload = {"url": url, "vQuality": "1080", "isAudioOnly": False}
             headers = {"Accept": "application/json", "User-Agent": random.choice(self.user_agents)}
-            try:
-                async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-                    async with session.post(api_url, json=payload, headers=headers, timeout=8) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            if data.get("url"):
-                                return {
-                                    "title": data.get("text", "YouTube Video"),
-                                    "url": data["url"],
-                                    "thumbnail": None,
-                                    "quality": "1080p", "width": 1920, "height": 1080,
-                                    "engine": f"cobalt-{api_url.split('/')[2]}"
-                                }
-            except: pass
+            # Errors propagate to scheduler.run, which records them as the failure reason
+            session = await HttpPool.get()
+            async with session.post(api_url, json=payload, headers=headers, timeout=8) as resp:
+                if resp.status == 200:
+                    data = await resp.json()
+                    if data.get("url"):
+                        return {
+                            "title": data.get("text", "YouTube Video"),
+                            "url": data["url"],
+                            "thumbnail": None,
+                            "quality": "1080p", "width": 1920, "height": 1080,
+                            "engine": f"cobalt-{api_url.split('/')[2]}"
+                        }
             return None
 
-        # Mini-race for Cobalt instances
-        tasks = [_hit(inst) for inst in instances]
-        for f in asyncio.as_completed(tasks):
-            res = await f
-            if res: return res
+        # Mini-race for healthy Cobalt instances
+        hosts = {f"cobalt:{inst.split('/')[2]}": inst for inst in instances}
+        tasks = [
+            asyncio.ensure_future(self.scheduler.run(name, lambda inst=hosts[name]: _hit(inst)))
+            for name in self.scheduler.ordered(list(hosts))
+        ]
+        try:
+            for f in asyncio.as_completed(tasks):
+                res = await f
+                if res: return res
+        finally:
+            await cancel_all(tasks)
         return None
 
     async def _engine_native(self, url):
         """
-        Native YouTube Scraper with Residential Proxy.
+        Native InnerTube client with Residential Proxy: the player JSON endpoint
+        (small compressed request/response) instead of the 1 MB+ watch page, which
+        is only read, incrementally, if every API client fails.
         """
         video_id = self._extract_video_id(url)
         if not video_id: return None
         proxy = await ProxyManager.get_proxy()
-        
-        try:
-            headers = {"User-Agent": self.user_agents[0]}
-            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-                async with session.get(f"https://www.youtube.com/watch?v={video_id}", headers=headers, proxy=proxy, timeout=7) as resp:
-                    if resp.status != 200: return None
-                    html = await resp.text()
-                    match = re.search(r'ytInitialPlayerResponse\s*=\s*({.+?});', html) or \
-                            re.search(r'var\s+ytInitialPlayerResponse\s*=\s*({.+?});', html)
-                    if match:
-                        data = json.loads(match.group(1))
-                        streaming_data = data.get("streamingData", {})
-                        formats = streaming_data.get("formats", []) + streaming_data.get("adaptiveFormats", [])
-                        formats = [f for f in formats if "url" in f]
-                        combined = sorted([f for f in formats if f.get("acodec") != "none" and f.get("vcodec") != "none"], 
-                                        key=lambda x: x.get("height", 0), reverse=True)
-                        best_f = combined[0] if combined else (sorted(formats, key=lambda x: x.get("height", 0), reverse=True)[0] if formats else None)
-                        if best_f:
-                            return {
-                                "title": data.get("videoDetails", {}).get("title"),
-                                "url": best_f["url"],
-                                "thumbnail": data.get("videoDetails", {}).get("thumbnail", {}).get("thumbnails", [{}])[-1].get("url"),
-                                "quality": f"{best_f.get('height', '720')}p",
-                                "width": best_f.get("width", 1280), "height": best_f.get("height", 720), 
-                                "engine": "native-residential"
-                            }
-        except: pass
-        return None
+        return await innertube.resolve(video_id, self.user_agents[0], proxy)
 
     async def _engine_piped(self, url):
         video_id = self._extract_video_id(url)
         if not video_id: return None
-        instances = ["https://pipedapi.kavin.rocks", "https://api.piped.victr.me", "https://pipedapi.lunar.icu", "https://api-piped.mha.fi"]
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-            for instance in instances:
-                try:
-                    async with session.get(f"{instance}/streams/{video_id}", timeout=5) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            streams = data.get("videoStreams", [])
-                            if streams:
-                                best = sorted(streams, key=lambda x: x.get("height", 0), reverse=True)[0]
-                                return {
-                                    "title": data.get("title"),
-                                    "url": best["url"],
-                                    "thumbnail": data.get("thumbnailUrl"),
-                                    "quality": best.get("quality", "720p"),
-                                    "width": best.get("width", 1280), "height": best.get("height", 720),
-                                    "engine": "piped-api"
-                                }
-                except: continue
-        return None
+        instances = self.PIPED_INSTANCES
+        session = await HttpPool.get()
+
+        async def _hit(instance):
+            async with session.get(f"{instance}/streams/{video_id}", timeout=5) as resp:
+                if resp.status == 200:
+                    data = await resp.json()
+                    streams = data.get("videoStreams", [])
+                    if streams:
+                        formats = [from_piped(s) for s in streams] + [from_piped(s, audio=True) for s in data.get("audioStreams", [])]
+                        best = pick_combined(formats)
+                        return {
+                            "title": data.get("title"),
+                            "url": best["url"] if best else None,
+                            "thumbnail": data.get("thumbnailUrl"),
+                            "quality": f"{best['height'] if best else 720}p",
+                            "width": best["width"] if best else 1280, "height": best["height"] if best else 720,
+                            "formats": formats,
+                            "engine": "piped-api"
+                        }
+            return None
+
+        return await self._instance_loop("piped", instances, _hit)
 
     async def _engine_invidious(self, url):
         video_id = self._extract_video_id(url)
         if not video_id: return None
-        instances = ["https://inv.tux.pizza", "https://yewtu.be", "https://iv.melmac.space", "https://inv.nadeko.net"]
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-            for instance in instances:
-                try:
-                    async with session.get(f"{instance}/api/v1/videos/{video_id}", timeout=5) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            streams = data.get("formatStreams", [])
-                            if streams:
-                                best = sorted(streams, key=lambda x: int(x.get("resolution", "0").replace("p","")), reverse=True)[0]
-                                return {
-                                    "title": data.get("title"),
-                                    "url": best["url"],
-                                    "thumbnail": data.get("videoThumbnails", [{}])[0].get("url"),
-                                    "quality": best.get("resolution", "720p"),
-                                    "width": 1280, "height": 720, "engine": "invidious-api"
-                                }
-                except: continue
+        instances = self.INVIDIOUS_INSTANCES
+        session = await HttpPool.get()
+
+        async def _hit(instance):
+            async with session.get(f"{instance}/api/v1/videos/{video_id}", timeout=5) as resp:
+                if resp.status == 200:
+                    data = await resp.json()
+                    streams = data.get("formatStreams", [])
+                    if streams:
+                        best = sorted(streams, key=lambda x: int(x.get("resolution", "0").replace("p","")), reverse=True)[0]
+                        formats = [from_invidious(f) for f in streams + data.get("adaptiveFormats", [])]
+                        return {
+                            "title": data.get("title"),
+                            "url": best["url"],
+                            "thumbnail": data.get("videoThumbnails", [{}])[0].get("url"),
+                            "quality": best.get("resolution", "720p"),
+                            "width": 1280, "height": 720,
+                            "formats": formats,
+                            "engine": "invidious-api"
+                        }
+            return None
+
+        return await self._instance_loop("invidious", instances, _hit)
+
+    async def _instance_loop(self, prefix, instances, hit):
+        """Tries API instances one by one, healthiest first, skipping tripped breakers."""
+        hosts = {f"{prefix}:{inst.split('/')[2]}": inst for inst in instances}
+        for name in self.scheduler.ordered(list(hosts)):
+            result = await self.scheduler.run(name, lambda inst=hosts[name]: hit(inst))
+            if result: return result
         return None
 
     async def _engine_savefrom(self, url):
-        try:
-            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-                async with session.post("https://worker.savefrom.net/api/convert", json={"url": url}, timeout=10) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        links = data.get("url", [])
-                        if links:
-                            return {
-                                "title": data.get("title"),
-                                "url": links[0].get("url"),
-                                "thumbnail": data.get("thumb"),
-                                "quality": "720p", "width": 1280, "height": 720,
-                                "engine": "savefrom"
-                            }
-        except: pass
+        session = await HttpPool.get()
+        async with session.post(self.SAVEFROM_API, json={"url": url}, timeout=10) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                links = data.get("url", [])
+                if links:
+                    return {
+                        "title": data.get("title"),
+                        "url": links[0].get("url"),
+                        "thumbnail": data.get("thumb"),
+                        "quality": "720p", "width": 1280, "height": 720,
+                        "engine": "savefrom"
+                    }
         return None
 
     async def _engine_ytdlp(self, url, use_proxy=True, itag=None):
         proxy = await ProxyManager.get_proxy() if use_proxy else None
-        def _extract():
-            opts = {'quiet': True, 'no_warnings': True, 'nocheckcertificate': True}
-            if proxy: opts['proxy'] = proxy
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                formats = [f for f in info.get('formats', []) if f.get('url')]
-                
-                best = None
-                if itag:
-                    # Look for specific itag
-                    best = next((f for f in formats if str(f.get('format_id')) == str(itag)), None)
-                
-                if not best:
-                    # Filter for combined formats (video+audio) sort by height
-                    playable = sorted([f for f in formats if f.get('vcodec') != 'none' and f.get('acodec') != 'none'],
-                                   key=lambda x: x.get('height', 0), reverse=True)
-                    if playable:
-                        best = playable[0]
-                
-                if best:
-                    return {
-                        "title": info.get("title"),
-                        "url": best["url"],
-                        "thumbnail": info.get("thumbnail"),
-                        "quality": f"{best.get('height', '720')}p",
-                        "width": best.get("width", 1280), "height": best.get("height", 720),
-                        "engine": f"yt-dlp-{'proxy' if proxy else 'direct'}"
-                    }
-            return None
         try:
-            loop = asyncio.get_event_loop()
-            return await loop.run_in_executor(None, _extract)
-        except: return None
+            return await ytdlp_pool.submit(ytdlp_worker.extract, url, proxy, itag)
+        except ExecutorSaturated as e:
+            raise EngineSkipped(str(e))
 
     async def _engine_selenium(self, url):
-        def _selenium_task():
-            from selenium import webdriver
-            from selenium.webdriver.chrome.options import Options
-            import time
-            chrome_options = Options()
-            chrome_options.add_argument("--headless")
-            chrome_options.add_argument("--no-sandbox")
-            chrome_options.add_argument("--disable-dev-shm-usage")
-            driver = webdriver.Chrome(options=chrome_options)
-            try:
-                driver.get(url)
-                time.sleep(5)
-                data_json = driver.execute_script("return JSON.stringify(window.ytInitialPlayerResponse);")
-                if data_json:
-                    data = json.loads(data_json)
-                    vd = data.get("videoDetails", {})
-                    formats = data.get("streamingData", {}).get("formats", []) + data.get("streamingData", {}).get("adaptiveFormats", [])
-                    formats = [f for f in formats if "url" in f]
-                    if formats:
-                        best = sorted(formats, key=lambda x: x.get("height", 0), reverse=True)[0]
-                        return {
-                            "title": vd.get("title"),
-                            "url": best["url"],
-                            "thumbnail": vd.get("thumbnail", {}).get("thumbnails", [{}])[-1].get("url"),
-                            "quality": f"{best.get('height', '720')}p",
-                            "width": best.get("width", 1280), "height": best.get("height", 720),
-                            "engine": "selenium"
-                        }
-            finally: driver.quit()
-            return None
         try:
-            loop = asyncio.get_event_loop()
-            return await loop.run_in_executor(None, _selenium_task)
-        except: return None
+            return await selenium_pool.submit(selenium_worker.scrape, url)
+        except ExecutorSaturated as e:
+            raise EngineSkipped(str(e))
 
     def _extract_video_id(self, url):
         match = re.search(r"(?:v=|\/)([0-9A-Za-z_-]{11}).*", url)
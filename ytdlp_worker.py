@@ -0,0 +1,117 @@
+import threading
+
+from formats import from_ytdlp, FormatIndex
+
+
+_ydl_class = None
+
+
+def youtube_dl_class():
+    """
+    CancellableYoutubeDL: a YoutubeDL that checks a cancel event before every HTTP
+    request, so an extraction whose race was already lost stops at the next network call.
+    Built on first use: importing yt_dlp costs every worker ~130 ms and tens of MB,
+    which only the yt-dlp engines need.
+    """
+    global _ydl_class
+    if _ydl_class is None:
+        import yt_dlp
+
+        class CancellableYoutubeDL(yt_dlp.YoutubeDL):
+            def __init__(self, params=None, cancel_event=None, **kwargs):
+                super().__init__(params, **kwargs)
+                self.cancel_event = cancel_event
+
+            def urlopen(self, req):
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    raise yt_dlp.utils.DownloadCancelled("Race lost")
+                return super().urlopen(req)
+
+        _ydl_class = CancellableYoutubeDL
+    return _ydl_class
+
+
+def preload():
+    """Imports yt_dlp and its YouTube extractor now (gunicorn preload: shared copy-on-write pages)."""
+    youtube_dl_class()
+    from yt_dlp.extractor.youtube import YoutubeIE  # noqa: F401
+
+
+# One warm YoutubeDL per worker thread/process and proxy setting.
+# Reusing it keeps the extractor instances, player JS and cookie jar hot between calls.
+_local = threading.local()
+
+
+def _warm_ydl(proxy, flat=False):
+    instances = getattr(_local, "instances", None)
+    if instances is None:
+        instances = _local.instances = {}
+    ydl = instances.get((proxy, flat))
+    if ydl is None:
+        opts = {'quiet': True, 'no_warnings': True, 'nocheckcertificate': True}
+        if proxy: opts['proxy'] = proxy
+        # Flat: list a playlist's entries without resolving every video in it
+        if flat: opts['extract_flat'] = 'in_playlist'
+        ydl = instances[(proxy, flat)] = youtube_dl_class()(opts)
+    return ydl
+
+
+def init_worker(*proxies):
+    """
+    Pays the extractor setup once per worker: one instance per proxy setting the
+    races will use (default: direct only, e.g. as the ProcessPoolExecutor initializer).
+    """
+    for proxy in proxies or (None,):
+        _warm_ydl(proxy)
+
+
+def extract(url, proxy=None, itag=None, cancel_event=None):
+    """
+    Runs a yt-dlp extraction and picks the stream to play.
+    `cancel_event` is only available in thread mode (events don't cross processes).
+    """
+    ydl = _warm_ydl(proxy)
+    ydl.cancel_event = cancel_event
+    try:
+        info = ydl.extract_info(url, download=False)
+    finally:
+        ydl.cancel_event = None
+    formats = [from_ytdlp(f) for f in info.get('formats', []) if f.get('url')]
+
+    # Specific itag if asked for, else the tallest combined (video+audio) format
+    index = FormatIndex(formats)
+    best = index.itag(itag) if itag else None
+    if not best:
+        best = index.combined()
+
+    if formats:
+        return {
+            "title": info.get("title"),
+            "url": best["url"] if best else None,
+            "thumbnail": info.get("thumbnail"),
+            "quality": f"{best['height'] if best and best['height'] else 720}p",
+            "width": best["width"] if best and best["width"] else 1280,
+            "height": best["height"] if best and best["height"] else 720,
+            "formats": formats,
+            "engine": f"yt-dlp-{'proxy' if proxy else 'direct'}"
+        }
+    return None
+
+
+def expand_playlist(url, proxy=None, limit=500, cancel_event=None):
+    """
+    Lists a playlist's videos (flat extraction: the playlist pages only, no per-video lookups).
+    Returns {"title", "urls"} with at most `limit` watch URLs.
+    """
+    ydl = _warm_ydl(proxy, flat=True)
+    ydl.cancel_event = cancel_event
+    ydl.params['playlistend'] = limit
+    try:
+        info = ydl.extract_info(url, download=False)
+    finally:
+        ydl.cancel_event = None
+    urls = []
+    for entry in info.get('entries') or []:
+        if entry and entry.get('id') and len(urls) < limit:
+            urls.append(f"https://www.youtube.com/watch?v={entry['id']}")
+    return {"title": info.get("title"), "urls": urls}